@@ -0,0 +1,77 @@
+"""Compares the raster and vector dilation engines used to build the rural mask.
+
+The vector engine is run twice: buffering in Mollweide, as the rural mask was built
+before the distance transform, and in an azimuthal equidistant projection centered
+on the raster, which measures true distances like the distance transform. The first
+mismatch is the change in the rural mask, and the second is the error of the
+distance transform.
+
+Usage:
+    python -m benchmarks.dilation data/esa_worldcover_v200/*/*.tif
+
+The published WorldCover tiles can be read directly, cropped to a city:
+    python -m benchmarks.dilation --bounds -100.5 25.5 -100.1 25.9 \
+        https://esa-worldcover.s3.eu-central-1.amazonaws.com/v200/2021/map/ESA_WorldCover_10m_2021_v200_N24W102_Map.tif
+"""
+
+import argparse
+import time
+
+import numpy as np
+import rasterio as rio
+
+from rasterio.windows import from_bounds
+from ursa_backend.code.constants import RURAL_BUFFER_SIZE
+from ursa_backend.code.world_cover import (
+    dilate_binary_array,
+    dilate_binary_array_edt,
+    get_local_projection,
+)
+
+
+def time_call(func, *args, **kwargs) -> tuple[float, np.ndarray]:
+    start = time.perf_counter()
+    out = func(*args, **kwargs)
+    return time.perf_counter() - start, out
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("cover_paths", nargs="+")
+    parser.add_argument("--buffer-size", type=float, default=RURAL_BUFFER_SIZE)
+    parser.add_argument(
+        "--bounds",
+        nargs=4,
+        type=float,
+        metavar=("XMIN", "YMIN", "XMAX", "YMAX"),
+        help="Crop each raster to these bounds, in its CRS.",
+    )
+    args = parser.parse_args()
+
+    print("raster\tshape\tvector_s\tedt_s\tspeedup\tmismatch_frac\taeqd_mismatch_frac")
+    for path in args.cover_paths:
+        with rio.open(path) as ds:
+            window = None
+            if args.bounds is not None:
+                window = from_bounds(*args.bounds, transform=ds.transform)
+                window = window.round_offsets().round_lengths()
+            urban = ds.read(1, window=window) == 50
+            transform = ds.transform if window is None else ds.window_transform(window)
+            kwargs = dict(transform=transform, crs=ds.crs, buffer_size=args.buffer_size)
+
+        t_vector, vector = time_call(dilate_binary_array, urban, **kwargs)
+        t_edt, edt = time_call(dilate_binary_array_edt, urban, **kwargs)
+        mismatch = np.mean(vector != edt)
+        aeqd = dilate_binary_array(
+            urban, projection=get_local_projection(transform, urban.shape), **kwargs
+        )
+        aeqd_mismatch = np.mean(aeqd != edt)
+
+        print(
+            f"{path}\t{urban.shape}\t{t_vector:.2f}\t{t_edt:.2f}"
+            f"\t{t_vector / t_edt:.1f}x\t{mismatch:.5f}\t{aeqd_mismatch:.5f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
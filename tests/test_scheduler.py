@@ -0,0 +1,33 @@
+import ee
+import httplib2
+import pytest
+
+from googleapiclient.errors import HttpError
+from ursa_backend.code.scheduler import is_retryable
+
+
+def raise_ee_exception(status: int) -> None:
+    """Raises an HTTP error the way `ee.data` does, as an `ee.EEException` raised
+    while handling it, without `from`."""
+    try:
+        raise HttpError(httplib2.Response({"status": status}), b"")
+    except HttpError as exc:
+        raise ee.EEException(str(exc))
+
+
+@pytest.mark.parametrize(
+    "status, expected", [(429, True), (500, True), (503, True), (400, False)]
+)
+def test_chained_ee_exception(status: int, expected: bool) -> None:
+    with pytest.raises(ee.EEException) as info:
+        raise_ee_exception(status)
+
+    assert info.value.__cause__ is None
+    assert is_retryable(info.value) is expected
+
+
+def test_context_cycle() -> None:
+    first, second = ValueError(), ValueError()
+    first.__context__, second.__context__ = second, first
+
+    assert not is_retryable(first)
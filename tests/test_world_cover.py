@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+import scipy.ndimage
+
+from affine import Affine
+from rasterio.crs import CRS
+from ursa_backend.code.world_cover import (
+    dilate_binary_array,
+    dilate_binary_array_edt,
+    get_local_projection,
+)
+
+
+# Largest fraction of pixels in which the distance transform may differ from buffering
+# the polygonized mask in a projection that measures true distances
+MAX_MISMATCH = 1e-3
+
+
+@pytest.mark.parametrize("lat", [25.9, 60.0])
+def test_edt_matches_true_distance_buffer(lat: float) -> None:
+    rng = np.random.default_rng(0)
+    noise = scipy.ndimage.gaussian_filter(rng.random((400, 500)), 8)
+    urban = noise > np.quantile(noise, 0.9)
+    urban[rng.random(urban.shape) < 0.002] = True
+
+    res = 50 / 111_319.49
+    transform = Affine(res, 0, -100.5, 0, -res, lat)
+    crs = CRS.from_epsg(4326)
+
+    edt = dilate_binary_array_edt(
+        urban, transform=transform, crs=crs, buffer_size=500, strip_height=64
+    )
+    vector = dilate_binary_array(
+        urban,
+        transform=transform,
+        crs=crs,
+        buffer_size=500,
+        projection=get_local_projection(transform, urban.shape),
+    )
+
+    assert np.mean(edt != vector) <= MAX_MISMATCH
@@ -3,12 +3,13 @@ import ee
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
-from ursa_backend.routers import suhi
+from ursa_backend.routers import admin, suhi
 
 ee.Initialize(project="ee-ursa-test")
 
 app = FastAPI()
 app.include_router(suhi.router)
+app.include_router(admin.router)
 
 app.add_middleware(
     CORSMiddleware,
@@ -16,6 +17,16 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[
+        "X-Raster-Width",
+        "X-Raster-Height",
+        "X-Raster-Dtype",
+        "X-Raster-Crs",
+        "X-Raster-Transform",
+        "X-Color-Bounds",
+        "X-Raster-Scale",
+        "X-Full-Resolution-Job",
+    ],
 )
 
 
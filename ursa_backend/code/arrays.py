@@ -0,0 +1,297 @@
+import atexit
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+import rasterio as rio
+
+from collections import OrderedDict
+from contextlib import closing
+from pathlib import Path
+from typing import Callable
+from ursa_backend.code.constants import (
+    ARRAY_CACHE_ATTACHED,
+    ARRAY_CACHE_MAX_BYTES,
+    ARRAY_CACHE_PATH,
+)
+from ursa_backend.code.fs import atomic_write, read_raster
+from ursa_backend.code.locks import single_flight
+from ursa_backend.models import RasterResponseModel
+
+
+INDEX_NAME = "arrays.sqlite"
+
+# Arrays attached by this process, most recently used last. Each of them holds a
+# reference in the index, so other processes don't evict it
+_attached: OrderedDict[str, np.ndarray] = OrderedDict()
+_attached_lock = threading.Lock()
+
+
+def connect_index() -> sqlite3.Connection:
+    """Opens the index of shared arrays and their references, creating it if needed."""
+    ARRAY_CACHE_PATH.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(ARRAY_CACHE_PATH / INDEX_NAME, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS arrays (
+            key TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            last_access REAL NOT NULL
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS refs (
+            key TEXT NOT NULL,
+            pid INTEGER NOT NULL,
+            PRIMARY KEY (key, pid)
+        )
+        """
+    )
+    return conn
+
+
+def get_array_path(key: str) -> Path:
+    return ARRAY_CACHE_PATH / f"{key}.npy"
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _open_array(path: Path) -> np.ndarray | None:
+    try:
+        return np.load(path, mmap_mode="r")
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _drop_dead_refs(conn: sqlite3.Connection) -> None:
+    pids = [row["pid"] for row in conn.execute("SELECT DISTINCT pid FROM refs")]
+    conn.executemany(
+        "DELETE FROM refs WHERE pid = ?",
+        [(pid,) for pid in pids if not _is_alive(pid)],
+    )
+
+
+def _acquire(key: str, size: int) -> bool:
+    """Adds a reference to an array, unless its file was evicted since it was opened.
+    The check and the insert share a write transaction with `evict_arrays`, so an
+    evicted array is never indexed again."""
+    with closing(connect_index()) as conn, conn:
+        conn.execute("BEGIN IMMEDIATE")
+        if not get_array_path(key).exists():
+            return False
+
+        conn.execute(
+            """
+            INSERT INTO arrays VALUES (?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET last_access = excluded.last_access
+            """,
+            (key, size, time.time()),
+        )
+        conn.execute("INSERT OR IGNORE INTO refs VALUES (?, ?)", (key, os.getpid()))
+        return True
+
+
+def _release(keys: list[str]) -> None:
+    with closing(connect_index()) as conn, conn:
+        conn.executemany(
+            "DELETE FROM refs WHERE key = ? AND pid = ?",
+            [(key, os.getpid()) for key in keys],
+        )
+
+
+def _release_over_budget(keep: str, max_size: int) -> list[str]:
+    """Releases the least recently used arrays attached by this process, except
+    `keep`, while the arrays attached by every process exceed the size budget.
+
+    Returns
+    -------
+    list[str]
+        Keys of the released arrays.
+    """
+    with _attached_lock:
+        candidates = [key for key in _attached if key != keep]
+    if not candidates:
+        return []
+
+    released = []
+    with closing(connect_index()) as conn, conn:
+        conn.execute("BEGIN IMMEDIATE")
+        _drop_dead_refs(conn)
+        pinned = conn.execute(
+            """
+            SELECT COALESCE(SUM(size), 0) FROM arrays
+            WHERE key IN (SELECT key FROM refs)
+            """
+        ).fetchone()[0]
+
+        for key in candidates:
+            if pinned <= max_size:
+                break
+            conn.execute(
+                "DELETE FROM refs WHERE key = ? AND pid = ?", (key, os.getpid())
+            )
+            released.append(key)
+            if conn.execute("SELECT 1 FROM refs WHERE key = ?", (key,)).fetchone():
+                continue
+            row = conn.execute("SELECT size FROM arrays WHERE key = ?", (key,))
+            pinned -= row.fetchone()["size"]
+
+    with _attached_lock:
+        for key in released:
+            _attached.pop(key, None)
+    return released
+
+
+def get_shared_array(key: str, load: Callable[[], np.ndarray]) -> np.ndarray:
+    """Returns an array shared by every worker process, decoding it only once.
+
+    Arrays are stored as .npy files under `ARRAY_CACHE_PATH` and memory-mapped, so
+    processes that attach to the same array share its pages instead of holding a
+    copy each. While a process keeps an array attached, the array holds a reference
+    that protects it from `evict_arrays`. Each process keeps at most
+    `ARRAY_CACHE_ATTACHED` arrays attached, and releases the least recently used
+    ones beyond that, or while the arrays attached by every process exceed
+    `ARRAY_CACHE_MAX_BYTES`. Callers must not keep the array once they are done with
+    it, so that released arrays are unmapped.
+
+    Parameters
+    ----------
+    key: str
+        Key of the array, usually the cache key of the raster it was decoded from.
+
+    load: Callable[[], np.ndarray]
+        Function that decodes the array. It is only called if no process has stored
+        the array yet.
+
+    Returns
+    -------
+    np.ndarray
+        Read-only memory-mapped array. It stays valid after the array is evicted.
+    """
+    with _attached_lock:
+        if key in _attached:
+            _attached.move_to_end(key)
+            return _attached[key]
+
+    path = get_array_path(key)
+    created = False
+    while True:
+        arr = _open_array(path)
+        if arr is None:
+            with single_flight(f"array_{key}"):
+                arr = _open_array(path)
+                if arr is None:
+                    with atomic_write(path) as temp_path:
+                        np.save(temp_path, np.ascontiguousarray(load()))
+                    arr = _open_array(path)
+                    created = True
+
+        # Another process may have evicted the file since it was opened
+        if _acquire(key, arr.nbytes):
+            break
+
+    released = []
+    with _attached_lock:
+        _attached[key] = arr
+        while len(_attached) > ARRAY_CACHE_ATTACHED:
+            released.append(_attached.popitem(last=False)[0])
+    if released:
+        _release(released)
+
+    released.extend(_release_over_budget(key, ARRAY_CACHE_MAX_BYTES))
+    if created or released:
+        evict_arrays()
+    return arr
+
+
+def release_arrays() -> None:
+    """Drops every reference held by this process."""
+    with _attached_lock:
+        keys = list(_attached)
+        _attached.clear()
+    if keys:
+        _release(keys)
+
+
+atexit.register(release_arrays)
+
+
+def evict_arrays(max_size: int = ARRAY_CACHE_MAX_BYTES) -> list[str]:
+    """Deletes the least recently used arrays that no live process has attached, until
+    the shared arrays fit in their size budget.
+
+    References of processes that died without releasing them are dropped first.
+    Processes that still map an evicted array keep reading it, since the file is
+    only unlinked.
+
+    Parameters
+    ----------
+    max_size: int
+        Size budget, in bytes.
+
+    Returns
+    -------
+    list[str]
+        Keys of the evicted arrays.
+    """
+    evicted = []
+
+    with closing(connect_index()) as conn, conn:
+        conn.execute("BEGIN IMMEDIATE")
+        _drop_dead_refs(conn)
+
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM arrays").fetchone()[0]
+        if total <= max_size:
+            return evicted
+
+        rows = conn.execute(
+            """
+            SELECT key, size FROM arrays
+            WHERE key NOT IN (SELECT key FROM refs)
+            ORDER BY last_access
+            """
+        ).fetchall()
+
+        for row in rows:
+            if total <= max_size:
+                break
+            conn.execute("DELETE FROM arrays WHERE key = ?", (row["key"],))
+            get_array_path(row["key"]).unlink(missing_ok=True)
+            total -= row["size"]
+            evicted.append(row["key"])
+
+    return evicted
+
+
+def read_shared_raster(
+    path: os.PathLike, *, overview_level: int | None = None
+) -> RasterResponseModel:
+    """Shared counterpart of `read_raster`, keyed by the cache key of the raster, which
+    is the stem of its path.
+
+    The data is a read-only memory map and must not be modified.
+    """
+    path = Path(path)
+    key = path.stem if overview_level is None else f"{path.stem}_ov{overview_level}"
+
+    with rio.open(path, overview_level=overview_level) as ds:
+        crs, transform = str(ds.crs), list(ds.transform)
+
+    data = get_shared_array(
+        key, lambda: read_raster(path, overview_level=overview_level).data
+    )
+    return RasterResponseModel(data=data, crs=crs, transform=transform)
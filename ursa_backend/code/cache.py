@@ -0,0 +1,730 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import shutil
+import sqlite3
+import time
+
+from contextlib import ExitStack, closing
+from pathlib import Path
+from typing import Any, Callable, Sequence, TypedDict
+from ursa_backend.code.constants import (
+    CACHE_BOUNDS_PRECISION,
+    CACHE_EVICTION_GRACE,
+    CACHE_MAX_BYTES,
+    DATA_PATH,
+    DEFAULT_CRS,
+    DEFAULT_SCALE,
+    PIPELINE_VERSION,
+)
+from ursa_backend.code.locks import single_flight
+
+
+# Bump whenever the way keys are derived from a spec changes
+KEY_SCHEME_VERSION = 1
+
+MANIFEST_NAME = "manifest.sqlite"
+
+
+class CacheSpec(TypedDict):
+    dataset: str
+    bounds: tuple[float, float, float, float] | None
+    scale: float | None
+    crs: str | None
+    version: int
+    params: dict[str, Any]
+
+
+class CacheEntry(TypedDict):
+    key: str
+    dataset: str
+    path: str
+    spec: CacheSpec
+    size: int
+    checksum: str
+    created_at: float
+    last_access: float
+
+
+class CacheStats(TypedDict):
+    entries: int
+    size: int
+    max_size: int
+    hits: int
+    misses: int
+    evictions: int
+    hit_rate: float | None
+
+
+def canonicalize_bounds(
+    xmin: float,
+    ymin: float,
+    xmax: float,
+    ymax: float,
+    precision: int = CACHE_BOUNDS_PRECISION,
+) -> tuple[float, float, float, float]:
+    """Rounds a bounding box so that equivalent boxes produce the same key.
+
+    Parameters
+    ----------
+    xmin: float
+        Minimum x coordinate.
+
+    ymin: float
+        Minimum y coordinate.
+
+    xmax: float
+        Maximum x coordinate.
+
+    ymax: float
+        Maximum y coordinate.
+
+    precision: int
+        Number of decimal places to keep.
+
+    Returns
+    -------
+    tuple[float, float, float, float]
+        Rounded bounding box.
+    """
+    # Adding 0.0 turns -0.0 into 0.0
+    return tuple(round(float(v), precision) + 0.0 for v in (xmin, ymin, xmax, ymax))
+
+
+def make_spec(
+    dataset: str,
+    bounds: tuple[float, float, float, float],
+    *,
+    scale: float = DEFAULT_SCALE,
+    crs: str = DEFAULT_CRS,
+    version: int = PIPELINE_VERSION,
+    **params: Any,
+) -> CacheSpec:
+    """Builds the specification of a cached raster.
+
+    Parameters
+    ----------
+    dataset: str
+        Name of the source dataset.
+
+    bounds: tuple[float, float, float, float]
+        Bounding box of the raster. It is canonicalized with `canonicalize_bounds`.
+
+    scale: float
+        Pixel size, in meters, of the downloaded raster.
+
+    crs: str
+        CRS of the downloaded raster.
+
+    version: int
+        Version of the processing pipeline that generated the raster.
+
+    **params: Any
+        Any other JSON serializable parameter that identifies the raster, such as the
+        year and month of a monthly composite.
+
+    Returns
+    -------
+    CacheSpec
+        Specification of the raster.
+    """
+    return CacheSpec(
+        dataset=dataset,
+        bounds=canonicalize_bounds(*bounds),
+        scale=scale,
+        crs=crs,
+        version=version,
+        params=params,
+    )
+
+
+def make_derived_spec(
+    product: str,
+    input_paths: Sequence[os.PathLike],
+    *,
+    version: int = PIPELINE_VERSION,
+    **params: Any,
+) -> CacheSpec:
+    """Builds the specification of an artifact computed from cached rasters.
+
+    The inputs are identified by their cache keys, which are the stems of their paths,
+    so the artifact changes whenever any of its inputs does.
+
+    Parameters
+    ----------
+    product: str
+        Name of the derived product.
+
+    input_paths: Sequence[os.PathLike]
+        Paths of the cached rasters the artifact is computed from, in a meaningful order.
+
+    version: int
+        Version of the processing pipeline that computes the artifact.
+
+    **params: Any
+        Any other JSON serializable parameter of the computation.
+
+    Returns
+    -------
+    CacheSpec
+        Specification of the artifact.
+    """
+    return CacheSpec(
+        dataset=f"ursa/{product}",
+        bounds=None,
+        scale=None,
+        crs=None,
+        version=version,
+        params=dict(params, inputs=[Path(p).stem for p in input_paths]),
+    )
+
+
+def get_cache_key(spec: CacheSpec) -> str:
+    """Derives a deterministic, content-addressed key from a raster specification.
+
+    Parameters
+    ----------
+    spec: CacheSpec
+        Specification of the raster.
+
+    Returns
+    -------
+    str
+        Hex digest identifying the raster. It is stable across processes and restarts.
+    """
+    payload = json.dumps(
+        dict(spec, key_scheme=KEY_SCHEME_VERSION),
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()[:32]
+
+
+def dataset_slug(dataset: str) -> str:
+    return re.sub(r"[^a-z0-9]+", "_", dataset.lower()).strip("_")
+
+
+def get_cache_path(spec: CacheSpec, suffix: str = ".tif") -> Path:
+    """Returns the location of a cached raster.
+
+    Parameters
+    ----------
+    spec: CacheSpec
+        Specification of the raster.
+
+    suffix: str
+        File extension.
+
+    Returns
+    -------
+    Path
+        Path of the form `{DATA_PATH}/{dataset}/{key[:2]}/{key}{suffix}`.
+    """
+    key = get_cache_key(spec)
+    return DATA_PATH / dataset_slug(spec["dataset"]) / key[:2] / f"{key}{suffix}"
+
+
+def file_checksum(path: os.PathLike) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def connect_manifest() -> sqlite3.Connection:
+    """Opens the manifest of cache entries, creating it if needed."""
+    DATA_PATH.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(DATA_PATH / MANIFEST_NAME, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY,
+            dataset TEXT NOT NULL,
+            path TEXT NOT NULL,
+            spec TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            checksum TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            last_access REAL NOT NULL DEFAULT 0
+        )
+        """
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+    )
+
+    columns = {row["name"] for row in conn.execute("PRAGMA table_info(entries)")}
+    if "last_access" not in columns:
+        conn.execute(
+            "ALTER TABLE entries ADD COLUMN last_access REAL NOT NULL DEFAULT 0"
+        )
+        conn.execute("UPDATE entries SET last_access = created_at")
+    return conn
+
+
+def _increment_stat(conn: sqlite3.Connection, name: str, amount: int = 1) -> None:
+    conn.execute(
+        """
+        INSERT INTO stats VALUES (?, ?)
+        ON CONFLICT(name) DO UPDATE SET value = value + excluded.value
+        """,
+        (name, amount),
+    )
+
+
+def _row_to_entry(row: sqlite3.Row) -> CacheEntry:
+    return CacheEntry(
+        key=row["key"],
+        dataset=row["dataset"],
+        path=row["path"],
+        spec=json.loads(row["spec"]),
+        size=row["size"],
+        checksum=row["checksum"],
+        created_at=row["created_at"],
+        last_access=row["last_access"],
+    )
+
+
+def register_entry(
+    spec: CacheSpec, path: os.PathLike, *, checksum: bool = True
+) -> CacheEntry:
+    """Adds a cached file to the manifest, replacing any previous entry with the same key.
+
+    Parameters
+    ----------
+    spec: CacheSpec
+        Specification of the cached raster.
+
+    path: os.PathLike
+        Location of the cached file.
+
+    checksum: bool
+        Whether to store the checksum of the file. Data cubes skip it, so adding a
+        band doesn't hash the whole cube again.
+
+    Returns
+    -------
+    CacheEntry
+        The new manifest entry.
+    """
+    path = Path(path)
+    now = time.time()
+    entry = CacheEntry(
+        key=get_cache_key(spec),
+        dataset=spec["dataset"],
+        path=str(path),
+        spec=spec,
+        size=path.stat().st_size,
+        checksum=file_checksum(path) if checksum else "",
+        created_at=now,
+        last_access=now,
+    )
+
+    with closing(connect_manifest()) as conn, conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                entry["key"],
+                entry["dataset"],
+                entry["path"],
+                json.dumps(entry["spec"]),
+                entry["size"],
+                entry["checksum"],
+                entry["created_at"],
+                entry["last_access"],
+            ),
+        )
+
+    evict()
+    return entry
+
+
+def lookup(spec: CacheSpec, suffix: str = ".tif") -> Path | None:
+    """Looks up a raster in the cache, updating its last access time and the hit counters.
+
+    Parameters
+    ----------
+    spec: CacheSpec
+        Specification of the raster.
+
+    suffix: str
+        File extension.
+
+    Returns
+    -------
+    Path | None
+        Location of the cached raster, or None if it isn't cached.
+    """
+    key = get_cache_key(spec)
+    path = get_cache_path(spec, suffix=suffix)
+
+    with closing(connect_manifest()) as conn, conn:
+        row = conn.execute("SELECT key FROM entries WHERE key = ?", (key,)).fetchone()
+
+        if path.exists() and row is not None:
+            conn.execute(
+                "UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key)
+            )
+            _increment_stat(conn, "hits")
+            return path
+
+        if row is not None:
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+        if not path.exists():
+            _increment_stat(conn, "misses")
+            return None
+
+        _increment_stat(conn, "hits")
+
+    # The file was written without going through the manifest
+    register_entry(spec, path)
+    return path
+
+
+def get_entry(key: str) -> CacheEntry | None:
+    with closing(connect_manifest()) as conn:
+        row = conn.execute("SELECT * FROM entries WHERE key = ?", (key,)).fetchone()
+    return None if row is None else _row_to_entry(row)
+
+
+def list_entries(dataset: str | None = None) -> list[CacheEntry]:
+    """Lists the entries in the manifest.
+
+    Parameters
+    ----------
+    dataset: str | None
+        If given, only entries of this dataset are returned.
+
+    Returns
+    -------
+    list[CacheEntry]
+        Manifest entries, oldest first.
+    """
+    with closing(connect_manifest()) as conn:
+        if dataset is None:
+            rows = conn.execute("SELECT * FROM entries ORDER BY created_at").fetchall()
+        else:
+            rows = conn.execute(
+                "SELECT * FROM entries WHERE dataset = ? ORDER BY created_at",
+                (dataset,),
+            ).fetchall()
+    return [_row_to_entry(row) for row in rows]
+
+
+def remove_entry(key: str, *, delete_file: bool = True) -> CacheEntry | None:
+    """Removes an entry from the manifest.
+
+    Parameters
+    ----------
+    key: str
+        Key of the entry.
+
+    delete_file: bool
+        Whether to also delete the cached file.
+
+    Returns
+    -------
+    CacheEntry | None
+        The removed entry, or None if there was no entry with the given key.
+    """
+    entry = get_entry(key)
+    if entry is None:
+        return None
+
+    with closing(connect_manifest()) as conn, conn:
+        conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    if delete_file:
+        Path(entry["path"]).unlink(missing_ok=True)
+
+    return entry
+
+
+def get_or_create(
+    spec: CacheSpec, create: Callable[[Path], None], suffix: str = ".tif"
+) -> Path:
+    """Returns the location of a cached raster, creating it if it isn't cached.
+
+    Concurrent calls for the same spec, from this or other processes, are coalesced:
+    only one of them runs `create` and the rest wait for it and reuse its result.
+
+    Parameters
+    ----------
+    spec: CacheSpec
+        Specification of the raster.
+
+    create: Callable[[Path], None]
+        Function that writes the raster to the given path. It must publish the file
+        atomically, so that the path never holds a partially written file.
+
+    suffix: str
+        File extension.
+
+    Returns
+    -------
+    Path
+        Location of the cached raster.
+    """
+    path = lookup(spec, suffix=suffix)
+    if path is not None:
+        return path
+
+    path = get_cache_path(spec, suffix=suffix)
+    with single_flight(get_cache_key(spec)):
+        # Another request may have created the file while we waited for the lock
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            create(path)
+            register_entry(spec, path)
+
+    return path
+
+
+def get_or_create_many(
+    specs: list[CacheSpec],
+    create: Callable[[list[tuple[CacheSpec, Path]]], None],
+    suffix: str = ".tif",
+) -> list[Path]:
+    """Returns the locations of several cached rasters, creating the missing ones at once.
+
+    This is the batched version of `get_or_create`, for sources that can produce many
+    rasters with a single download. The locks of all missing rasters are acquired in
+    a fixed order before calling `create`.
+
+    Parameters
+    ----------
+    specs: list[CacheSpec]
+        Specifications of the rasters.
+
+    create: Callable[[list[tuple[CacheSpec, Path]]], None]
+        Function that receives the specs and output paths of the missing rasters and
+        writes all of them. Each file must be published atomically.
+
+    suffix: str
+        File extension.
+
+    Returns
+    -------
+    list[Path]
+        Locations of the cached rasters, in the same order as `specs`.
+    """
+    missing = [spec for spec in specs if lookup(spec, suffix=suffix) is None]
+
+    if missing:
+        keys = sorted({get_cache_key(spec) for spec in missing})
+        with ExitStack() as stack:
+            for key in keys:
+                stack.enter_context(single_flight(key))
+
+            pending = []
+            for spec in missing:
+                path = get_cache_path(spec, suffix=suffix)
+                if not path.exists():
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    pending.append((spec, path))
+
+            if pending:
+                create(pending)
+                for spec, path in pending:
+                    register_entry(spec, path)
+
+    return [get_cache_path(spec, suffix=suffix) for spec in specs]
+
+
+def evict(
+    max_size: int = CACHE_MAX_BYTES, *, grace: float = CACHE_EVICTION_GRACE
+) -> list[CacheEntry]:
+    """Deletes the least recently used entries until the cache fits in its size budget.
+
+    Parameters
+    ----------
+    max_size: int
+        Size budget, in bytes.
+
+    grace: float
+        Entries accessed less than this many seconds ago are kept even if the cache
+        exceeds its budget.
+
+    Returns
+    -------
+    list[CacheEntry]
+        The evicted entries.
+    """
+    evicted = []
+
+    with closing(connect_manifest()) as conn, conn:
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= max_size:
+            return evicted
+
+        rows = conn.execute(
+            "SELECT * FROM entries WHERE last_access < ? ORDER BY last_access",
+            (time.time() - grace,),
+        ).fetchall()
+
+        for row in rows:
+            if total <= max_size:
+                break
+            entry = _row_to_entry(row)
+            conn.execute("DELETE FROM entries WHERE key = ?", (entry["key"],))
+            Path(entry["path"]).unlink(missing_ok=True)
+            total -= entry["size"]
+            evicted.append(entry)
+
+        _increment_stat(conn, "evictions", len(evicted))
+
+    return evicted
+
+
+def purge(dataset: str | None = None) -> list[CacheEntry]:
+    """Deletes every entry in the cache, or every entry of a dataset.
+
+    Parameters
+    ----------
+    dataset: str | None
+        If given, only entries of this dataset are deleted.
+
+    Returns
+    -------
+    list[CacheEntry]
+        The deleted entries.
+    """
+    entries = list_entries(dataset)
+    for entry in entries:
+        remove_entry(entry["key"])
+    return entries
+
+
+def get_stats() -> CacheStats:
+    """Returns the size of the cache and its hit, miss and eviction counters."""
+    with closing(connect_manifest()) as conn:
+        n_entries, size = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()
+        counters = {
+            row["name"]: row["value"]
+            for row in conn.execute("SELECT name, value FROM stats")
+        }
+
+    hits = counters.get("hits", 0)
+    misses = counters.get("misses", 0)
+    return CacheStats(
+        entries=n_entries,
+        size=size,
+        max_size=CACHE_MAX_BYTES,
+        hits=hits,
+        misses=misses,
+        evictions=counters.get("evictions", 0),
+        hit_rate=hits / (hits + misses) if hits + misses > 0 else None,
+    )
+
+
+def verify_entries(*, checksum: bool = False) -> dict[str, list[str]]:
+    """Checks the manifest against the files on disk.
+
+    Parameters
+    ----------
+    checksum: bool
+        Whether to recompute the checksum of every file that has one. Otherwise only
+        sizes are compared.
+
+    Returns
+    -------
+    dict[str, list[str]]
+        A dictionary with the following keys:
+            - missing: Keys of entries whose file doesn't exist.
+            - corrupted: Keys of entries whose file doesn't match the recorded size or checksum.
+            - stale: Keys of entries generated by an older pipeline version.
+            - untracked: Files under the data directory that aren't in the manifest.
+    """
+    report = dict(missing=[], corrupted=[], stale=[], untracked=[])
+
+    tracked = set()
+    for entry in list_entries():
+        path = Path(entry["path"])
+        tracked.add(path.resolve())
+
+        if entry["spec"]["version"] != PIPELINE_VERSION:
+            report["stale"].append(entry["key"])
+
+        if not path.exists():
+            report["missing"].append(entry["key"])
+        elif path.stat().st_size != entry["size"] or (
+            checksum and entry["checksum"] and file_checksum(path) != entry["checksum"]
+        ):
+            report["corrupted"].append(entry["key"])
+
+    for path in DATA_PATH.rglob("*.tif"):
+        if path.resolve() not in tracked:
+            report["untracked"].append(str(path))
+
+    return report
+
+
+def migrate_entries() -> dict[str, int]:
+    """Brings the cache up to date with the current key scheme and pipeline version.
+
+    Entries from an older pipeline version are deleted. The rest are rekeyed and moved
+    to the location given by `get_cache_path`, so cached files survive changes to the
+    key scheme or the directory layout.
+
+    Returns
+    -------
+    dict[str, int]
+        Number of entries that were moved and deleted.
+    """
+    counts = dict(moved=0, deleted=0)
+
+    for entry in list_entries():
+        spec = entry["spec"]
+        if spec["version"] != PIPELINE_VERSION:
+            remove_entry(entry["key"])
+            counts["deleted"] += 1
+            continue
+
+        old_path = Path(entry["path"])
+        new_path = get_cache_path(spec, suffix=old_path.suffix)
+        if old_path == new_path and get_cache_key(spec) == entry["key"]:
+            continue
+
+        if not old_path.exists():
+            remove_entry(entry["key"], delete_file=False)
+            counts["deleted"] += 1
+            continue
+
+        new_path.parent.mkdir(parents=True, exist_ok=True)
+        shutil.move(old_path, new_path)
+        remove_entry(entry["key"], delete_file=False)
+        register_entry(spec, new_path, checksum=bool(entry["checksum"]))
+        counts["moved"] += 1
+
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect the raster cache.")
+    parser.add_argument(
+        "command", choices=["list", "stats", "verify", "migrate", "evict"]
+    )
+    parser.add_argument("--dataset", default=None)
+    parser.add_argument("--checksum", action="store_true")
+    args = parser.parse_args()
+
+    if args.command == "list":
+        result = list_entries(args.dataset)
+    elif args.command == "stats":
+        result = get_stats()
+    elif args.command == "evict":
+        result = evict(grace=0)
+    elif args.command == "verify":
+        result = verify_entries(checksum=args.checksum)
+    else:
+        result = migrate_entries()
+
+    print(json.dumps(result, indent=2))
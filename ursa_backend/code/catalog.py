@@ -0,0 +1,214 @@
+import datetime
+import json
+import time
+
+import ee
+import shapely
+
+from pathlib import Path
+from typing import Sequence, TypedDict
+from ursa_backend.code.cache import get_cache_key, make_spec
+from ursa_backend.code.common import bounds_to_ee
+from ursa_backend.code.constants import (
+    DATA_PATH,
+    LST_DATASET,
+    SCENE_CATALOG_TTL,
+)
+from ursa_backend.code.fs import atomic_write
+from ursa_backend.code.locks import single_flight
+from ursa_backend.code.scheduler import Priority, get_scheduler
+
+
+CATALOG_DATASET = "ursa/scene_catalog"
+
+
+class SceneRecord(TypedDict):
+    id: str
+    time: int
+    footprint: dict
+
+
+class SceneCatalog(TypedDict):
+    dataset: str
+    bounds: tuple[float, float, float, float]
+    year: int
+    fetched_at: float
+    scenes: list[SceneRecord]
+
+
+class MonthCoverage(TypedDict):
+    month: int
+    scenes: int
+    coverage: float
+
+
+def get_catalog_key(bounds: tuple[float, float, float, float], year: int) -> str:
+    spec = make_spec(CATALOG_DATASET, bounds, source=LST_DATASET, year=year)
+    return get_cache_key(spec)
+
+
+def get_catalog_path(key: str) -> Path:
+    return DATA_PATH / "catalog" / f"{key}.json"
+
+
+def query_scenes(
+    bounds: tuple[float, float, float, float], year: int
+) -> list[SceneRecord]:
+    """Lists the scenes of a year that intersect a bounding box.
+
+    The IDs, acquisition times and footprints of every scene are aggregated into a
+    single dictionary on the Earth Engine side, so the whole year costs one round
+    trip.
+
+    Parameters
+    ----------
+    bounds: tuple[float, float, float, float]
+        Bounding box, in EPSG:4326.
+
+    year: int
+        Year to list.
+
+    Returns
+    -------
+    list[SceneRecord]
+        Scenes sorted by acquisition time, in milliseconds since the epoch. Footprints
+        are GeoJSON geometries.
+    """
+    collection = (
+        ee.ImageCollection(LST_DATASET)
+        .filterDate(f"{year}-01-01", f"{year + 1}-01-01")
+        .filterBounds(bounds_to_ee(*bounds))
+    )
+    columns = ee.Dictionary(
+        dict(
+            id=collection.aggregate_array("system:index"),
+            time=collection.aggregate_array("system:time_start"),
+            footprint=collection.aggregate_array("system:footprint"),
+        )
+    ).getInfo()
+
+    scenes = [
+        SceneRecord(id=scene_id, time=int(t), footprint=footprint)
+        for scene_id, t, footprint in zip(
+            columns["id"], columns["time"], columns["footprint"]
+        )
+    ]
+    return sorted(scenes, key=lambda scene: scene["time"])
+
+
+def read_catalog(key: str) -> SceneCatalog | None:
+    try:
+        with open(get_catalog_path(key)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def _write_catalog(key: str, catalog: SceneCatalog) -> None:
+    with atomic_write(get_catalog_path(key)) as temp_path:
+        with open(temp_path, "w") as f:
+            json.dump(catalog, f)
+
+
+def _is_fresh(catalog: SceneCatalog | None, ttl: float) -> bool:
+    return catalog is not None and time.time() - catalog["fetched_at"] < ttl
+
+
+def get_scene_catalog(
+    bounds: tuple[float, float, float, float],
+    year: int,
+    *,
+    ttl: float = SCENE_CATALOG_TTL,
+    priority: Priority = Priority.INTERACTIVE,
+) -> SceneCatalog:
+    """Returns the scene catalog of a bounding box and year, querying Earth Engine only
+    when there is no local copy younger than `ttl`.
+
+    Parameters
+    ----------
+    bounds: tuple[float, float, float, float]
+        Bounding box, in EPSG:4326.
+
+    year: int
+        Year of the catalog.
+
+    ttl: float
+        Maximum age, in seconds, of a stored catalog.
+
+    priority: Priority
+        Priority of the query in the shared download scheduler.
+
+    Returns
+    -------
+    SceneCatalog
+        Catalog with every scene of the year that intersects the bounding box.
+    """
+    key = get_catalog_key(bounds, year)
+    catalog = read_catalog(key)
+    if _is_fresh(catalog, ttl):
+        return catalog
+
+    with single_flight(key):
+        catalog = read_catalog(key)
+        if _is_fresh(catalog, ttl):
+            return catalog
+
+        catalog = SceneCatalog(
+            dataset=LST_DATASET,
+            bounds=bounds,
+            year=year,
+            fetched_at=time.time(),
+            scenes=get_scheduler().run(query_scenes, bounds, year, priority=priority),
+        )
+        _write_catalog(key, catalog)
+        return catalog
+
+
+def get_scene_month(scene: SceneRecord) -> int:
+    return datetime.datetime.fromtimestamp(
+        scene["time"] / 1000, tz=datetime.timezone.utc
+    ).month
+
+
+def footprint_to_polygon(footprint: dict) -> shapely.Geometry:
+    """Earth Engine stores scene footprints as linear rings, which have no area."""
+    geom = shapely.geometry.shape(footprint)
+    if isinstance(geom, shapely.LinearRing):
+        return shapely.Polygon(geom)
+    return geom
+
+
+def get_month_coverage(
+    catalog: SceneCatalog, months: Sequence[int]
+) -> list[MonthCoverage]:
+    """Summarizes the scenes of a catalog by month.
+
+    Parameters
+    ----------
+    catalog: SceneCatalog
+        Scene catalog.
+
+    months: Sequence[int]
+        Months to summarize, starting from 1 (January).
+
+    Returns
+    -------
+    list[MonthCoverage]
+        Number of scenes of each month, and the fraction of the bounding box of the
+        catalog covered by the union of their footprints.
+    """
+    bbox = shapely.box(*catalog["bounds"])
+    footprints = {month: [] for month in months}
+    for scene in catalog["scenes"]:
+        month = get_scene_month(scene)
+        if month in footprints:
+            footprints[month].append(footprint_to_polygon(scene["footprint"]))
+
+    out = []
+    for month, shapes in footprints.items():
+        coverage = 0.0
+        if shapes and bbox.area > 0:
+            union = shapely.union_all(shapes)
+            coverage = min(union.intersection(bbox).area / bbox.area, 1.0)
+        out.append(MonthCoverage(month=month, scenes=len(shapes), coverage=coverage))
+    return out
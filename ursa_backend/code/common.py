@@ -1,15 +1,20 @@
 import ee
+import functools
 import geemap
 import os
 import shapely
+import uuid
 
 import matplotlib as mpl
-import matplotlib.colors as mcol
 import numpy as np
 import rasterio as rio
 
+from affine import Affine
+from pathlib import Path
 from shapely import Geometry
 from typing import Callable, Literal, Sequence, assert_never
+from ursa_backend.code.constants import DEFAULT_CRS, DEFAULT_SCALE
+from ursa_backend.code.scheduler import Priority, get_scheduler
 
 
 def bbox_to_ee(bbox: shapely.Polygon) -> ee.Geometry.Polygon:
@@ -54,106 +59,396 @@ def bounds_to_ee(xmin: float, ymin: float, xmax: float, ymax: float) -> ee.Geome
     return bbox_to_ee(shapely.box(xmin, ymin, xmax, ymax))
 
 
-def get_hash(xmin: float, ymin: float, xmax: float, ymax: float) -> str:
-    """Hashes a bounding box given by its extent.
+def _get_grid_kwargs(
+    bbox: ee.Geometry,
+    scale: float,
+    crs_transform: Affine | None,
+    shape: tuple[int, int] | None,
+) -> dict:
+    if crs_transform is None:
+        return dict(region=bbox, scale=scale)
+    return dict(crs_transform=tuple(crs_transform)[:6], shape=shape)
+
+
+def load_or_download_image(
+    img: ee.Image,
+    raster_path: os.PathLike,
+    bbox: ee.Geometry,
+    nodata: float | None = None,
+    scale: float = DEFAULT_SCALE,
+    crs: str = DEFAULT_CRS,
+    priority: Priority = Priority.INTERACTIVE,
+    *,
+    crs_transform: Affine | None = None,
+    shape: tuple[int, int] | None = None,
+) -> None:
+    """Downloads an EarthEngine image to a GeoTIFF file, unless the file already exists.
+
+    The image is downloaded and post-processed under temporary names in the same
+    directory, and moved to `raster_path` with an atomic rename once complete, so
+    readers never see a partially written file.
 
     Parameters
     ----------
-    xmin: float
-        Minimum x coordinate.
+    img: ee.Image
+        Image to download.
 
-    ymin: float
-        Minimum y coordinate.
+    raster_path: os.PathLike
+        Output path.
 
-    xmax: float
-        Maximum x coordinate.
+    bbox: ee.Geometry
+        Region to download.
 
-    ymax: float
-        Maximum y coordinate.
+    nodata: float | None
+        If given, masked and NaN pixels are replaced with this value.
 
-    Returns
-    -------
-    str
-        Hash of the bounding box.
-    """
-    return str(hash((xmin, ymin, xmax, ymax)))[:7]
+    scale: float
+        Pixel size, in meters.
 
+    crs: str
+        CRS of the output raster.
 
-def load_or_download_image(
-    img: ee.Image,
-    raster_path: os.PathLike,
-    bbox: ee.Geometry,
-    nodata: float | None = None,
-) -> None:
+    priority: Priority
+        Priority of the download in the shared download scheduler.
+
+    crs_transform: Affine | None
+        If given, the image is downloaded on this pixel grid instead of on a grid
+        fitted to `bbox` at `scale`. Requires `shape`.
+
+    shape: tuple[int, int] | None
+        Height and width of the image, when downloading on a fixed grid.
+    """
+    raster_path = Path(raster_path)
     if raster_path.exists():
         return
 
     raster_path.parent.mkdir(exist_ok=True, parents=True)
 
-    if nodata is None:
-        temp_raster_path = raster_path
-    else:
-        temp_raster_path = raster_path.with_name(f"{raster_path.stem}_temp.tif")
-
-    geemap.download_ee_image(
-        img,
-        temp_raster_path,
-        scale=50,
-        crs="EPSG:4326",
-        region=bbox,
-        unmask_value=nodata,
-    )
-
-    if nodata is None:
-        return
+    temp_id = uuid.uuid4().hex
+    temp_raster_path = raster_path.with_name(f".{raster_path.stem}.{temp_id}.dl.tif")
+    final_temp_path = raster_path.with_name(f".{raster_path.stem}.{temp_id}.tif")
 
-    with rio.open(temp_raster_path) as ds:
-        data = ds.read(1)
-        profile = ds.profile
+    try:
+        get_scheduler().run(
+            geemap.download_ee_image,
+            img,
+            temp_raster_path,
+            crs=crs,
+            unmask_value=nodata,
+            priority=priority,
+            **_get_grid_kwargs(bbox, scale, crs_transform, shape),
+        )
 
-    data[data == profile["nodata"]] = nodata
-    data[np.isnan(data)] = nodata
-    data = data.squeeze()
+        if nodata is None:
+            os.replace(temp_raster_path, raster_path)
+            return
 
-    profile.update(nodata=nodata, compress="lzw")
+        with rio.open(temp_raster_path) as ds:
+            data = ds.read(1)
+            profile = ds.profile
 
-    with rio.open(raster_path, "w", **profile) as ds:
-        ds.write(data, 1)
+        data[data == profile["nodata"]] = nodata
+        data[np.isnan(data)] = nodata
+        data = data.squeeze()
 
-    os.remove(temp_raster_path)
+        profile.update(nodata=nodata, compress="lzw")
 
+        with rio.open(final_temp_path, "w", **profile) as ds:
+            ds.write(data, 1)
 
-def raster_to_rgb(
+        os.replace(final_temp_path, raster_path)
+    finally:
+        temp_raster_path.unlink(missing_ok=True)
+        final_temp_path.unlink(missing_ok=True)
+
+
+def download_image_bands(
+    img: ee.Image,
+    raster_paths: Sequence[os.PathLike],
+    bbox: ee.Geometry,
+    nodata: float,
+    scale: float = DEFAULT_SCALE,
+    crs: str = DEFAULT_CRS,
+    priority: Priority = Priority.INTERACTIVE,
+    *,
+    crs_transform: Affine | None = None,
+    shape: tuple[int, int] | None = None,
+) -> list[bool]:
+    """Downloads a multi-band EarthEngine image once and splits it into one file per band.
+
+    Each output file is published with an atomic rename, as in `load_or_download_image`.
+
+    Parameters
+    ----------
+    img: ee.Image
+        Image to download.
+
+    raster_paths: Sequence[os.PathLike]
+        Output path of each band, in band order.
+
+    bbox: ee.Geometry
+        Region to download.
+
+    nodata: float
+        Masked and NaN pixels are replaced with this value.
+
+    scale: float
+        Pixel size, in meters.
+
+    crs: str
+        CRS of the output rasters.
+
+    priority: Priority
+        Priority of the download in the shared download scheduler.
+
+    crs_transform: Affine | None
+        If given, the image is downloaded on this pixel grid instead of on a grid
+        fitted to `bbox` at `scale`. Requires `shape`.
+
+    shape: tuple[int, int] | None
+        Height and width of the image, when downloading on a fixed grid.
+
+    Returns
+    -------
+    list[bool]
+        Whether each band was fully masked, i.e. had no valid pixels.
+    """
+    raster_paths = [Path(p) for p in raster_paths]
+    parent = raster_paths[0].parent
+    parent.mkdir(exist_ok=True, parents=True)
+
+    temp_id = uuid.uuid4().hex
+    temp_raster_path = parent / f".stack.{temp_id}.dl.tif"
+    band_temp_paths = [p.with_name(f".{p.stem}.{temp_id}.tif") for p in raster_paths]
+
+    try:
+        get_scheduler().run(
+            geemap.download_ee_image,
+            img,
+            temp_raster_path,
+            crs=crs,
+            unmask_value=nodata,
+            priority=priority,
+            **_get_grid_kwargs(bbox, scale, crs_transform, shape),
+        )
+
+        empty = []
+        with rio.open(temp_raster_path) as ds:
+            if ds.count != len(raster_paths):
+                raise ValueError(
+                    f"Downloaded {ds.count} bands, expected {len(raster_paths)}."
+                )
+
+            profile = ds.profile
+            profile.update(count=1, nodata=nodata, compress="lzw")
+
+            for i, temp_path in enumerate(band_temp_paths, start=1):
+                data = ds.read(i)
+                data[data == ds.nodata] = nodata
+                data[np.isnan(data)] = nodata
+                empty.append(bool(np.all(data == nodata)))
+
+                with rio.open(temp_path, "w", **profile) as dst:
+                    dst.write(data, 1)
+
+        for temp_path, raster_path in zip(band_temp_paths, raster_paths):
+            os.replace(temp_path, raster_path)
+    finally:
+        temp_raster_path.unlink(missing_ok=True)
+        for temp_path in band_temp_paths:
+            temp_path.unlink(missing_ok=True)
+
+    return empty
+
+
+def histogram_quantile(hist: np.ndarray, edges: np.ndarray, q: float) -> float:
+    """Estimates a quantile from a histogram, interpolating linearly within a bin.
+
+    Parameters
+    ----------
+    hist: np.ndarray
+        Number of values in each bin.
+
+    edges: np.ndarray
+        Edges of the bins, one more than `hist`.
+
+    q: float
+        Quantile to estimate, between 0 and 1.
+
+    Returns
+    -------
+    float
+        Estimated quantile.
+    """
+    cum = np.cumsum(hist)
+    target = q * cum[-1]
+    k = min(int(np.searchsorted(cum, target)), len(hist) - 1)
+    below = cum[k - 1] if k > 0 else 0
+    frac = (target - below) / hist[k] if hist[k] > 0 else 0.0
+    return float(edges[k] + frac * (edges[k + 1] - edges[k]))
+
+
+def approximate_quantiles(
+    data: np.ndarray, quantiles: Sequence[float], *, bins: int = 4096
+) -> list[float]:
+    """Estimates quantiles of a raster from a histogram of its values.
+
+    This avoids sorting or partitioning a copy of the valid values. The error is at
+    most the width of a bin, `(max - min) / bins`.
+
+    Parameters
+    ----------
+    data: np.ndarray
+        Raster data. NaN values are ignored.
+
+    quantiles: Sequence[float]
+        Quantiles to estimate, between 0 and 1.
+
+    bins: int
+        Number of bins of the histogram.
+
+    Returns
+    -------
+    list[float]
+        Estimated quantiles, in the same order as `quantiles`. NaN if `data` has no
+        valid values.
+    """
+    vmin, vmax = np.nanmin(data), np.nanmax(data)
+    if not np.isfinite(vmin) or vmin == vmax:
+        return [float(vmin)] * len(quantiles)
+
+    hist, edges = np.histogram(data, bins=bins, range=(vmin, vmax))
+    return [histogram_quantile(hist, edges, q) for q in quantiles]
+
+
+def get_color_bounds(data: np.ndarray) -> tuple[float, float]:
+    """Calculates the bounds of the color scale of a raster.
+
+    Parameters
+    ----------
+    data: np.ndarray
+        Raster data. NaN values are ignored.
+
+    Returns
+    -------
+    tuple[float, float]
+        Approximate 3rd and 97th percentiles of the valid values.
+    """
+    vmin, vmax = approximate_quantiles(data, (0.03, 0.97))
+    return vmin, vmax
+
+
+@functools.lru_cache(maxsize=4)
+def get_colormap_lut(name: str) -> np.ndarray:
+    """Lookup table with the uint8 RGBA colors of a Matplotlib colormap.
+
+    Parameters
+    ----------
+    name: str
+        Name of the colormap.
+
+    Returns
+    -------
+    np.ndarray
+        Array of shape (N + 1, 4), where N is the number of colors of the colormap.
+        The last entry is transparent and is used for missing pixels.
+    """
+    cmap = mpl.colormaps[name]
+    colors = np.round(cmap(np.arange(cmap.N)) * 255).astype(np.uint8)
+    return np.vstack([colors, np.zeros((1, 4), dtype=np.uint8)])
+
+
+def _color_indices(
+    data: np.ndarray, breakpoints: Sequence[float], n_colors: int
+) -> np.ndarray:
+    # Linear norm for two breakpoints and two-slope norm for three, computed in place
+    # on a float32 copy. Values out of range are clipped to the ends of the colormap,
+    # like Matplotlib does with the default under and over colors.
+    x = np.array(data, dtype=np.float32)
+
+    if len(breakpoints) == 2:
+        vmin, vmax = breakpoints
+        x -= vmin
+        x *= n_colors / (vmax - vmin)
+    else:
+        vmin, vcenter, vmax = breakpoints
+        lower = x < vcenter
+        x -= vcenter
+        np.multiply(x, n_colors / 2 / (vcenter - vmin), out=x, where=lower)
+        np.multiply(x, n_colors / 2 / (vmax - vcenter), out=x, where=~lower)
+        x += n_colors / 2
+
+    np.clip(x, 0, n_colors - 1, out=x)
+    np.nan_to_num(x, copy=False, nan=n_colors)
+    return x.astype(np.uint16)
+
+
+def raster_to_rgba(
     data: np.ndarray,
     *,
     nodata: float | None = None,
     kind: Literal["continuous", "discrete", "continuous_centered"],
-) -> tuple[list, list[float]]:
-    data = data.astype(float).copy()
+    color_bounds: tuple[float, float] | None = None,
+) -> tuple[np.ndarray, list[float]]:
+    """Colors a raster with a diverging colormap.
 
-    if nodata is not None:
-        data[data == nodata] = np.nan
+    Colors are looked up in a precomputed table of the colormap, so the only
+    intermediate arrays are a float32 copy of the data and the uint16 color indices.
+
+    Parameters
+    ----------
+    data: np.ndarray
+        Raster data.
 
-    data_notna = data[np.bitwise_not(np.isnan(data))]
+    nodata: float | None
+        Value of the pixels to treat as missing. NaN values are always treated as missing.
 
-    cmap = mpl.colormaps["RdBu"].reversed()
+    kind: Literal["continuous", "discrete", "continuous_centered"]
+        Type of color scale.
+
+    color_bounds: tuple[float, float] | None
+        Bounds of the color scale for the continuous kinds. If None, they are
+        calculated from `data` with `get_color_bounds`.
+
+    Returns
+    -------
+    tuple[np.ndarray, list[float]]
+        Array of shape (height, width, 4) with the uint8 RGBA colors, and the bounds
+        of the color scale. Missing pixels are transparent.
+    """
+    data = np.asarray(data)
+    if nodata is not None:
+        data = np.where(data == nodata, np.nan, data)
 
     if kind == "discrete":
         bounds = []
-        norm = mcol.Normalize(vmin=-3, vmax=3)
+        breakpoints = (-3, 3)
     else:
-        vmin = np.quantile(data_notna, 0.03)
-        vmax = np.quantile(data_notna, 0.97)
+        if color_bounds is None:
+            color_bounds = get_color_bounds(data)
+        vmin, vmax = color_bounds
         bounds = [vmin, vmax]
 
         if kind == "continuous":
-            norm = mcol.Normalize(vmin=-vmin, vmax=vmax)
+            breakpoints = (-vmin, vmax)
         elif kind == "continuous_centered":
-            norm = mcol.TwoSlopeNorm(vcenter=0, vmin=vmin, vmax=vmax)
+            if not vmin < 0 < vmax:
+                raise ValueError("vmin, vcenter, and vmax must be in ascending order")
+            breakpoints = (vmin, 0, vmax)
         else:
             assert_never(kind)
 
-    rgb = cmap(norm(data))
-    colors = np.round(rgb * 255).astype(np.uint8).flatten().tolist()
+    lut = get_colormap_lut("RdBu_r")
+    colors = lut[_color_indices(data, breakpoints, len(lut) - 1)]
 
     return colors, bounds
+
+
+def raster_to_rgb(
+    data: np.ndarray,
+    *,
+    nodata: float | None = None,
+    kind: Literal["continuous", "discrete", "continuous_centered"],
+) -> tuple[list, list[float]]:
+    colors, bounds = raster_to_rgba(data, nodata=nodata, kind=kind)
+    return colors.flatten().tolist(), bounds
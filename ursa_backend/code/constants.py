@@ -1,4 +1,99 @@
+import os
+
+from pathlib import Path
+
 LST_NODATA = -99_999
 LST_CAT_NODATA = -127
 
 WANTED_WORLDCOVER_LABELS = (10, 20, 30, 40, 50, 60, 90, 95, 100)
+
+DATA_PATH = Path(os.getenv("URSA_DATA_PATH", "./data"))
+
+# Decoded arrays are shared between worker processes as memory-mapped .npy files in
+# this directory. Pointing it to /dev/shm keeps them in RAM
+ARRAY_CACHE_PATH = Path(os.getenv("URSA_ARRAY_CACHE_PATH", DATA_PATH / "arrays"))
+
+# Size budget of the shared arrays, and number of arrays each worker process keeps
+# attached. Attached arrays are never evicted, but count against the budget: while
+# they exceed it, processes release the ones they used least recently
+ARRAY_CACHE_MAX_BYTES = int(os.getenv("URSA_ARRAY_CACHE_MAX_BYTES", 4 * 1024**3))
+ARRAY_CACHE_ATTACHED = 32
+
+# Size budget of the raster cache. Least recently used entries are evicted beyond it
+CACHE_MAX_BYTES = int(os.getenv("URSA_CACHE_MAX_BYTES", 20 * 1024**3))
+
+# Entries accessed more recently than this (in seconds) are never evicted, so files
+# that are about to be read by an in-flight request don't disappear
+CACHE_EVICTION_GRACE = 120
+
+# Bump whenever a change in the download or processing code invalidates cached rasters
+PIPELINE_VERSION = 2
+
+# Bounding boxes are rounded to this many decimal places (~10 cm) before hashing
+CACHE_BOUNDS_PRECISION = 6
+
+# Distance, in meters, from urban pixels beyond which pixels can be considered rural
+RURAL_BUFFER_SIZE = 500
+
+# Algorithm that dilates the urban mask by RURAL_BUFFER_SIZE to get the rural mask.
+# "edt" measures true distances with a distance transform. "vector" buffers the
+# polygonized mask in the Mollweide projection, which was the only method until the
+# distance transform replaced it. Mollweide stretches distances away from its
+# central meridian, so the two rural masks, and every SUHI output computed from
+# them, differ. Set it to "vector" to reproduce results computed before the change
+RURAL_DILATION = os.getenv("URSA_RURAL_DILATION", "edt")
+
+SEASONS = ("Q1", "Q2", "Q3", "Q4", "Qall")
+
+# Radial profiles are averaged over rings of this width, in meters, and smoothed with
+# a spline of this strength, which is tuned for that ring width
+RADIAL_RING_WIDTH = 250
+RADIAL_PDF_LAM = 0.05
+
+DEFAULT_SCALE = 50
+DEFAULT_CRS = "EPSG:4326"
+
+# Pixel sizes, in meters, that rasters can be downloaded at, from finest to coarsest.
+# Keeping them to a few tiers lets requests at similar resolutions share the cache
+SCALE_TIERS = (30, 50, 100, 250, 500)
+
+# Maps requested in progressive mode are served at this pixel size, in meters, until
+# their full resolution version is ready
+PREVIEW_SCALE = 250
+
+# LST and WorldCover are downloaded in square tiles of this many pixels of a global
+# grid, so overlapping requests share their downloads
+GRID_TILE_SIZE = 512
+
+# Rasters with at least this many pixels are processed in square blocks of
+# WINDOW_BLOCK_SIZE pixels, so memory use doesn't grow with the size of the bbox
+WINDOWED_MIN_PIXELS = int(os.getenv("URSA_WINDOWED_MIN_PIXELS", 16 * 1024**2))
+WINDOW_BLOCK_SIZE = 1024
+
+# Overviews are added to cached rasters, halving the resolution at every level until
+# the smallest side of the raster would have fewer pixels than this
+OVERVIEW_MIN_SIZE = 256
+
+# "stack" downloads all the months of a request as bands of a single image, while
+# "monthly" downloads each month separately
+LST_DOWNLOAD_MODE = os.getenv("URSA_LST_DOWNLOAD_MODE", "stack")
+
+# Earth Engine fetches run on a pool of this many threads per worker process
+DOWNLOAD_WORKERS = int(os.getenv("URSA_DOWNLOAD_WORKERS", 4))
+DOWNLOAD_MAX_RETRIES = 5
+DOWNLOAD_BACKOFF_BASE = 2.0
+DOWNLOAD_BACKOFF_MAX = 120.0
+
+# Background SUHI jobs run on this many threads per worker process
+JOB_WORKERS = int(os.getenv("URSA_JOB_WORKERS", 2))
+
+# Queued or running jobs not updated for this many seconds are assumed to be lost,
+# e.g. because their worker process died, and are resubmitted
+JOB_STALE_AFTER = 3600
+
+# Scene catalogs are queried again from Earth Engine once they are older than this
+# many seconds
+SCENE_CATALOG_TTL = int(os.getenv("URSA_SCENE_CATALOG_TTL", 7 * 24 * 3600))
+
+LST_DATASET = "LANDSAT/LC09/C02/T1_L2"
+WORLDCOVER_DATASET = "ESA/WorldCover/v200"
@@ -0,0 +1,331 @@
+import os
+import shutil
+import tempfile
+
+import rasterio as rio
+
+from affine import Affine
+from pathlib import Path
+from typing import Callable, Iterable, Sequence
+from ursa_backend.code.cache import (
+    CacheSpec,
+    get_cache_key,
+    get_cache_path,
+    lookup,
+    register_entry,
+    remove_entry,
+)
+from ursa_backend.code.constants import WINDOW_BLOCK_SIZE
+from ursa_backend.code.fs import (
+    atomic_write,
+    build_overviews,
+    get_float32_profile,
+    get_overview_factors,
+    iter_windows,
+    to_float32,
+    update_overviews,
+    write_band_vrt,
+)
+from ursa_backend.code.locks import single_flight
+
+
+def get_band_dir(cube_path: os.PathLike) -> Path:
+    """Directory with the single-band VRTs that expose each band of a cube."""
+    return Path(cube_path).with_suffix("")
+
+
+def get_band_path(cube_path: os.PathLike, key: str) -> Path:
+    """Location of the VRT of a band. Its stem is the cache key of the band."""
+    return get_band_dir(cube_path) / f"{key}.vrt"
+
+
+def get_band_slots(cube_path: os.PathLike) -> dict[tuple[int, int], int]:
+    """Band allocated to every year and month of a cube, whether it has been written or
+    not. Empty if there is no cube."""
+    try:
+        with rio.open(cube_path) as ds:
+            slots = {}
+            for band in ds.indexes:
+                tags = ds.tags(band)
+                slots[int(tags["year"]), int(tags["month"])] = band
+            return slots
+    except rio.errors.RasterioIOError:
+        return {}
+
+
+def get_written_bands(cube_path: os.PathLike) -> dict[str, int]:
+    """Band of every cache key written to a cube, in band order. Empty if there is no
+    cube."""
+    try:
+        with rio.open(cube_path) as ds:
+            keys = {band: ds.tags(band).get("key") for band in ds.indexes}
+            return {key: band for band, key in keys.items() if key is not None}
+    except rio.errors.RasterioIOError:
+        return {}
+
+
+def get_band_keys(cube_path: os.PathLike) -> list[str]:
+    """Cache keys of the bands written to a cube, in band order. Empty if there is no
+    cube."""
+    return list(get_written_bands(cube_path))
+
+
+def write_band_vrts(cube_path: os.PathLike) -> None:
+    """Writes the VRT of every written band of a cube, replacing stale ones."""
+    for key, band in get_written_bands(cube_path).items():
+        write_band_vrt(get_band_path(cube_path, key), cube_path, band)
+
+
+def get_missing_slots(
+    cube_path: os.PathLike, years: Iterable[int]
+) -> list[tuple[int, int]]:
+    """Years and months of several years that have no band allocated in a cube."""
+    slots = get_band_slots(cube_path)
+    return [
+        (year, month)
+        for year in sorted(set(years))
+        for month in range(1, 13)
+        if (year, month) not in slots
+    ]
+
+
+def copy_cube(
+    cube_path: os.PathLike,
+    out_path: os.PathLike,
+    years: Iterable[int],
+    *,
+    height: int,
+    width: int,
+    crs: str,
+    transform: Affine,
+    block_size: int = WINDOW_BLOCK_SIZE,
+) -> None:
+    """Copies a cube to a new file, allocating a band for every month of several years.
+    If there is no cube, an empty one is created.
+
+    If every month is already allocated, the file is copied byte for byte. GeoTIFFs
+    can't gain bands in place, so otherwise the cube is rewritten. The new bands are
+    sparse, so they take no space until `write_bands` fills them, and the written
+    bands and their overviews are copied as they are, so nothing is resampled.
+
+    Parameters
+    ----------
+    cube_path: os.PathLike
+        Location of the cube. It isn't modified.
+
+    out_path: os.PathLike
+        Location of the copy.
+
+    years: Iterable[int]
+        Years to allocate. Months that are already allocated are skipped, so cubes
+        written before bands were allocated by year are completed.
+
+    height, width: int
+        Shape of the cube.
+
+    crs: str
+        CRS of the cube.
+
+    transform: affine.Affine
+        Geographic transform of the cube.
+
+    block_size: int
+        Height and width of the blocks copied at a time.
+    """
+    slots = get_band_slots(cube_path)
+    new_slots = get_missing_slots(cube_path, years)
+    if slots and not new_slots:
+        shutil.copyfile(cube_path, out_path)
+        return
+
+    written = list(get_written_bands(cube_path).values())
+    profile = get_float32_profile(
+        height, width, crs=crs, transform=transform, count=len(slots) + len(new_slots)
+    )
+
+    with rio.open(out_path, "w", sparse_ok=True, **profile) as out:
+        # Building the overviews of an empty cube is cheap. Those of the written bands
+        # are copied below
+        build_overviews(out)
+
+        if slots:
+            with rio.open(cube_path) as old:
+                if old.shape != out.shape or old.transform != out.transform:
+                    raise ValueError(f"{cube_path} is not aligned with the cube.")
+
+                for band in old.indexes:
+                    out.update_tags(band, **old.tags(band))
+                    out.set_band_description(band, old.descriptions[band - 1])
+                for band in written:
+                    for window in iter_windows(height, width, block_size):
+                        out.write(old.read(band, window=window), band, window=window)
+
+        for band, (year, month) in enumerate(new_slots, start=len(slots) + 1):
+            out.update_tags(band, year=year, month=month)
+            out.set_band_description(band, f"{year}-{month:02d}")
+
+    if written:
+        for level in range(len(get_overview_factors(height, width))):
+            with (
+                rio.open(cube_path, overview_level=level) as old,
+                rio.open(out_path, "r+", overview_level=level) as out,
+            ):
+                for band in written:
+                    out.write(old.read(band), band)
+
+
+def write_bands(
+    cube_path: os.PathLike, bands: Sequence[tuple[CacheSpec, os.PathLike]]
+) -> None:
+    """Writes bands in place into the bands allocated to their months in a cube, and
+    computes their overviews.
+
+    Only the new bands are written and resampled. The cube is modified in place, so
+    it must be a copy that nobody reads yet, as made by `copy_cube`.
+
+    Parameters
+    ----------
+    cube_path: os.PathLike
+        Location of the cube. The years of the bands must be allocated.
+
+    bands: Sequence[tuple[CacheSpec, os.PathLike]]
+        Specification of each new band and path of a single-band raster with its
+        data. The rasters must be aligned with the cube.
+    """
+    slots = get_band_slots(cube_path)
+    indexes = [
+        slots[spec["params"]["year"], spec["params"]["month"]] for spec, _ in bands
+    ]
+
+    with rio.open(cube_path, "r+") as out:
+        for band, (spec, path) in zip(indexes, bands):
+            with rio.open(path) as ds:
+                if ds.shape != out.shape or ds.transform != out.transform:
+                    raise ValueError(f"{path} is not aligned with the cube.")
+                out.write(to_float32(ds.read(1), ds.nodata), band)
+            out.update_tags(band, key=get_cache_key(spec), **spec["params"])
+
+    update_overviews(cube_path, indexes)
+
+
+def get_or_append_bands(
+    cube_spec: CacheSpec,
+    band_specs: Sequence[CacheSpec],
+    create: Callable[[list[tuple[CacheSpec, Path]]], None],
+) -> list[Path]:
+    """Returns the locations of several bands of a cube, creating the missing ones.
+
+    This is the cube counterpart of `get_or_create_many`. The missing bands are
+    written by `create` to temporary files, and then into a copy of the cube that is
+    moved into place with an atomic rename, all while holding the lock of the cube.
+    Readers only ever see complete versions of the cube, and those that opened the
+    previous one keep reading it. The copy is byte for byte, so only the new bands
+    are compressed and resampled. Bands that were cached as separate files by older
+    versions of the pipeline are moved into the cube instead of downloaded again.
+
+    Parameters
+    ----------
+    cube_spec: CacheSpec
+        Specification of the cube.
+
+    band_specs: Sequence[CacheSpec]
+        Specifications of the bands.
+
+    create: Callable[[list[tuple[CacheSpec, Path]]], None]
+        Function that receives the specs and output paths of the missing bands and
+        writes each of them as a single-band raster.
+
+    Returns
+    -------
+    list[Path]
+        Location of the VRT of each band, in the same order as `band_specs`. Every
+        VRT reads from the cube.
+    """
+    cube_path = lookup(cube_spec) or get_cache_path(cube_spec)
+    keys = [get_cache_key(spec) for spec in band_specs]
+
+    if not set(keys).issubset(get_band_keys(cube_path)):
+        with single_flight(get_cache_key(cube_spec)):
+            cached_keys = get_band_keys(cube_path)
+            missing = {
+                key: spec
+                for key, spec in zip(keys, band_specs)
+                if key not in cached_keys
+            }
+
+            if missing:
+                if not cached_keys:
+                    # Leftovers of an evicted cube may point to the wrong bands
+                    shutil.rmtree(get_band_dir(cube_path), ignore_errors=True)
+
+                cube_path.parent.mkdir(parents=True, exist_ok=True)
+                with tempfile.TemporaryDirectory(dir=cube_path.parent) as temp_dir:
+                    new_bands, pending = [], []
+                    for key, spec in missing.items():
+                        legacy_path = get_cache_path(spec)
+                        if legacy_path.exists():
+                            new_bands.append((spec, legacy_path))
+                        else:
+                            path = Path(temp_dir) / f"{key}.tif"
+                            new_bands.append((spec, path))
+                            pending.append((spec, path))
+
+                    if pending:
+                        create(pending)
+
+                    with rio.open(new_bands[0][1]) as ds:
+                        height, width = ds.shape
+                        crs, transform = ds.crs, ds.transform
+                    with atomic_write(cube_path) as temp_path:
+                        copy_cube(
+                            cube_path,
+                            temp_path,
+                            {spec["params"]["year"] for spec, _ in new_bands},
+                            height=height,
+                            width=width,
+                            crs=crs,
+                            transform=transform,
+                        )
+                        write_bands(temp_path, new_bands)
+
+                register_entry(cube_spec, cube_path, checksum=False)
+                write_band_vrts(cube_path)
+                for spec, path in new_bands:
+                    if path == get_cache_path(spec):
+                        remove_entry(get_cache_key(spec), delete_file=False)
+                        path.unlink(missing_ok=True)
+
+    paths = [get_band_path(cube_path, key) for key in keys]
+    if not all(path.exists() for path in paths):
+        write_band_vrts(cube_path)
+    return paths
+
+
+def allocate_cube_years(
+    cube_spec: CacheSpec,
+    years: Iterable[int],
+    *,
+    height: int,
+    width: int,
+    crs: str,
+    transform: Affine,
+) -> None:
+    """Allocates every month of several years in a cube while holding its lock, so a
+    range of years that is filled one year at a time rewrites the cube only once. See
+    `copy_cube`."""
+    cube_path = lookup(cube_spec) or get_cache_path(cube_spec)
+    with single_flight(get_cache_key(cube_spec)):
+        if not get_missing_slots(cube_path, years):
+            return
+
+        with atomic_write(cube_path) as temp_path:
+            copy_cube(
+                cube_path,
+                temp_path,
+                years,
+                height=height,
+                width=width,
+                crs=crs,
+                transform=transform,
+            )
+        register_entry(cube_spec, cube_path, checksum=False)
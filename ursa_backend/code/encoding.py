@@ -0,0 +1,218 @@
+import cv2
+import io
+import json
+
+import numpy as np
+
+from affine import Affine
+from rasterio.io import MemoryFile
+from typing import Literal
+from ursa_backend.models import RasterResponseModel
+
+
+RasterFormat = Literal["json", "raw", "npy", "tiff"]
+ImageFormat = Literal["json", "png", "webp"]
+
+RASTER_MEDIA_TYPES: dict[str, str] = {
+    "json": "application/json",
+    "raw": "application/octet-stream",
+    "npy": "application/x-npy",
+    "tiff": "image/tiff",
+}
+
+IMAGE_MEDIA_TYPES: dict[str, str] = {
+    "json": "application/json",
+    "png": "image/png",
+    "webp": "image/webp",
+}
+
+
+def negotiate_format(
+    requested: str | None,
+    accept: str | None,
+    media_types: dict[str, str],
+    default: str,
+) -> str | None:
+    """Chooses the output format of a response.
+
+    Parameters
+    ----------
+    requested: str | None
+        Format explicitly requested through a query parameter. Takes precedence over
+        the `Accept` header.
+
+    accept: str | None
+        Value of the `Accept` header of the request.
+
+    media_types: dict[str, str]
+        Mapping from format name to media type of the formats the endpoint supports.
+
+    default: str
+        Format to use if neither `requested` nor `accept` select one.
+
+    Returns
+    -------
+    str | None
+        Name of the chosen format, or None if the requested format is not supported.
+    """
+    if requested is not None:
+        return requested if requested in media_types else None
+
+    if not accept:
+        return default
+
+    by_media_type = {v: k for k, v in media_types.items()}
+    for part in accept.split(","):
+        media_type = part.split(";")[0].strip().lower()
+        if media_type in ("*/*", ""):
+            return default
+        if media_type in by_media_type:
+            return by_media_type[media_type]
+
+    return None
+
+
+def raster_headers(raster: RasterResponseModel, arr: np.ndarray) -> dict[str, str]:
+    """Builds the headers describing the georeference of a binary raster payload.
+
+    Parameters
+    ----------
+    raster: RasterResponseModel
+        Raster being sent.
+
+    arr: np.ndarray
+        Array with the raster data, as it will be encoded.
+
+    Returns
+    -------
+    dict[str, str]
+        Headers with the width, height, dtype, CRS and transform of the raster.
+    """
+    return {
+        "X-Raster-Width": str(arr.shape[1]),
+        "X-Raster-Height": str(arr.shape[0]),
+        "X-Raster-Dtype": arr.dtype.str,
+        "X-Raster-Crs": raster.crs,
+        "X-Raster-Transform": json.dumps(list(raster.transform)),
+    }
+
+
+def raster_to_float32(raster: RasterResponseModel) -> np.ndarray:
+    """Returns the raster data as a C-contiguous little-endian float32 array."""
+    return np.ascontiguousarray(raster.data, dtype="<f4")
+
+
+def encode_raw(arr: np.ndarray) -> bytes:
+    """Encodes an array as its raw row-major bytes."""
+    return arr.tobytes(order="C")
+
+
+def encode_npy(arr: np.ndarray) -> bytes:
+    """Encodes an array in NumPy's `.npy` format."""
+    buffer = io.BytesIO()
+    np.save(buffer, arr, allow_pickle=False)
+    return buffer.getvalue()
+
+
+def encode_geotiff(
+    arr: np.ndarray, raster: RasterResponseModel, *, nodata: float | None = np.nan
+) -> bytes:
+    """Encodes an array as an in-memory Cloud Optimized GeoTIFF.
+
+    Parameters
+    ----------
+    arr: np.ndarray
+        2D array to encode.
+
+    raster: RasterResponseModel
+        Raster the array was extracted from. Its CRS and transform are written to the file.
+
+    nodata: float | None
+        Nodata value of the array.
+
+    Returns
+    -------
+    bytes
+        Contents of the GeoTIFF file.
+    """
+    profile = dict(
+        driver="COG",
+        height=arr.shape[0],
+        width=arr.shape[1],
+        count=1,
+        dtype=arr.dtype,
+        crs=raster.crs,
+        transform=Affine(*raster.transform[:6]),
+        nodata=nodata,
+        compress="deflate",
+        predictor=3 if np.issubdtype(arr.dtype, np.floating) else 2,
+        blocksize=512,
+    )
+
+    with MemoryFile() as memfile:
+        with memfile.open(**profile) as ds:
+            ds.write(arr, 1)
+        return memfile.read()
+
+
+def encode_raster(
+    fmt: RasterFormat, arr: np.ndarray, raster: RasterResponseModel
+) -> bytes:
+    """Encodes a raster in one of the binary formats.
+
+    Parameters
+    ----------
+    fmt: RasterFormat
+        Output format. Must be one of `raw`, `npy` or `tiff`.
+
+    arr: np.ndarray
+        Raster data, as returned by `raster_to_float32`.
+
+    raster: RasterResponseModel
+        Raster to encode. Only its CRS and transform are used.
+
+    Returns
+    -------
+    bytes
+        Encoded raster.
+    """
+    if fmt == "raw":
+        return encode_raw(arr)
+    elif fmt == "npy":
+        return encode_npy(arr)
+    elif fmt == "tiff":
+        return encode_geotiff(arr, raster)
+    else:
+        raise ValueError(f"Unsupported binary raster format: {fmt}")
+
+
+def encode_image(fmt: ImageFormat, rgba: np.ndarray) -> bytes:
+    """Encodes an RGBA array as a compressed image.
+
+    Parameters
+    ----------
+    fmt: ImageFormat
+        Output format. Must be one of `png` or `webp`.
+
+    rgba: np.ndarray
+        Array of shape (height, width, 4) with uint8 RGBA colors.
+
+    Returns
+    -------
+    bytes
+        Encoded image.
+    """
+    bgra = cv2.cvtColor(rgba, cv2.COLOR_RGBA2BGRA)
+
+    if fmt == "png":
+        ok, buffer = cv2.imencode(".png", bgra, [cv2.IMWRITE_PNG_COMPRESSION, 6])
+    elif fmt == "webp":
+        # Quality above 100 selects lossless compression
+        ok, buffer = cv2.imencode(".webp", bgra, [cv2.IMWRITE_WEBP_QUALITY, 101])
+    else:
+        raise ValueError(f"Unsupported image format: {fmt}")
+
+    if not ok:
+        raise RuntimeError(f"Could not encode image as {fmt}.")
+
+    return buffer.tobytes()
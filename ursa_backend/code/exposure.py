@@ -0,0 +1,178 @@
+import geopandas as gpd
+import numpy as np
+
+from affine import Affine
+from rasterio.enums import Resampling
+from rasterio.io import MemoryFile
+from rasterio.warp import reproject
+from typing import TypedDict
+from ursa_backend.code.constants import RADIAL_PDF_LAM, RADIAL_RING_WIDTH
+from ursa_backend.code.suhi import get_radial_pdf
+from ursa_backend.code.zonal import get_zonal_stats, rasterize_zones
+from ursa_backend.models import RasterResponseModel
+
+
+POPULATION_RASTER_MEDIA_TYPES = ("image/tiff", "image/geotiff")
+
+
+class ExposureCurve(TypedDict):
+    temperature: list[float]
+    cdf: list[float]
+    pdf: list[float]
+    population: float
+    unmatched_population: float
+
+
+def is_population_raster(media_type: str) -> bool:
+    return media_type.split(";")[0].strip().lower() in POPULATION_RASTER_MEDIA_TYPES
+
+
+def resample_population(
+    content: bytes, raster_response: RasterResponseModel
+) -> np.ndarray:
+    """Resamples a population raster to the grid of another raster.
+
+    Counts are summed rather than averaged, so the total population is preserved
+    when the population raster is finer than the target grid.
+
+    Parameters
+    ----------
+    content: bytes
+        Population raster, in any format readable by GDAL.
+
+    raster_response: RasterResponseModel
+        Raster whose grid is used.
+
+    Returns
+    -------
+    np.ndarray
+        Population of each pixel of the target grid. Pixels without data are 0.
+    """
+    height, width = raster_response.data.shape
+    out = np.zeros((height, width), dtype=np.float64)
+
+    with MemoryFile(content) as memfile, memfile.open() as ds:
+        reproject(
+            ds.read(1, masked=True).filled(0).astype(np.float64),
+            out,
+            src_transform=ds.transform,
+            src_crs=ds.crs,
+            src_nodata=0,
+            dst_transform=Affine(*raster_response.transform[:6]),
+            dst_crs=raster_response.crs,
+            dst_nodata=0,
+            resampling=Resampling.sum,
+        )
+    return out
+
+
+def get_weighted_cdf(
+    values: np.ndarray, weights: np.ndarray, *, bin_width: float
+) -> tuple[np.ndarray, np.ndarray]:
+    """Calculates the weighted cumulative distribution of a set of values.
+
+    Values are binned into a histogram, so the cost doesn't depend on how many
+    values share a bin.
+
+    Parameters
+    ----------
+    values: np.ndarray
+        Values to summarize. Must be finite.
+
+    weights: np.ndarray
+        Weight of each value.
+
+    bin_width: float
+        Width of the histogram bins, in the units of `values`.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        Upper edge of each bin, and the fraction of the total weight with a value
+        up to that edge.
+    """
+    lo = np.floor(values.min() / bin_width)
+    hi = max(np.ceil(values.max() / bin_width), lo + 1)
+    edges = bin_width * np.arange(lo, hi + 1)
+
+    hist, _ = np.histogram(values, bins=edges, weights=weights)
+    return edges[1:], np.cumsum(hist) / hist.sum()
+
+
+def get_exposure_curve(
+    values: np.ndarray, weights: np.ndarray, *, bin_width: float
+) -> ExposureCurve:
+    """Builds the population-weighted CDF and PDF of a temperature layer.
+
+    Parameters
+    ----------
+    values: np.ndarray
+        Temperature of each pixel or zone. NaN values are not matched.
+
+    weights: np.ndarray
+        Population of each pixel or zone, with the same shape as `values`.
+
+    bin_width: float
+        Width of the temperature bins.
+
+    Returns
+    -------
+    ExposureCurve
+        CDF and smoothed PDF at the upper edge of each bin, plus the matched and
+        unmatched population.
+    """
+    values = values.ravel()
+    weights = np.nan_to_num(weights.ravel())
+
+    matched = ~np.isnan(values) & (weights > 0)
+    unmatched_population = float(weights[np.isnan(values)].sum())
+
+    if not matched.any():
+        return ExposureCurve(
+            temperature=[],
+            cdf=[],
+            pdf=[],
+            population=0.0,
+            unmatched_population=unmatched_population,
+        )
+
+    temperature, cdf = get_weighted_cdf(
+        values[matched], weights[matched], bin_width=bin_width
+    )
+    # The smoothing penalty grows with the cube of the spacing of the samples, so the
+    # strength tuned for radial rings is scaled to the temperature bins
+    lam = RADIAL_PDF_LAM * (bin_width / RADIAL_RING_WIDTH) ** 3
+    _, pdf = get_radial_pdf(temperature, cdf, lam=lam)
+    return ExposureCurve(
+        temperature=temperature.tolist(),
+        cdf=cdf.tolist(),
+        pdf=pdf,
+        population=float(weights[matched].sum()),
+        unmatched_population=unmatched_population,
+    )
+
+
+def get_raster_exposure(
+    raster_response: RasterResponseModel, content: bytes, *, bin_width: float
+) -> ExposureCurve:
+    """Population exposure from a population raster, weighting every pixel."""
+    arr = raster_response.data
+    population = resample_population(content, raster_response)
+    return get_exposure_curve(arr, population, bin_width=bin_width)
+
+
+def get_zone_exposure(
+    raster_response: RasterResponseModel,
+    zones: gpd.GeoDataFrame,
+    weight_field: str,
+    *,
+    bin_width: float,
+) -> ExposureCurve:
+    """Population exposure from polygons with counts, weighting the mean of each."""
+    arr = raster_response.data
+    transform = Affine(*raster_response.transform[:6])
+
+    labels = rasterize_zones(zones, transform, arr.shape, raster_response.crs)
+    stats = get_zonal_stats(arr, labels, len(zones), percentiles=())
+    weights = zones[weight_field].to_numpy(dtype=float)
+    return get_exposure_curve(stats["mean"], weights, bin_width=bin_width)
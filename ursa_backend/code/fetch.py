@@ -0,0 +1,380 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Sequence, TypeVar
+from ursa_backend.code.cache import (
+    CacheSpec,
+    get_cache_key,
+    get_cache_path,
+    get_or_create,
+    get_or_create_many,
+    make_spec,
+)
+from ursa_backend.code.catalog import get_scene_catalog, get_scene_month
+from ursa_backend.code.common import (
+    bounds_to_ee,
+    download_image_bands,
+    load_or_download_image,
+)
+from ursa_backend.code.cube import (
+    allocate_cube_years,
+    get_band_keys,
+    get_or_append_bands,
+)
+from ursa_backend.code.dates import get_date_range, season_to_months
+from ursa_backend.code.constants import (
+    DEFAULT_CRS,
+    DOWNLOAD_WORKERS,
+    GRID_TILE_SIZE,
+    LST_DATASET,
+    LST_DOWNLOAD_MODE,
+    LST_NODATA,
+    SCALE_TIERS,
+    WORLDCOVER_DATASET,
+)
+from ursa_backend.code.grid import (
+    GridTile,
+    get_grid_window,
+    get_tile_bounds,
+    get_tile_window,
+    get_window_tiles,
+    get_window_transform,
+    mosaic_tiles,
+)
+from ursa_backend.code.scheduler import Priority, get_scheduler
+from ursa_backend.code.suhi import get_lst_stack, get_monthly_lst
+from ursa_backend.code.world_cover import get_world_cover
+from ursa_backend.models import GeographicRequestModel, GeoTemporalRequestModel
+
+
+T = TypeVar("T")
+
+
+def select_scale(max_scale: float, min_scale: int = SCALE_TIERS[0]) -> int:
+    """Chooses the coarsest download scale that is fine enough for an analysis.
+
+    Parameters
+    ----------
+    max_scale: float
+        Largest pixel size, in meters, that gives the accuracy the analysis needs.
+
+    min_scale: int
+        Finest pixel size worth downloading, usually the scale of the request.
+
+    Returns
+    -------
+    int
+        Coarsest scale in `SCALE_TIERS` that is not coarser than `max_scale`, or
+        `min_scale` if that is coarser.
+    """
+    candidates = [scale for scale in SCALE_TIERS if scale <= max_scale]
+    return max(min_scale, candidates[-1] if candidates else SCALE_TIERS[0])
+
+
+def get_lst_cube_spec(request: GeographicRequestModel) -> CacheSpec:
+    """Every month of LST of a bounding box is stored as a band of a single cube."""
+    return make_spec(
+        LST_DATASET, request.get_bounds(), scale=request.scale, layout="monthly_cube"
+    )
+
+
+def get_lst_specs(
+    request: GeoTemporalRequestModel, months: Sequence[int] | None = None
+) -> list[CacheSpec]:
+    if months is None:
+        months = season_to_months(request.season)
+    return [
+        make_spec(
+            LST_DATASET,
+            request.get_bounds(),
+            scale=request.scale,
+            year=request.year,
+            month=month,
+        )
+        for month in months
+    ]
+
+
+def get_lst_months(
+    request: GeoTemporalRequestModel, priority: Priority = Priority.INTERACTIVE
+) -> list[int]:
+    """Months of the season of a request that have scenes, according to the scene
+    catalog.
+
+    Every consumer of the LST rasters of a request fetches these months, so equal
+    requests share their rasters, their mean SUHI raster and its cache key, and
+    months without scenes are never asked from Earth Engine.
+    """
+    catalog = get_scene_catalog(request.get_bounds(), request.year, priority=priority)
+    scene_months = {get_scene_month(scene) for scene in catalog["scenes"]}
+    return [
+        month for month in season_to_months(request.season) if month in scene_months
+    ]
+
+
+def get_lst_tile_spec(
+    tile: GridTile, *, scale: int, year: int, month: int
+) -> CacheSpec:
+    return make_spec(
+        LST_DATASET,
+        get_tile_bounds(tile, scale),
+        scale=scale,
+        grid=GRID_TILE_SIZE,
+        tile=list(tile),
+        year=year,
+        month=month,
+    )
+
+
+def get_world_cover_tile_spec(tile: GridTile, *, scale: int) -> CacheSpec:
+    return make_spec(
+        WORLDCOVER_DATASET,
+        get_tile_bounds(tile, scale),
+        scale=scale,
+        grid=GRID_TILE_SIZE,
+        tile=list(tile),
+    )
+
+
+def map_tiles(fn: Callable[[GridTile], T], tiles: Sequence[GridTile]) -> list[T]:
+    """Fetches several grid tiles concurrently. The downloads themselves are still
+    throttled by the shared download scheduler."""
+    if len(tiles) == 1:
+        return [fn(tiles[0])]
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as pool:
+        return list(pool.map(fn, tiles))
+
+
+def fetch_lst_tiles(
+    tiles: Sequence[GridTile],
+    *,
+    scale: int,
+    year: int,
+    months: Sequence[int],
+    priority: Priority = Priority.INTERACTIVE,
+) -> list[dict[GridTile, Path]]:
+    """Returns the monthly LST rasters of several grid tiles, downloading the missing
+    ones.
+
+    Parameters
+    ----------
+    tiles: Sequence[GridTile]
+        Tiles of the global grid to fetch.
+
+    scale: int
+        Pixel size of the grid, in meters.
+
+    year: int
+        Year to fetch.
+
+    months: Sequence[int]
+        Months to fetch.
+
+    priority: Priority
+        Priority of the downloads in the shared download scheduler.
+
+    Returns
+    -------
+    list[dict[GridTile, Path]]
+        Path of the raster of every tile, for each month.
+    """
+    shape = (GRID_TILE_SIZE, GRID_TILE_SIZE)
+
+    def fetch_tile(tile: GridTile) -> list[Path]:
+        specs = [
+            get_lst_tile_spec(tile, scale=scale, year=year, month=month)
+            for month in months
+        ]
+        tile_ee = bounds_to_ee(*get_tile_bounds(tile, scale))
+        tile_transform = get_window_transform(get_tile_window(tile), scale)
+
+        if LST_DOWNLOAD_MODE == "stack":
+
+            def download_stack(pending: list[tuple[CacheSpec, Path]]) -> None:
+                pending_months = [spec["params"]["month"] for spec, _ in pending]
+                img = get_lst_stack(tile_ee, year, pending_months)
+                download_image_bands(
+                    img,
+                    [path for _, path in pending],
+                    tile_ee,
+                    nodata=LST_NODATA,
+                    crs=DEFAULT_CRS,
+                    priority=priority,
+                    crs_transform=tile_transform,
+                    shape=shape,
+                )
+
+            return get_or_create_many(specs, download_stack)
+
+        paths = []
+        for month, spec in zip(months, specs):
+
+            def download(path: Path) -> None:
+                start_date, end_date = get_date_range(month, year)
+                lst = get_scheduler().run(
+                    get_monthly_lst, tile_ee, start_date, end_date, priority=priority
+                )
+                load_or_download_image(
+                    lst,
+                    path,
+                    tile_ee,
+                    nodata=LST_NODATA,
+                    crs=DEFAULT_CRS,
+                    priority=priority,
+                    crs_transform=tile_transform,
+                    shape=shape,
+                )
+
+            paths.append(get_or_create(spec, download))
+        return paths
+
+    tile_paths = map_tiles(fetch_tile, tiles)
+    return [
+        {tile: paths[i] for tile, paths in zip(tiles, tile_paths)}
+        for i in range(len(months))
+    ]
+
+
+def fetch_lst_rasters(
+    request: GeoTemporalRequestModel,
+    priority: Priority = Priority.INTERACTIVE,
+    on_month: Callable[[int], None] | None = None,
+    months: Sequence[int] | None = None,
+) -> list[Path]:
+    """Returns the monthly LST rasters of a request, downloading the missing ones.
+
+    LST is downloaded in tiles of a global grid, which are shared by every request
+    that overlaps them. The months of the bounding box are mosaicked from the tiles
+    and stored as bands of the cube of the bounding box.
+
+    Parameters
+    ----------
+    request: GeoTemporalRequestModel
+        Bounding box, year and season to fetch.
+
+    priority: Priority
+        Priority of the downloads in the shared download scheduler.
+
+    on_month: Callable[[int], None] | None
+        Called with the month number as soon as each monthly raster is available.
+
+    months: Sequence[int] | None
+        Months to fetch, usually the ones with scenes according to the scene catalog.
+        Defaults to every month of the season of the request.
+
+    Returns
+    -------
+    list[Path]
+        Paths of single-band VRTs over the cube, one per month, in chronological
+        order. Their stems are the cache keys of the months.
+    """
+    if months is None:
+        months = season_to_months(request.season)
+    specs = get_lst_specs(request, months)
+    cube_spec = get_lst_cube_spec(request)
+    window = get_grid_window(request.get_bounds(), request.scale)
+
+    def create(pending: list[tuple[CacheSpec, Path]]) -> None:
+        month_tiles = fetch_lst_tiles(
+            get_window_tiles(window),
+            scale=request.scale,
+            year=request.year,
+            months=[spec["params"]["month"] for spec, _ in pending],
+            priority=priority,
+        )
+        for (_, path), tile_paths in zip(pending, month_tiles):
+            mosaic_tiles(tile_paths, window, path, scale=request.scale)
+
+    if LST_DOWNLOAD_MODE == "stack":
+        out = get_or_append_bands(cube_spec, specs, create)
+        if on_month is not None:
+            for month in months:
+                on_month(month)
+        return out
+
+    out = []
+    for month, spec in zip(months, specs):
+        out.extend(get_or_append_bands(cube_spec, [spec], create))
+        if on_month is not None:
+            on_month(month)
+
+    return out
+
+
+def prefetch_lst_tiles(
+    request: GeoTemporalRequestModel,
+    months: Sequence[int],
+    priority: Priority = Priority.INTERACTIVE,
+) -> None:
+    """Downloads the grid tiles of the months of a request that aren't in its cube yet.
+
+    Unlike `fetch_lst_rasters`, this doesn't take the lock of the cube, so requests
+    that share a cube, such as different years of the same bounding box, can download
+    their tiles in parallel and be added to the cube afterwards.
+    """
+    cached_keys = get_band_keys(get_cache_path(get_lst_cube_spec(request)))
+    missing = [
+        spec["params"]["month"]
+        for spec in get_lst_specs(request, months)
+        if get_cache_key(spec) not in cached_keys
+    ]
+    if missing:
+        fetch_lst_tiles(
+            get_window_tiles(get_grid_window(request.get_bounds(), request.scale)),
+            scale=request.scale,
+            year=request.year,
+            months=missing,
+            priority=priority,
+        )
+
+
+def allocate_lst_cube(request: GeographicRequestModel, years: Sequence[int]) -> None:
+    """Allocates every month of several years in the LST cube of a request at once, so
+    fetching the years one by one fills their bands instead of growing the cube once
+    per year."""
+    window = get_grid_window(request.get_bounds(), request.scale)
+    allocate_cube_years(
+        get_lst_cube_spec(request),
+        years,
+        height=int(window.height),
+        width=int(window.width),
+        crs="EPSG:4326",
+        transform=get_window_transform(window, request.scale),
+    )
+
+
+def get_world_cover_spec(request: GeographicRequestModel) -> CacheSpec:
+    return make_spec(WORLDCOVER_DATASET, request.get_bounds(), scale=request.scale)
+
+
+def fetch_world_cover(
+    request: GeographicRequestModel, priority: Priority = Priority.INTERACTIVE
+) -> Path:
+    """Returns the WorldCover raster of a request, mosaicked from tiles of the global
+    grid. Missing tiles are downloaded."""
+    spec = get_world_cover_spec(request)
+    scale = request.scale
+    window = get_grid_window(request.get_bounds(), scale)
+
+    def fetch_tile(tile: GridTile) -> Path:
+        tile_ee = bounds_to_ee(*get_tile_bounds(tile, scale))
+
+        def download(path: Path) -> None:
+            load_or_download_image(
+                get_world_cover(tile_ee),
+                path,
+                tile_ee,
+                nodata=0,
+                crs=DEFAULT_CRS,
+                priority=priority,
+                crs_transform=get_window_transform(get_tile_window(tile), scale),
+                shape=(GRID_TILE_SIZE, GRID_TILE_SIZE),
+            )
+
+        return get_or_create(get_world_cover_tile_spec(tile, scale=scale), download)
+
+    def create(path: Path) -> None:
+        tiles = get_window_tiles(window)
+        tile_paths = dict(zip(tiles, map_tiles(fetch_tile, tiles)))
+        mosaic_tiles(tile_paths, window, path, scale=scale)
+
+    return get_or_create(spec, create)
@@ -1,26 +1,366 @@
 import os
+import uuid
 
 import numpy as np
 import rasterio as rio
+import xml.etree.ElementTree as ET
 
+from affine import Affine
+from contextlib import ExitStack, contextmanager
+from pathlib import Path
+from rasterio.enums import Resampling
+from rasterio.io import DatasetReader, DatasetWriter
+from rasterio.windows import Window
+from typing import Generator, Sequence
+from ursa_backend.code.constants import OVERVIEW_MIN_SIZE
 from ursa_backend.models import RasterResponseModel
-from typing import Generator
-
-
-def raster_generator(
-    raster_paths: list[os.PathLike], nan_thresh: float | None = None
-) -> Generator[RasterResponseModel | None, None, None]:
-    for path in raster_paths:
-        with rio.open(path) as ds:
-            temp = ds.read(1)
-            crs = ds.crs
-            transform = ds.transform
-        temp[temp == ds.nodata] = np.nan
-
-        nan_frac = np.isnan(temp).sum() / temp.size
-        if nan_thresh is not None and nan_frac > nan_thresh:
-            yield None
-        else:
-            yield RasterResponseModel(
-                data=temp, crs=str(crs), transform=list(transform)
+
+
+def to_float32(data: np.ndarray, nodata: float | None) -> np.ndarray:
+    """Converts raster data to float32 with NaN as nodata, in place when possible.
+
+    Parameters
+    ----------
+    data: np.ndarray
+        Raster data, as read from a dataset. It may be modified.
+
+    nodata: float | None
+        Nodata value of the dataset.
+
+    Returns
+    -------
+    np.ndarray
+        Float32 array. It is `data` itself if `data` was already float32.
+    """
+    mask = data == nodata if nodata is not None and not np.isnan(nodata) else None
+    data = data.astype(np.float32, copy=False)
+    if mask is not None:
+        data[mask] = np.nan
+    return data
+
+
+def iter_windows(
+    height: int, width: int, block_size: int
+) -> Generator[Window, None, None]:
+    """Splits a raster into square blocks, in row-major order.
+
+    Parameters
+    ----------
+    height: int
+        Height of the raster.
+
+    width: int
+        Width of the raster.
+
+    block_size: int
+        Height and width of each block. Blocks on the bottom and right edges may be
+        smaller.
+
+    Yields
+    ------
+    rasterio.windows.Window
+        Window of each block.
+    """
+    for row in range(0, height, block_size):
+        for col in range(0, width, block_size):
+            yield Window(
+                col, row, min(block_size, width - col), min(block_size, height - row)
+            )
+
+
+def write_band_vrt(path: os.PathLike, source_path: os.PathLike, band: int) -> None:
+    """Writes a single-band VRT that exposes one band of another raster.
+
+    The VRT has the same grid as its source, so GDAL reads through it without
+    resampling, and it also exposes the overviews of the source.
+
+    Parameters
+    ----------
+    path: os.PathLike
+        Location of the VRT. It is published atomically.
+
+    source_path: os.PathLike
+        Raster the band belongs to. It is referenced relative to the VRT.
+
+    band: int
+        Index of the band, starting from 1.
+    """
+    path = Path(path)
+    with rio.open(source_path) as ds:
+        root = ET.Element(
+            "VRTDataset", rasterXSize=str(ds.width), rasterYSize=str(ds.height)
+        )
+        ET.SubElement(root, "SRS").text = ds.crs.to_wkt()
+        ET.SubElement(root, "GeoTransform").text = ", ".join(
+            str(v) for v in ds.transform.to_gdal()
+        )
+        band_el = ET.SubElement(root, "VRTRasterBand", dataType="Float32", band="1")
+        ET.SubElement(band_el, "NoDataValue").text = str(ds.nodatavals[band - 1])
+        if ds.descriptions[band - 1]:
+            ET.SubElement(band_el, "Description").text = ds.descriptions[band - 1]
+
+    source = ET.SubElement(band_el, "SimpleSource")
+    ET.SubElement(source, "SourceFilename", relativeToVRT="1").text = os.path.relpath(
+        source_path, path.parent
+    )
+    ET.SubElement(source, "SourceBand").text = str(band)
+
+    with atomic_write(path) as temp_path:
+        ET.ElementTree(root).write(temp_path)
+
+
+def resolve_band(path: os.PathLike) -> tuple[Path, int]:
+    """Finds the file and band that hold the data of a single-band raster.
+
+    VRTs written by `write_band_vrt` resolve to the band they expose, so that several
+    of them can be read through a single open of their source. Any other raster
+    resolves to its own first band.
+
+    Parameters
+    ----------
+    path: os.PathLike
+        Path of the raster.
+
+    Returns
+    -------
+    tuple[Path, int]
+        Path of the file and index of the band, starting from 1.
+    """
+    path = Path(path)
+    if path.suffix != ".vrt":
+        return path, 1
+
+    sources = ET.parse(path).getroot().findall("./VRTRasterBand/SimpleSource")
+    if len(sources) != 1 or sources[0].find("SrcRect") is not None:
+        return path, 1
+
+    filename = sources[0].find("SourceFilename")
+    source_path = filename.text
+    if filename.get("relativeToVRT") == "1":
+        source_path = os.path.normpath(path.parent / source_path)
+    return Path(source_path), int(sources[0].findtext("SourceBand", "1"))
+
+
+@contextmanager
+def open_bands(
+    raster_paths: Sequence[os.PathLike], *, overview_level: int | None = None
+) -> Generator[list[tuple[DatasetReader, int]], None, None]:
+    """Opens several single-band rasters, opening every underlying file only once.
+
+    Parameters
+    ----------
+    raster_paths: Sequence[os.PathLike]
+        Paths of the rasters. Bands of the same data cube share a dataset.
+
+    overview_level: int | None
+        If given, the datasets are opened at this overview level instead of at full
+        resolution.
+
+    Yields
+    ------
+    list[tuple[rasterio.io.DatasetReader, int]]
+        Dataset and band index of each raster, in the order of `raster_paths`.
+    """
+    with ExitStack() as stack:
+        datasets = {}
+        bands = []
+        for path in raster_paths:
+            source_path, band = resolve_band(path)
+            if source_path not in datasets:
+                datasets[source_path] = stack.enter_context(
+                    rio.open(source_path, overview_level=overview_level)
+                )
+            bands.append((datasets[source_path], band))
+        yield bands
+
+
+def read_band_stack(
+    bands: Sequence[tuple[DatasetReader, int]], *, window: Window | None = None
+) -> np.ndarray:
+    """Reads several bands into a single float32 array with NaN as nodata.
+
+    Bands that belong to the same dataset, such as the months of a data cube, are
+    read with a single call.
+
+    Parameters
+    ----------
+    bands: Sequence[tuple[rasterio.io.DatasetReader, int]]
+        Dataset and band index of each band, as yielded by `open_bands`. They must
+        have the same shape.
+
+    window: rasterio.windows.Window | None
+        If given, only this window of the bands is read.
+
+    Returns
+    -------
+    np.ndarray
+        Array with shape (bands, height, width).
+    """
+    groups = {}
+    for i, (ds, band) in enumerate(bands):
+        groups.setdefault(id(ds), (ds, []))[1].append((i, band))
+
+    out = None
+    for ds, members in groups.values():
+        data = ds.read([band for _, band in members], window=window)
+        if out is None:
+            out = np.empty((len(bands), *data.shape[1:]), dtype=np.float32)
+        for (i, band), band_data in zip(members, data):
+            out[i] = to_float32(band_data, ds.nodatavals[band - 1])
+    return out
+
+
+def read_raster(
+    path: os.PathLike, *, overview_level: int | None = None
+) -> RasterResponseModel:
+    """Reads the first band of a raster as float32, replacing its nodata values with
+    NaN.
+
+    Parameters
+    ----------
+    path: os.PathLike
+        Path of the raster.
+
+    overview_level: int | None
+        If given, the overview at this level is read instead of the full resolution
+        data. 0 is the finest overview.
+
+    Returns
+    -------
+    RasterResponseModel
+        Raster data, CRS and transform.
+    """
+    with rio.open(path, overview_level=overview_level) as ds:
+        return RasterResponseModel(
+            data=to_float32(ds.read(1), ds.nodata),
+            crs=str(ds.crs),
+            transform=list(ds.transform),
+        )
+
+
+def get_float32_profile(
+    height: int, width: int, *, crs: str, transform: Affine, count: int = 1
+) -> dict:
+    """Creation options of the float32 GeoTIFFs written by the pipeline.
+
+    Bands are stored in separate tiles, so reading one band of a multi-band file
+    doesn't decompress the others.
+    """
+    return dict(
+        driver="GTiff",
+        height=height,
+        width=width,
+        count=count,
+        dtype="float32",
+        crs=crs,
+        transform=transform,
+        nodata=np.nan,
+        compress="zstd",
+        predictor=3,
+        tiled=True,
+        interleave="band",
+        bigtiff="if_safer",
+    )
+
+
+def get_overview_factors(
+    height: int, width: int, *, min_size: int = OVERVIEW_MIN_SIZE
+) -> list[int]:
+    """Decimation factors of the overviews of a raster, halving the resolution at
+    every level until the smallest side would drop below `min_size` pixels."""
+    factors = []
+    factor = 2
+    while min(height, width) // factor >= min_size:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+def build_overviews(ds: DatasetWriter) -> None:
+    """Adds internal overviews to a dataset open for writing, averaging valid pixels."""
+    factors = get_overview_factors(ds.height, ds.width)
+    if factors:
+        ds.build_overviews(factors, Resampling.average)
+        ds.update_tags(ns="rio_overview", resampling="average")
+
+
+def update_overviews(path: os.PathLike, bands: Sequence[int]) -> None:
+    """Recomputes the internal overviews of some bands of a GeoTIFF in place.
+
+    GDAL only rebuilds the overviews of every band of a GeoTIFF at once, so bands
+    written after the overviews were built are resampled here instead, one level at a
+    time. Like `build_overviews`, each level is averaged from the previous one, so the
+    result is the same as rebuilding every band. The file is never open for reading
+    and writing at the same time, and it must not be read by others until this
+    returns.
+
+    Parameters
+    ----------
+    path: os.PathLike
+        GeoTIFF with internal overviews, as built by `build_overviews`.
+
+    bands: Sequence[int]
+        Indexes of the bands to update, starting from 1.
+    """
+    with rio.open(path) as ds:
+        n_levels = len(ds.overviews(1))
+
+    for level in range(n_levels):
+        with rio.open(path, overview_level=level) as ovr:
+            shape = ovr.shape
+
+        # The source is opened without its overviews, which are stale for these bands
+        source_level = "NONE" if level == 0 else f"{level - 1}only"
+        with rio.open(path, OVERVIEW_LEVEL=source_level) as src:
+            data = src.read(
+                list(bands),
+                out_shape=(len(bands), *shape),
+                resampling=Resampling.average,
             )
+
+        with rio.open(path, "r+", overview_level=level) as ovr:
+            ovr.write(data, list(bands))
+
+
+@contextmanager
+def atomic_write(path: os.PathLike) -> Generator[Path, None, None]:
+    """Yields a temporary path next to `path`, and moves it into place on success.
+
+    Parameters
+    ----------
+    path: os.PathLike
+        Final location of the file.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_name(f".{path.stem}.{uuid.uuid4().hex}{path.suffix}")
+    try:
+        yield temp_path
+        os.replace(temp_path, path)
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+
+def write_raster(path: os.PathLike, raster: RasterResponseModel) -> None:
+    """Writes a raster as a float32 GeoTIFF with NaN as nodata and overviews.
+
+    The file is written under a temporary name and moved into place with an atomic
+    rename.
+
+    Parameters
+    ----------
+    path: os.PathLike
+        Output path.
+
+    raster: RasterResponseModel
+        Raster to write.
+    """
+    data = raster.data.astype(np.float32, copy=False)
+    profile = get_float32_profile(
+        *data.shape, crs=raster.crs, transform=Affine(*raster.transform[:6])
+    )
+
+    with atomic_write(path) as temp_path:
+        with rio.open(temp_path, "w", **profile) as ds:
+            ds.write(data, 1)
+            build_overviews(ds)
@@ -1,65 +1,73 @@
-import shapely
-
-import geopandas as gpd
 import numpy as np
-import rasterio as rio
 
-from shapely import Geometry
-from typing import Callable, Sequence
+from affine import Affine
+from pyproj import Transformer
 
 
-def generate_circles(
-    center: tuple[float, float], circle_radius: float, max_radius: float
-) -> tuple[np.ndarray, list[shapely.geometry.Polygon]]:
-    """Generates a list of circles with increasing radius.
+def project_points(
+    x: np.ndarray, y: np.ndarray, *, src_crs: str, dst_crs: str
+) -> tuple[np.ndarray, np.ndarray]:
+    """Transforms arrays of coordinates between two CRSs.
 
     Parameters
     ----------
-    center: tuple[float, float]
-        Center of the circles.
+    x: np.ndarray
+        X coordinates.
+
+    y: np.ndarray
+        Y coordinates, with the same shape as `x`.
 
-    circle_radius: float
-        Radius of the circles.
+    src_crs: str
+        CRS of the input coordinates.
 
-    max_radius: float
-        Maximum radius of the circles.
+    dst_crs: str
+        CRS of the output coordinates.
 
     Returns
     -------
-    list[shapely.geometry.Polygon]
-        List of circles.
+    tuple[np.ndarray, np.ndarray]
+        Transformed x and y coordinates.
     """
-    radii = np.arange(circle_radius, max_radius + circle_radius, circle_radius)
-    circles = [
-        shapely.geometry.Point(center).buffer(radius, resolution=32) for radius in radii
-    ]
-    return radii, circles
+    transformer = Transformer.from_crs(src_crs, dst_crs, always_xy=True)
+    return transformer.transform(x, y)
 
 
-def generate_rings(
-    circles: list[shapely.geometry.Polygon],
-) -> list[shapely.geometry.Polygon]:
-    """Generates a list of rings from a list of circles.
+def get_pixel_centers(
+    transform: Affine, shape: tuple[int, int], *, crs: str, dst_crs: str
+) -> tuple[np.ndarray, np.ndarray]:
+    """Calculates the coordinates of the center of every pixel of a raster.
 
     Parameters
     ----------
-    circles: list[shapely.geometry.Polygon]
-        List of circles.
+    transform: affine.Affine
+        Geographic transform of the raster. Must be north-up.
+
+    shape: tuple[int, int]
+        Height and width of the raster.
+
+    crs: str
+        CRS of the raster.
+
+    dst_crs: str
+        CRS of the output coordinates.
 
     Returns
     -------
-    list[shapely.geometry.Polygon]
-        List of rings.
+    tuple[np.ndarray, np.ndarray]
+        X and y coordinates, as arrays with the same shape as the raster.
     """
-    return [circles[i].difference(circles[i - 1]) for i in range(1, len(circles))]
-
-
-def overlay_geometries(
-    ds: rio.DatasetBase, geometries: Sequence[Geometry], func: Callable
-) -> list[float]:
-    temps = []
-    for geom in geometries:
-        masked, _ = rio.mask.mask(ds, [geom], crop=True, nodata=-99999)
-        masked[masked == -99999] = np.nan
-        temps.append(func(masked))
-    return temps
+    height, width = shape
+    cols = transform.c + transform.a * (np.arange(width) + 0.5)
+    rows = transform.f + transform.e * (np.arange(height) + 0.5)
+    x, y = np.meshgrid(cols, rows)
+    return project_points(x, y, src_crs=crs, dst_crs=dst_crs)
+
+
+def get_raster_corners(
+    transform: Affine, shape: tuple[int, int], *, crs: str, dst_crs: str
+) -> tuple[np.ndarray, np.ndarray]:
+    """Coordinates of the four corners of a raster, projected to `dst_crs`."""
+    height, width = shape
+    corner_x = np.array([0, width, 0, width]) * transform.a + transform.c
+    corner_y = np.array([0, 0, height, height]) * transform.e + transform.f
+    return project_points(corner_x, corner_y, src_crs=crs, dst_crs=dst_crs)
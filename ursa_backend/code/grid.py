@@ -0,0 +1,168 @@
+import math
+import os
+
+import rasterio as rio
+
+from affine import Affine
+from rasterio.windows import Window
+from typing import Mapping
+from ursa_backend.code.constants import GRID_TILE_SIZE
+from ursa_backend.code.fs import atomic_write
+
+
+# Earth Engine converts scales in meters to degrees with the length of a degree of
+# longitude at the equator
+METERS_PER_DEGREE = 2 * math.pi * 6_378_137 / 360
+
+GridTile = tuple[int, int]
+
+
+def get_grid_transform(scale: float) -> Affine:
+    """Transform of the global EPSG:4326 pixel grid of a scale, anchored at (-180, 90)."""
+    resolution = scale / METERS_PER_DEGREE
+    return Affine(resolution, 0, -180, 0, -resolution, 90)
+
+
+def get_grid_window(bounds: tuple[float, float, float, float], scale: float) -> Window:
+    """Calculates the smallest window of the global grid that covers a bounding box.
+
+    Parameters
+    ----------
+    bounds: tuple[float, float, float, float]
+        Bounding box, in EPSG:4326.
+
+    scale: float
+        Pixel size of the grid, in meters.
+
+    Returns
+    -------
+    rasterio.windows.Window
+        Window in the pixel coordinates of the global grid.
+    """
+    xmin, ymin, xmax, ymax = bounds
+    inverse = ~get_grid_transform(scale)
+    col_start, row_start = inverse * (xmin, ymax)
+    col_stop, row_stop = inverse * (xmax, ymin)
+
+    # Rounding first keeps bounds that lie on a pixel edge from gaining a pixel
+    col_start, row_start = (math.floor(round(v, 6)) for v in (col_start, row_start))
+    col_stop, row_stop = (math.ceil(round(v, 6)) for v in (col_stop, row_stop))
+    return Window(
+        col_start,
+        row_start,
+        max(col_stop - col_start, 1),
+        max(row_stop - row_start, 1),
+    )
+
+
+def get_window_transform(window: Window, scale: float) -> Affine:
+    return get_grid_transform(scale) * Affine.translation(
+        window.col_off, window.row_off
+    )
+
+
+def get_tile_window(tile: GridTile, tile_size: int = GRID_TILE_SIZE) -> Window:
+    col, row = tile
+    return Window(col * tile_size, row * tile_size, tile_size, tile_size)
+
+
+def get_tile_bounds(
+    tile: GridTile, scale: float, tile_size: int = GRID_TILE_SIZE
+) -> tuple[float, float, float, float]:
+    transform = get_window_transform(get_tile_window(tile, tile_size), scale)
+    xmin, ymax = transform * (0, 0)
+    xmax, ymin = transform * (tile_size, tile_size)
+    return xmin, ymin, xmax, ymax
+
+
+def get_window_tiles(window: Window, tile_size: int = GRID_TILE_SIZE) -> list[GridTile]:
+    """Tiles of the global grid that intersect a window, in row-major order."""
+    col_start = int(window.col_off) // tile_size
+    col_stop = int(window.col_off + window.width - 1) // tile_size
+    row_start = int(window.row_off) // tile_size
+    row_stop = int(window.row_off + window.height - 1) // tile_size
+    return [
+        (col, row)
+        for row in range(row_start, row_stop + 1)
+        for col in range(col_start, col_stop + 1)
+    ]
+
+
+def mosaic_tiles(
+    tile_paths: Mapping[GridTile, os.PathLike],
+    window: Window,
+    out_path: os.PathLike,
+    *,
+    scale: float,
+    tile_size: int = GRID_TILE_SIZE,
+) -> None:
+    """Crops a window of the global grid out of the tiles that cover it.
+
+    Each tile is read only where it overlaps the window, and written straight to its
+    place in the output, so the mosaic is never held in memory.
+
+    Parameters
+    ----------
+    tile_paths: Mapping[GridTile, os.PathLike]
+        Path of the single-band raster of every tile that intersects the window, as
+        returned by `get_window_tiles`. They must share their dtype and nodata.
+
+    window: rasterio.windows.Window
+        Window of the global grid to extract.
+
+    out_path: os.PathLike
+        Output path. The file is published atomically.
+
+    scale: float
+        Pixel size of the grid, in meters.
+
+    tile_size: int
+        Height and width of the tiles, in pixels.
+    """
+    with rio.open(next(iter(tile_paths.values()))) as ds:
+        dtype, nodata = ds.dtypes[0], ds.nodata
+
+    profile = dict(
+        driver="GTiff",
+        height=int(window.height),
+        width=int(window.width),
+        count=1,
+        dtype=dtype,
+        crs="EPSG:4326",
+        transform=get_window_transform(window, scale),
+        nodata=nodata,
+        compress="zstd",
+        tiled=True,
+    )
+
+    with (
+        atomic_write(out_path) as temp_path,
+        rio.open(temp_path, "w", **profile) as out,
+    ):
+        for tile, path in tile_paths.items():
+            tile_window = get_tile_window(tile, tile_size)
+            overlap = window.intersection(tile_window)
+
+            with rio.open(path) as ds:
+                if ds.shape != (tile_size, tile_size):
+                    raise ValueError(f"{path} is not a {tile_size}px grid tile.")
+                data = ds.read(
+                    1,
+                    window=Window(
+                        overlap.col_off - tile_window.col_off,
+                        overlap.row_off - tile_window.row_off,
+                        overlap.width,
+                        overlap.height,
+                    ),
+                )
+
+            out.write(
+                data,
+                1,
+                window=Window(
+                    overlap.col_off - window.col_off,
+                    overlap.row_off - window.row_off,
+                    overlap.width,
+                    overlap.height,
+                ),
+            )
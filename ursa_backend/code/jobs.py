@@ -0,0 +1,208 @@
+import copy
+import json
+import os
+import threading
+import time
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Literal, Sequence, TypedDict
+from ursa_backend.code.cache import (
+    CacheSpec,
+    get_cache_key,
+    get_cache_path,
+    make_spec,
+)
+from ursa_backend.code.constants import DATA_PATH, JOB_STALE_AFTER, JOB_WORKERS
+from ursa_backend.code.cube import get_band_keys
+from ursa_backend.code.fetch import (
+    fetch_lst_rasters,
+    fetch_world_cover,
+    get_lst_cube_spec,
+    get_lst_months,
+    get_lst_specs,
+    get_world_cover_spec,
+)
+from ursa_backend.code.scheduler import Priority
+from ursa_backend.code.suhi import get_mean_suhi_path, get_mean_suhi_spec
+from ursa_backend.models import GeoTemporalRequestModel
+
+
+JobStatus = Literal["queued", "running", "completed", "failed"]
+MonthStatus = Literal["cached", "pending", "downloading", "done"]
+
+JOB_DATASET = "ursa/suhi_job"
+
+
+class JobRecord(TypedDict):
+    id: str
+    status: JobStatus
+    stage: str
+    request: dict
+    months: dict[str, MonthStatus]
+    error: str | None
+    created_at: float
+    updated_at: float
+
+
+_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="suhi-job")
+_jobs_lock = threading.Lock()
+
+
+def get_result_spec(
+    request: GeoTemporalRequestModel, months: Sequence[int]
+) -> CacheSpec:
+    """The result of a job is the cached mean SUHI raster of its request, computed from
+    the months with scenes given by `get_lst_months`."""
+    return get_mean_suhi_spec(
+        [get_cache_path(spec) for spec in get_lst_specs(request, months)],
+        get_cache_path(get_world_cover_spec(request)),
+    )
+
+
+def is_result_cached(request: GeoTemporalRequestModel) -> bool:
+    months = get_lst_months(request)
+    return get_cache_path(get_result_spec(request, months)).exists()
+
+
+def get_job_id(request: GeoTemporalRequestModel, months: Sequence[int]) -> str:
+    """Jobs are identified by their request and the months they fetch, so equal
+    requests share a job until new scenes enter the scene catalog."""
+    spec = make_spec(
+        JOB_DATASET,
+        request.get_bounds(),
+        scale=request.scale,
+        year=request.year,
+        season=request.season,
+        months=list(months),
+    )
+    return get_cache_key(spec)
+
+
+def get_job_path(job_id: str) -> Path:
+    return DATA_PATH / "jobs" / f"{job_id}.json"
+
+
+def get_job_result_path(job_id: str) -> Path | None:
+    """Returns the location of the result of a completed job, if it is still cached."""
+    job = read_job(job_id)
+    if job is None or job["status"] != "completed":
+        return None
+
+    request = GeoTemporalRequestModel(**job["request"])
+    months = [int(month) for month in job["months"]]
+    path = get_cache_path(get_result_spec(request, months))
+    return path if path.exists() else None
+
+
+def read_job(job_id: str) -> JobRecord | None:
+    try:
+        with open(get_job_path(job_id)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def _write_job(job: JobRecord) -> None:
+    path = get_job_path(job["id"])
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_name(f".{path.stem}.{uuid.uuid4().hex}.json")
+
+    job["updated_at"] = time.time()
+    with open(temp_path, "w") as f:
+        json.dump(job, f)
+    os.replace(temp_path, path)
+
+
+def _is_alive(job: JobRecord) -> bool:
+    return (
+        job["status"] in ("queued", "running")
+        and time.time() - job["updated_at"] < JOB_STALE_AFTER
+    )
+
+
+def submit_job(request: GeoTemporalRequestModel) -> JobRecord:
+    """Queues the computation of the mean SUHI raster of a request.
+
+    If the same request is already queued or running, its job is returned. If its
+    result is still cached, the job is returned as completed without recomputing it.
+
+    Parameters
+    ----------
+    request: GeoTemporalRequestModel
+        Bounding box, year and season to compute.
+
+    Returns
+    -------
+    JobRecord
+        Current state of the job.
+    """
+    months = get_lst_months(request)
+    job_id = get_job_id(request, months)
+
+    with _jobs_lock:
+        job = read_job(job_id)
+        if job is not None and (
+            _is_alive(job) or get_job_result_path(job_id) is not None
+        ):
+            return job
+
+        cached_keys = get_band_keys(get_cache_path(get_lst_cube_spec(request)))
+        month_status = {}
+        for spec in get_lst_specs(request, months):
+            month = str(spec["params"]["month"])
+            cached = get_cache_key(spec) in cached_keys
+            month_status[month] = "cached" if cached else "pending"
+
+        now = time.time()
+        job = JobRecord(
+            id=job_id,
+            status="queued",
+            stage="queued",
+            request=request.model_dump(),
+            months=month_status,
+            error=None,
+            created_at=now,
+            updated_at=now,
+        )
+        _write_job(job)
+
+    _executor.submit(run_job, copy.deepcopy(job))
+    return job
+
+
+def run_job(job: JobRecord) -> None:
+    """Downloads the inputs of a job and computes its result, recording the progress."""
+    request = GeoTemporalRequestModel(**job["request"])
+
+    def on_month(month: int) -> None:
+        if job["months"][str(month)] != "cached":
+            job["months"][str(month)] = "done"
+        _write_job(job)
+
+    try:
+        job.update(status="running", stage="downloading")
+        for month, status in job["months"].items():
+            if status == "pending":
+                job["months"][month] = "downloading"
+        _write_job(job)
+
+        months = [int(month) for month in job["months"]]
+        if not months:
+            raise ValueError("No measurements for given date and location found.")
+
+        world_cover_path = fetch_world_cover(request, Priority.BATCH)
+        monthly_temp_paths = fetch_lst_rasters(
+            request, Priority.BATCH, on_month=on_month, months=months
+        )
+
+        job.update(stage="computing")
+        _write_job(job)
+
+        get_mean_suhi_path(monthly_temp_paths, world_cover_path)
+        job.update(status="completed", stage="completed")
+    except Exception as exc:  # pylint: disable=broad-exception-caught
+        job.update(status="failed", stage="failed", error=str(exc))
+
+    _write_job(job)
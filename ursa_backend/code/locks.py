@@ -0,0 +1,59 @@
+import fcntl
+import threading
+
+from contextlib import contextmanager
+from typing import Generator
+from ursa_backend.code.constants import DATA_PATH
+
+
+_registry_lock = threading.Lock()
+_thread_locks: dict[str, tuple[threading.Lock, int]] = {}
+
+
+@contextmanager
+def _thread_lock(key: str) -> Generator[None, None, None]:
+    with _registry_lock:
+        lock, waiters = _thread_locks.get(key, (threading.Lock(), 0))
+        _thread_locks[key] = (lock, waiters + 1)
+
+    try:
+        with lock:
+            yield
+    finally:
+        with _registry_lock:
+            lock, waiters = _thread_locks[key]
+            if waiters == 1:
+                del _thread_locks[key]
+            else:
+                _thread_locks[key] = (lock, waiters - 1)
+
+
+@contextmanager
+def _file_lock(key: str) -> Generator[None, None, None]:
+    lock_path = DATA_PATH / "locks" / f"{key}.lock"
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+
+    with open(lock_path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+@contextmanager
+def single_flight(key: str) -> Generator[None, None, None]:
+    """Runs a block of code while holding an exclusive lock on a key.
+
+    The lock is held both against other threads of this process and against other
+    processes sharing the data directory, such as other uvicorn workers. Threads of
+    the same process queue on an in-memory lock first, so each process holds at most
+    one file lock per key.
+
+    Parameters
+    ----------
+    key: str
+        Key to lock, usually a cache key.
+    """
+    with _thread_lock(key), _file_lock(key):
+        yield
@@ -0,0 +1,270 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+
+import requests
+
+from collections import deque
+from concurrent.futures import Future
+from enum import IntEnum
+from typing import Any, Callable, TypedDict
+from ursa_backend.code.constants import (
+    DOWNLOAD_BACKOFF_BASE,
+    DOWNLOAD_BACKOFF_MAX,
+    DOWNLOAD_MAX_RETRIES,
+    DOWNLOAD_WORKERS,
+)
+
+
+# Rate limits and transient server errors
+RETRYABLE_STATUS_CODES = frozenset({408, 429, 500, 502, 503, 504})
+
+RETRYABLE_EXCEPTIONS = (
+    ConnectionError,
+    TimeoutError,
+    requests.ConnectionError,
+    requests.Timeout,
+)
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    BATCH = 10
+    PREFETCH = 20
+
+
+class SchedulerStats(TypedDict):
+    workers: int
+    running: int
+    queue_depth: int
+    queue_depth_by_priority: dict[str, int]
+    submitted: int
+    completed: int
+    failed: int
+    retries: int
+    mean_wait: float | None
+    max_wait: float | None
+
+
+class _Task:
+    def __init__(
+        self, fn: Callable, args: tuple, kwargs: dict, priority: Priority
+    ) -> None:
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.future = Future()
+        self.submitted_at = time.monotonic()
+
+
+def get_status_code(exc: BaseException) -> int | None:
+    """HTTP status code of an error raised by `requests` or by the Google API client
+    used by Earth Engine, if any."""
+    response = getattr(exc, "response", None)
+    status = getattr(response, "status_code", None)
+    if status is None:
+        status = getattr(getattr(exc, "resp", None), "status", None)
+    return status if isinstance(status, int) else None
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """Whether an exception raised by an Earth Engine call is worth retrying.
+
+    The exception and the exceptions it was raised from or while handling are checked
+    by type and by HTTP status code, never by message. The latter matter because
+    `ee.data` re-raises HTTP errors as `ee.EEException` without `from`.
+
+    Parameters
+    ----------
+    exc: BaseException
+        Exception to check.
+
+    Returns
+    -------
+    bool
+        True for network errors, timeouts, rate limits and transient server errors.
+    """
+    seen = set()
+    while exc is not None and id(exc) not in seen:
+        if isinstance(exc, RETRYABLE_EXCEPTIONS):
+            return True
+        if get_status_code(exc) in RETRYABLE_STATUS_CODES:
+            return True
+        seen.add(id(exc))
+        exc = exc.__cause__ or exc.__context__
+    return False
+
+
+def backoff_delay(attempt: int, *, base: float, max_delay: float) -> float:
+    """Exponential backoff with full jitter, in seconds."""
+    return random.uniform(0, min(max_delay, base * 2**attempt))
+
+
+class DownloadScheduler:
+    """Runs Earth Engine fetches on a bounded pool of worker threads.
+
+    Tasks are served by priority, and in submission order within a priority, so
+    interactive requests jump ahead of queued batch and prefetch work. Tasks that
+    fail with a retryable error are retried with jittered exponential backoff. The
+    worker sleeps through the backoff, which also lowers the effective concurrency
+    while Earth Engine is pushing back.
+
+    Parameters
+    ----------
+    max_workers: int
+        Maximum number of concurrent fetches.
+
+    max_retries: int
+        Maximum number of retries per task.
+
+    backoff_base: float
+        Base delay of the backoff, in seconds.
+
+    backoff_max: float
+        Maximum delay of the backoff, in seconds.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = DOWNLOAD_WORKERS,
+        *,
+        max_retries: int = DOWNLOAD_MAX_RETRIES,
+        backoff_base: float = DOWNLOAD_BACKOFF_BASE,
+        backoff_max: float = DOWNLOAD_BACKOFF_MAX,
+    ) -> None:
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self._queue: list[tuple[int, int, _Task]] = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._workers: list[threading.Thread] = []
+
+        self._running = 0
+        self._submitted = 0
+        self._completed = 0
+        self._failed = 0
+        self._retries = 0
+        self._waits: deque[float] = deque(maxlen=1000)
+
+    def _ensure_workers(self) -> None:
+        while len(self._workers) < self.max_workers:
+            worker = threading.Thread(
+                target=self._work, name="download-scheduler", daemon=True
+            )
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(
+        self,
+        fn: Callable,
+        *args: Any,
+        priority: Priority = Priority.INTERACTIVE,
+        **kwargs: Any,
+    ) -> Future:
+        """Queues a call to `fn(*args, **kwargs)`.
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Future with the result of the call.
+        """
+        task = _Task(fn, args, kwargs, priority)
+        with self._cond:
+            self._ensure_workers()
+            heapq.heappush(self._queue, (int(priority), next(self._counter), task))
+            self._submitted += 1
+            self._cond.notify()
+        return task.future
+
+    def run(
+        self,
+        fn: Callable,
+        *args: Any,
+        priority: Priority = Priority.INTERACTIVE,
+        **kwargs: Any,
+    ) -> Any:
+        """Queues a call to `fn(*args, **kwargs)` and blocks until it finishes."""
+        return self.submit(fn, *args, priority=priority, **kwargs).result()
+
+    def _work(self) -> None:
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                _, _, task = heapq.heappop(self._queue)
+                self._running += 1
+                self._waits.append(time.monotonic() - task.submitted_at)
+
+            if not task.future.set_running_or_notify_cancel():
+                with self._cond:
+                    self._running -= 1
+                continue
+
+            try:
+                result = self._call_with_retries(task)
+            except BaseException as exc:  # pylint: disable=broad-exception-caught
+                task.future.set_exception(exc)
+                with self._cond:
+                    self._failed += 1
+            else:
+                task.future.set_result(result)
+                with self._cond:
+                    self._completed += 1
+            finally:
+                with self._cond:
+                    self._running -= 1
+
+    def _call_with_retries(self, task: _Task) -> Any:
+        for attempt in range(self.max_retries + 1):
+            try:
+                return task.fn(*task.args, **task.kwargs)
+            except Exception as exc:  # pylint: disable=broad-exception-caught
+                if attempt == self.max_retries or not is_retryable(exc):
+                    raise
+                with self._cond:
+                    self._retries += 1
+                time.sleep(
+                    backoff_delay(
+                        attempt, base=self.backoff_base, max_delay=self.backoff_max
+                    )
+                )
+
+    def stats(self) -> SchedulerStats:
+        """Returns the queue depth, wait times and task counters of the scheduler."""
+        with self._cond:
+            depth_by_priority = {p.name.lower(): 0 for p in Priority}
+            for priority, _, _ in self._queue:
+                depth_by_priority[Priority(priority).name.lower()] += 1
+            waits = list(self._waits)
+
+            return SchedulerStats(
+                workers=self.max_workers,
+                running=self._running,
+                queue_depth=len(self._queue),
+                queue_depth_by_priority=depth_by_priority,
+                submitted=self._submitted,
+                completed=self._completed,
+                failed=self._failed,
+                retries=self._retries,
+                mean_wait=sum(waits) / len(waits) if waits else None,
+                max_wait=max(waits) if waits else None,
+            )
+
+
+_scheduler: DownloadScheduler | None = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> DownloadScheduler:
+    """Returns the download scheduler shared by every request of this process."""
+    global _scheduler  # pylint: disable=global-statement
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = DownloadScheduler()
+        return _scheduler
@@ -0,0 +1,160 @@
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import TypedDict
+from ursa_backend.code.constants import DOWNLOAD_WORKERS
+from ursa_backend.code.dates import season_to_months
+from ursa_backend.code.fetch import (
+    allocate_lst_cube,
+    fetch_lst_rasters,
+    fetch_world_cover,
+    get_lst_months,
+    prefetch_lst_tiles,
+)
+from ursa_backend.code.scheduler import Priority
+from ursa_backend.code.suhi import get_suhi_partial_paths, read_suhi_partial
+from ursa_backend.models import GeoTemporalRequestModel, TimeSeriesRequestModel
+
+
+class MonthlySeries(TypedDict):
+    year: list[int]
+    month: list[int]
+    rural: list[float]
+    urban: list[float]
+    suhi: list[float]
+    nan_fraction: list[float]
+
+
+class SeasonalSeries(TypedDict):
+    year: list[int]
+    season: list[str]
+    rural: list[float]
+    urban: list[float]
+    suhi: list[float]
+    months: list[int]
+
+
+class RuralTimeSeries(TypedDict):
+    monthly: MonthlySeries
+    seasonal: SeasonalSeries
+
+
+def get_year_request(
+    request: TimeSeriesRequestModel, year: int
+) -> GeoTemporalRequestModel:
+    return GeoTemporalRequestModel(
+        **request.model_dump(include={"xmin", "ymin", "xmax", "ymax", "scale"}),
+        year=year,
+        season="Qall",
+    )
+
+
+def get_rural_time_series(
+    request: TimeSeriesRequestModel,
+    *,
+    nan_thresh: float = 0.10,
+    priority: Priority = Priority.INTERACTIVE,
+) -> RuralTimeSeries:
+    """Calculates the rural and urban mean temperatures of every month of a range of
+    years, and their seasonal means.
+
+    The WorldCover masks are computed once for the whole range, and the years are
+    fetched in parallel. The temperatures are the reference temperatures stored in
+    the partial SUHI aggregates of each month, so months that were already processed
+    by other requests aren't read again.
+
+    Parameters
+    ----------
+    request: TimeSeriesRequestModel
+        Bounding box, range of years and seasons.
+
+    nan_thresh: float
+        Months with a larger fraction of missing pixels are NaN, and are left out of
+        the seasonal means.
+
+    priority: Priority
+        Priority of the downloads in the shared download scheduler.
+
+    Returns
+    -------
+    RuralTimeSeries
+        Monthly and seasonal series, as columns. SUHI intensity is the urban mean
+        minus the rural mean. Months without scenes are NaN.
+    """
+    years = list(range(request.start_year, request.end_year + 1))
+    months = sorted(
+        {month for season in request.seasons for month in season_to_months(season)}
+    )
+
+    year_requests = [get_year_request(request, year) for year in years]
+
+    def prefetch(year_request: GeoTemporalRequestModel) -> list[int]:
+        available = [
+            month for month in get_lst_months(year_request, priority) if month in months
+        ]
+        prefetch_lst_tiles(year_request, available, priority)
+        return available
+
+    # Every year shares the cube of the bounding box, so the tiles are downloaded in
+    # parallel first and written to the cube one year at a time
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as pool:
+        world_cover_future = pool.submit(fetch_world_cover, request, priority)
+        year_months = list(pool.map(prefetch, year_requests))
+        world_cover_path = world_cover_future.result()
+
+    # The cube grows once for the whole range, and each year fills its own bands
+    allocate_lst_cube(
+        request, [year for year, available in zip(years, year_months) if available]
+    )
+
+    # The partials of each year are computed in one stacked pass, which bounds the
+    # size of the stack to 12 months
+    partials = {}
+    for year_request, available in zip(year_requests, year_months):
+        if not available:
+            continue
+        raster_paths = fetch_lst_rasters(year_request, priority, months=available)
+        partial_paths = get_suhi_partial_paths(raster_paths, world_cover_path)
+        for month, partial_path in zip(available, partial_paths):
+            partials[year_request.year, month] = read_suhi_partial(partial_path)
+
+    monthly = MonthlySeries(
+        year=[], month=[], rural=[], urban=[], suhi=[], nan_fraction=[]
+    )
+    values = {}
+    for year in years:
+        for month in months:
+            partial = partials.get((year, month))
+            nan_fraction = np.nan if partial is None else partial["nan_fraction"]
+            rural, urban = np.nan, np.nan
+            if partial is not None and nan_fraction <= nan_thresh:
+                rural, urban = partial["rural_temp"], partial["urban_temp"]
+            values[year, month] = (rural, urban)
+
+            monthly["year"].append(year)
+            monthly["month"].append(month)
+            monthly["rural"].append(rural)
+            monthly["urban"].append(urban)
+            monthly["suhi"].append(urban - rural)
+            monthly["nan_fraction"].append(nan_fraction)
+
+    seasonal = SeasonalSeries(
+        year=[], season=[], rural=[], urban=[], suhi=[], months=[]
+    )
+    for year in years:
+        for season in request.seasons:
+            rural, urban = np.array(
+                [values[year, month] for month in season_to_months(season)]
+            ).T
+            valid = ~np.isnan(rural) & ~np.isnan(urban)
+            rural_mean = rural[valid].mean() if valid.any() else np.nan
+            urban_mean = urban[valid].mean() if valid.any() else np.nan
+
+            seasonal["year"].append(year)
+            seasonal["season"].append(season)
+            seasonal["rural"].append(float(rural_mean))
+            seasonal["urban"].append(float(urban_mean))
+            seasonal["suhi"].append(float(urban_mean - rural_mean))
+            seasonal["months"].append(int(valid.sum()))
+
+    return RuralTimeSeries(monthly=monthly, seasonal=seasonal)
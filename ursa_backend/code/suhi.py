@@ -1,28 +1,68 @@
+import contextlib
 import ee
+import functools
 import os
-import rasterio.mask  # pylint: disable=unused-import
-import shapely
 
-import geopandas as gpd
-import matplotlib.colors as mcol
 import numpy as np
 import rasterio as rio
 
 from affine import Affine
-from rasterio.io import MemoryFile
 from scipy.interpolate import make_smoothing_spline
-from typing import Sequence
-from ursa_backend.code.constants import LST_CAT_NODATA
-from ursa_backend.code.fs import raster_generator
+from pathlib import Path
+from rasterio.windows import Window
+from typing import Generator, Sequence, TypedDict
+from ursa_backend.code.arrays import read_shared_raster
+from ursa_backend.code.common import get_color_bounds, histogram_quantile
+from ursa_backend.code.cache import (
+    CacheSpec,
+    get_cache_key,
+    get_cache_path,
+    get_or_create,
+    get_or_create_many,
+    make_derived_spec,
+)
+from ursa_backend.code.constants import (
+    LST_CAT_NODATA,
+    LST_DATASET,
+    RADIAL_PDF_LAM,
+    RADIAL_RING_WIDTH,
+    RURAL_BUFFER_SIZE,
+    WANTED_WORLDCOVER_LABELS,
+    WINDOWED_MIN_PIXELS,
+    WINDOW_BLOCK_SIZE,
+)
+from ursa_backend.code.dates import get_date_range
+from ursa_backend.code.fs import (
+    atomic_write,
+    build_overviews,
+    get_float32_profile,
+    iter_windows,
+    open_bands,
+    read_band_stack,
+)
 from ursa_backend.code.geometry import (
-    generate_circles,
-    generate_rings,
-    overlay_geometries,
+    get_pixel_centers,
+    get_raster_corners,
+    project_points,
 )
-from ursa_backend.code.world_cover import load_cover_and_masks
+from ursa_backend.code.tiles import get_overview_resolutions
+from ursa_backend.code.world_cover import (
+    get_cached_masks_path,
+    get_masks_spec,
+    load_cached_masks,
+)
+from ursa_backend.code.zonal import get_zonal_stats
 from ursa_backend.models import RasterResponseModel
 
 
+class CoverCategoryStats(TypedDict):
+    cover: list[int]
+    count: list[int]
+    mean: list[float]
+    median: list[float]
+    categories: dict[str, list[float]]
+
+
 def fmask(image: ee.Image) -> ee.Image:
     """Calculates the cloud mask for a Landsat image.
 
@@ -50,9 +90,14 @@ def fmask(image: ee.Image) -> ee.Image:
     return image.updateMask(mask)
 
 
-def get_lst(bbox_ee: ee.Geometry.Polygon, start_date: str, end_date: str) -> ee.Image:
+def get_monthly_lst(
+    bbox_ee: ee.Geometry.Polygon, start_date: str, end_date: str
+) -> ee.Image:
     """Calculates the average Land Surface Temperature for a given region and date range.
 
+    Earth Engine isn't queried for the number of scenes, which is known in advance
+    from the scene catalog. If there are none, the result is a fully masked image.
+
     Parameters
     ----------
     bbox_ee: ee.Geometry.Polygon
@@ -67,26 +112,54 @@ def get_lst(bbox_ee: ee.Geometry.Polygon, start_date: str, end_date: str) -> ee.
     Returns
     -------
     ee.Image
-        LST image.
+        Single band float LST image.
     """
-
     filtered: ee.ImageCollection = (
-        ee.ImageCollection("LANDSAT/LC09/C02/T1_L2")
+        ee.ImageCollection(LST_DATASET)
         .filterDate(start_date, end_date)
         .filterBounds(bbox_ee)
     )
+    empty = ee.Image.constant(0).rename("ST_B10").updateMask(0)
+    composite = ee.Image(
+        ee.Algorithms.If(
+            filtered.size().gt(0),
+            filtered.map(fmask).select("ST_B10").mean(),
+            empty,
+        )
+    )
 
-    if filtered.size().getInfo() == 0:
-        raise ValueError("No measurements for given date and location found.")
+    return composite.multiply(0.00341802).add(149 - 273.15).toFloat().clip(bbox_ee)
 
-    return (
-        filtered.map(fmask)
-        .select("ST_B10")
-        .mean()
-        .multiply(0.00341802)
-        .add(149 - 273.15)
-        .clip(bbox_ee)
-    )
+
+def get_lst_stack(
+    bbox_ee: ee.Geometry.Polygon, year: int, months: Sequence[int]
+) -> ee.Image:
+    """Builds a multi-band image with the average Land Surface Temperature of each month.
+
+    Parameters
+    ----------
+    bbox_ee: ee.Geometry.Polygon
+        Region of interest.
+
+    year: int
+        Year to analyze.
+
+    months: Sequence[int]
+        Months to include, starting from 1 (January).
+
+    Returns
+    -------
+    ee.Image
+        Image with one band per month, in the same order as `months`, named
+        `{year}_{month}` with a zero-padded month. Months without measurements are
+        fully masked.
+    """
+    bands = []
+    for month in months:
+        start_date, end_date = get_date_range(month, year)
+        band_name = f"{year}_{str(month).rjust(2, '0')}"
+        bands.append(get_monthly_lst(bbox_ee, start_date, end_date).rename(band_name))
+    return ee.Image.cat(bands)
 
 
 def get_raster_stats(data: np.ndarray) -> tuple[float, float]:
@@ -99,181 +172,775 @@ def get_raster_stats(data: np.ndarray) -> tuple[float, float]:
 def discretize_array(
     arr: np.ndarray, n_pairs: int, *, nodata: float
 ) -> np.ndarray[int]:
-    mu, sigma = get_raster_stats(arr)
+    """Classifies a raster by its distance to the mean, in standard deviations.
 
-    bounds = []
-    labels = []
-    for i in range(n_pairs):
-        scale = i + 0.5
-        bounds.append(mu + sigma * scale)
-        bounds.append(mu - sigma * scale)
-        labels.append(i + 1)
-        labels.append(-(i + 1))
-
-    bounds = sorted(bounds)
-
-    # Do not change order
-    labels.append(0)
-    labels = sorted(labels)
-    labels.append(nodata)
-
-    nan_color = 2 * n_pairs
-    colors = (
-        [-1]  # below
-        + list(range(1, (n_pairs - 1) * 2 + 2))
-        + [2 * n_pairs + 1]  # above
-        + [nan_color]  # nodata
-    )
+    Pixels within half a standard deviation of the mean get category 0, the next
+    bands get 1 and -1, and so on up to `n_pairs` and `-n_pairs`, which also
+    include everything beyond them. The category of every pixel is found with a
+    single binary search and a lookup table.
+
+    Parameters
+    ----------
+    arr: np.ndarray
+        Raster data. NaN values are treated as missing.
 
-    norm = mcol.BoundaryNorm(bounds, 2 * n_pairs + 1, extend="both")
-    arr_normalized = norm(arr)
+    n_pairs: int
+        Number of categories on each side of the mean.
+
+    nodata: float
+        Category of missing pixels. Must fit in an int8.
+
+    Returns
+    -------
+    np.ndarray[int]
+        Int8 array with the category of each pixel.
+    """
+    mu, sigma = get_raster_stats(arr)
 
-    out = np.zeros_like(arr, dtype=np.int8)
-    for label, color in zip(labels, colors):
-        out += (arr_normalized == color) * label
+    # NaN sorts after +inf, so missing pixels land in the last slot of the table
+    bounds = np.append(mu + sigma * (np.arange(-n_pairs, n_pairs) + 0.5), np.inf)
+    lut = np.append(np.arange(-n_pairs, n_pairs + 1), nodata).astype(np.int8)
 
-    return out
+    return lut[np.searchsorted(bounds, arr, side="right")]
 
 
 def generate_categorical_raster(
-    cont_raster_path: os.PathLike, cat_raster_path: os.PathLike
+    cont_raster_path: os.PathLike,
+    cat_raster_path: os.PathLike,
+    *,
+    n_pairs: int = 3,
 ) -> None:
-    n_color_pairs = 3
+    """Writes the categories of a continuous raster, as given by `discretize_array`.
+
+    The file is written under a temporary name and moved into place with an atomic
+    rename.
+
+    Parameters
+    ----------
+    cont_raster_path: os.PathLike
+        Path of the continuous raster.
+
+    cat_raster_path: os.PathLike
+        Output path.
 
+    n_pairs: int
+        Number of categories on each side of the mean.
+    """
     with rio.open(cont_raster_path) as ds:
-        data = np.squeeze(ds.read(1))
+        data = np.squeeze(ds.read(1, masked=True).filled(np.nan))
         profile = ds.profile
-    data[data == profile["nodata"]] = np.nan
 
-    data_cat = discretize_array(data, n_color_pairs, nodata=LST_CAT_NODATA)
+    data_cat = discretize_array(data, n_pairs, nodata=LST_CAT_NODATA)
+
+    profile.update(nodata=LST_CAT_NODATA, dtype="int8", predictor=2)
+    with atomic_write(cat_raster_path) as temp_path:
+        with rio.open(temp_path, "w", **profile) as ds:
+            ds.write(data_cat, 1)
+
+
+class SuhiPartial(TypedDict):
+    rural_temp: float
+    urban_temp: float
+    offset: float
+    nan_fraction: float
+
 
-    profile.update(nodata=LST_CAT_NODATA, dtype="int8")
-    with rio.open(cat_raster_path, "w", **profile) as ds:
-        ds.write(data_cat, 1)
+def get_stack_references(
+    temps: np.ndarray, urban: np.ndarray, rural: np.ndarray
+) -> dict[str, np.ndarray]:
+    """Accumulates the statistics needed for the reference temperature of every month
+    of a stack, with masked reductions over each month.
 
+    Parameters
+    ----------
+    temps: np.ndarray
+        LST stack, with shape (months, height, width) and NaN as nodata.
+
+    urban: np.ndarray
+        Boolean urban mask, with shape (height, width).
+
+    rural: np.ndarray
+        Boolean rural mask, with shape (height, width).
+
+    Returns
+    -------
+    dict[str, np.ndarray]
+        Missing pixel count, rural and urban sums and counts, and urban minimum and
+        maximum, as arrays with one value per month.
+    """
+    axes = (1, 2)
+    valid = ~np.isnan(temps)
+    nan_count = temps[0].size - np.count_nonzero(valid, axis=axes)
+    rural_valid = np.logical_and(valid, rural)
+    urban_valid = np.logical_and(valid, urban, out=valid)
+    return dict(
+        nan_count=nan_count,
+        rural_sum=np.sum(temps, axis=axes, where=rural_valid, dtype=np.float64),
+        rural_count=np.count_nonzero(rural_valid, axis=axes),
+        urban_sum=np.sum(temps, axis=axes, where=urban_valid, dtype=np.float64),
+        urban_count=np.count_nonzero(urban_valid, axis=axes),
+        urban_min=np.min(temps, axis=axes, where=urban_valid, initial=np.inf),
+        urban_max=np.max(temps, axis=axes, where=urban_valid, initial=-np.inf),
+    )
+
+
+def generate_suhi_partials(
+    raster_paths: Sequence[os.PathLike],
+    world_cover_path: os.PathLike,
+    out_paths: Sequence[os.PathLike],
+    *,
+    buffer_size: float = RURAL_BUFFER_SIZE,
+    block_size: int = WINDOW_BLOCK_SIZE,
+    percentile_bins: int = 2**16,
+) -> None:
+    """Computes the partial SUHI aggregates of several months and writes them to files.
+
+    Each partial is a single-band GeoTIFF, described as `suhi`, with the LST of the
+    month minus its reference temperature, and 0 where the LST is missing. Its tags
+    are the fields of `SuhiPartial`: the rural and urban mean temperatures, the
+    reference temperature (`offset`) and the fraction of missing pixels. The mean
+    SUHI of any set of months adds up their partials, so each month is only
+    processed once.
+
+    The months are read together as a (months, height, width) stack, block by block,
+    and every statistic is computed for all of them at once. A first pass
+    accumulates the missing pixel counts and the rural and urban sums. When the
+    urban mean of a month is colder than the rural one, its reference is the 5th
+    percentile of its urban temperatures. It is exact when the stack fits in a
+    single block, and estimated from a histogram with `percentile_bins` bins in an
+    extra pass otherwise.
+
+    Parameters
+    ----------
+    raster_paths: Sequence[os.PathLike]
+        Paths of the monthly LST rasters. They must be aligned with the WorldCover
+        raster.
+
+    world_cover_path: os.PathLike
+        Path of the WorldCover raster.
+
+    out_paths: Sequence[os.PathLike]
+        Output path of the partial of each month. The files are published
+        atomically.
+
+    buffer_size: float
+        Distance, in meters, from urban pixels within which pixels are not rural.
+
+    block_size: int
+        Height and width of each block. Stacks with fewer than `WINDOWED_MIN_PIXELS`
+        pixels are read at once.
+
+    percentile_bins: int
+        Number of bins of the histograms used to estimate percentiles.
+    """
+    masks_path = get_cached_masks_path(
+        world_cover_path, buffer_size=buffer_size, block_size=block_size
+    )
+
+    with (
+        rio.open(masks_path) as masks_ds,
+        open_bands(raster_paths) as bands,
+        contextlib.ExitStack() as stack,
+    ):
+        for ds, _ in bands:
+            if ds.shape != masks_ds.shape or ds.transform != masks_ds.transform:
+                raise ValueError(f"{ds.name} is not aligned with the cover raster.")
+
+        n = len(bands)
+        height, width = masks_ds.shape
+        if n * height * width < WINDOWED_MIN_PIXELS:
+            block_size = max(height, width)
+        windows = list(iter_windows(height, width, block_size))
+
+        def read_blocks() -> (
+            Generator[tuple[Window, np.ndarray, np.ndarray, np.ndarray], None, None]
+        ):
+            for window in windows:
+                urban, rural = masks_ds.read((1, 2), window=window).view(bool)
+                yield window, urban, rural, read_band_stack(bands, window=window)
+
+        totals = None
+        single_block = None
+        for _, urban, rural, temps in read_blocks():
+            if len(windows) == 1:
+                # Kept for the percentiles, so the only block isn't read again
+                single_block = urban, temps
+            refs = get_stack_references(temps, urban, rural)
+            if totals is None:
+                totals = refs
+                continue
+            for key in (
+                "nan_count",
+                "rural_sum",
+                "rural_count",
+                "urban_sum",
+                "urban_count",
+            ):
+                totals[key] += refs[key]
+            totals["urban_min"] = np.minimum(totals["urban_min"], refs["urban_min"])
+            totals["urban_max"] = np.maximum(totals["urban_max"], refs["urban_max"])
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            rural_temp = totals["rural_sum"] / totals["rural_count"]
+            urban_temp = totals["urban_sum"] / totals["urban_count"]
+
+        offsets = rural_temp.copy()
+        colder = np.flatnonzero(urban_temp < rural_temp)
+        if colder.size > 0 and single_block is not None:
+            block_urban, block_temps = single_block
+            colder_temps = block_temps[colder]
+            urban_temps = np.where(
+                block_urban & ~np.isnan(colder_temps), colder_temps, np.nan
+            )
+            offsets[colder] = np.nanpercentile(urban_temps, 5, axis=(1, 2))
+        elif colder.size > 0:
+            edges = {
+                i: np.linspace(
+                    totals["urban_min"][i], totals["urban_max"][i], percentile_bins + 1
+                )
+                for i in colder
+            }
+            hists = {i: np.zeros(percentile_bins, dtype=np.int64) for i in colder}
+            for _, urban, _, temps in read_blocks():
+                for i in colder:
+                    urban_pixels = temps[i][urban & ~np.isnan(temps[i])]
+                    hists[i] += np.histogram(urban_pixels, bins=edges[i])[0]
+            for i in colder:
+                offsets[i] = histogram_quantile(hists[i], edges[i], 0.05)
+
+        profile = get_float32_profile(
+            height, width, crs=masks_ds.crs, transform=masks_ds.transform
+        )
+        outs = []
+        for out_path in out_paths:
+            temp_path = stack.enter_context(atomic_write(out_path))
+            outs.append(stack.enter_context(rio.open(temp_path, "w", **profile)))
+
+        for window, _, _, temps in read_blocks():
+            temps -= offsets[:, None, None].astype(np.float32)
+            np.nan_to_num(temps, copy=False, nan=0)
+            for out, suhi in zip(outs, temps):
+                out.write(suhi, 1, window=window)
+
+        nan_fraction = totals["nan_count"] / (height * width)
+        for i, out in enumerate(outs):
+            out.set_band_description(1, "suhi")
+            out.update_tags(
+                rural_temp=float(rural_temp[i]),
+                urban_temp=float(urban_temp[i]),
+                offset=float(offsets[i]),
+                nan_fraction=float(nan_fraction[i]),
+            )
+
+
+def read_suhi_partial(path: os.PathLike) -> SuhiPartial:
+    """Reads the reference temperatures stored in the tags of a partial aggregate."""
+    with rio.open(path) as ds:
+        tags = ds.tags()
+    return SuhiPartial(**{key: float(tags[key]) for key in SuhiPartial.__annotations__})
+
+
+def get_masks_input(
+    world_cover_path: os.PathLike, *, buffer_size: float = RURAL_BUFFER_SIZE
+) -> Path:
+    """Input that identifies the masks of a cover raster in the specs of the SUHI
+    artifacts computed from them."""
+    return get_cache_path(get_masks_spec(world_cover_path, buffer_size=buffer_size))
+
+
+def get_suhi_partial_paths(
+    raster_paths: Sequence[os.PathLike],
+    world_cover_path: os.PathLike,
+    *,
+    buffer_size: float = RURAL_BUFFER_SIZE,
+) -> list[Path]:
+    """Locations of the cached partial SUHI aggregates of several months, computing
+    the missing ones in a single stacked pass. Months are identified by the cache
+    keys of their rasters, so a partial is shared by every season and year range that
+    includes its month."""
+    masks_input = get_masks_input(world_cover_path, buffer_size=buffer_size)
+
+    inputs = {}
+    specs = []
+    for raster_path in raster_paths:
+        spec = make_derived_spec("suhi_partial", [raster_path, masks_input])
+        inputs[get_cache_key(spec)] = raster_path
+        specs.append(spec)
+
+    def create(pending: list[tuple[CacheSpec, Path]]) -> None:
+        generate_suhi_partials(
+            [inputs[get_cache_key(spec)] for spec, _ in pending],
+            world_cover_path,
+            [path for _, path in pending],
+            buffer_size=buffer_size,
+        )
+
+    return get_or_create_many(specs, create)
+
+
+def compose_mean_suhi_raster(
+    partial_paths: Sequence[os.PathLike],
+    out_path: os.PathLike,
+    *,
+    nan_thresh: float = 0.15,
+    block_size: int = WINDOW_BLOCK_SIZE,
+) -> None:
+    """Writes the mean SUHI raster of several months by adding up their partial
+    aggregates, block by block.
+
+    Parameters
+    ----------
+    partial_paths: Sequence[os.PathLike]
+        Paths of the partial aggregates of the months, as given by
+        `get_suhi_partial_paths`.
+
+    out_path: os.PathLike
+        Output path. The file is published atomically.
+
+    nan_thresh: float
+        Months with a larger fraction of missing pixels are skipped.
+
+    block_size: int
+        Height and width of each block.
+    """
+    included = [
+        path
+        for path in partial_paths
+        if read_suhi_partial(path)["nan_fraction"] <= nan_thresh
+    ]
+    if not included:
+        raise ValueError("Every month has too many missing pixels.")
+
+    with contextlib.ExitStack() as stack:
+        partials = [stack.enter_context(rio.open(path)) for path in included]
+        first = partials[0]
+        for ds in partials:
+            if ds.shape != first.shape or ds.transform != first.transform:
+                raise ValueError(f"{ds.name} is not aligned with {first.name}.")
+
+        profile = get_float32_profile(
+            first.height, first.width, crs=first.crs, transform=first.transform
+        )
+        with (
+            atomic_write(out_path) as temp_path,
+            rio.open(temp_path, "w", **profile) as out,
+        ):
+            for window in iter_windows(first.height, first.width, block_size):
+                mean_suhi_block = np.zeros(
+                    (int(window.height), int(window.width)), dtype=np.float32
+                )
+                for ds in partials:
+                    mean_suhi_block += ds.read(1, window=window)
+                mean_suhi_block /= len(partials)
+                out.write(mean_suhi_block, 1, window=window)
+            build_overviews(out)
+
+
+def get_mean_suhi_spec(
+    raster_paths: Sequence[os.PathLike],
+    world_cover_path: os.PathLike,
+    *,
+    nan_thresh: float = 0.15,
+    buffer_size: float = RURAL_BUFFER_SIZE,
+) -> CacheSpec:
+    return make_derived_spec(
+        "mean_suhi",
+        [*raster_paths, get_masks_input(world_cover_path, buffer_size=buffer_size)],
+        nan_thresh=nan_thresh,
+    )
 
-def generate_suhi_raster(
-    temp: np.ndarray, rural_mask: np.ndarray, urban_mask: np.ndarray
-) -> np.ndarray:
-    rural_pixels = temp[rural_mask]
-    rural_pixels = rural_pixels[~np.isnan(rural_pixels)]
 
-    urban_pixels = temp[urban_mask]
-    urban_pixels = urban_pixels[~np.isnan(urban_pixels)]
+def get_mean_suhi_path(
+    raster_paths: Sequence[os.PathLike],
+    world_cover_path: os.PathLike,
+    *,
+    nan_thresh: float = 0.15,
+    buffer_size: float = RURAL_BUFFER_SIZE,
+) -> Path:
+    """Location of the cached mean SUHI raster, computing it if needed.
 
-    rural_temp = np.mean(rural_pixels)
-    urban_temp = np.mean(urban_pixels)
+    The mean is composed from the partial aggregates of the months, so only the
+    months that have never been processed are read from their LST rasters.
+    """
+    spec = get_mean_suhi_spec(
+        raster_paths, world_cover_path, nan_thresh=nan_thresh, buffer_size=buffer_size
+    )
 
-    if urban_temp >= rural_temp:
-        offset_temp = rural_temp
-    else:
-        offset_temp = np.percentile(urban_pixels, 5)
+    def compute(path: os.PathLike) -> None:
+        partial_paths = get_suhi_partial_paths(
+            raster_paths, world_cover_path, buffer_size=buffer_size
+        )
+        compose_mean_suhi_raster(partial_paths, path, nan_thresh=nan_thresh)
 
-    return temp - offset_temp
+    return get_or_create(spec, compute)
 
 
-def generate_mean_suhi_raster(
-    raster_paths: Sequence[os.PathLike], world_cover_path: os.PathLike
+def load_mean_suhi_raster(
+    raster_paths: Sequence[os.PathLike],
+    world_cover_path: os.PathLike,
+    *,
+    nan_thresh: float = 0.15,
+    buffer_size: float = RURAL_BUFFER_SIZE,
+    overview_level: int | None = None,
 ) -> RasterResponseModel:
-    mask_map = load_cover_and_masks(world_cover_path, rural=True, urban=True)
+    """Loads the mean SUHI raster from the cache, computing it if needed.
 
-    mean_suhi_raster = np.zeros(mask_map["rural"].shape, dtype=float)
-    counter = 0
-    crs, transform = None, None
-    for elem in raster_generator(raster_paths, nan_thresh=0.15):
-        if elem is None:
-            continue
+    Parameters
+    ----------
+    raster_paths: Sequence[os.PathLike]
+        Paths of the monthly LST rasters.
 
-        arr = np.array(elem.data)
-        suhi_raster = generate_suhi_raster(arr, mask_map["rural"], mask_map["urban"])
-        suhi_raster[np.isnan(suhi_raster)] = 0
-        mean_suhi_raster += suhi_raster
-        counter += 1
+    world_cover_path: os.PathLike
+        Path of the WorldCover raster.
 
-        if crs is not None:
-            assert crs == elem.crs
+    nan_thresh: float
+        Months with a larger fraction of missing pixels are skipped.
 
-        if transform is not None:
-            assert transform == elem.transform
+    buffer_size: float
+        Distance, in meters, from urban pixels within which pixels are not rural.
 
-        crs = elem.crs
-        transform = elem.transform
+    overview_level: int | None
+        If given, one of the overviews of the raster is loaded instead of the full
+        resolution data. 0 is the finest overview.
 
-    return RasterResponseModel(
-        data=mean_suhi_raster / counter, crs=crs, transform=transform
+    Returns
+    -------
+    RasterResponseModel
+        Mean SUHI raster. Its data is shared between worker processes with
+        `read_shared_raster`, and is read-only.
+    """
+    return read_shared_raster(
+        get_mean_suhi_path(
+            raster_paths,
+            world_cover_path,
+            nan_thresh=nan_thresh,
+            buffer_size=buffer_size,
+        ),
+        overview_level=overview_level,
     )
 
 
+def get_categorical_path(
+    raster_paths: Sequence[os.PathLike],
+    world_cover_path: os.PathLike,
+    *,
+    n_pairs: int = 3,
+) -> Path:
+    """Location of the cached categories of the mean SUHI raster, computing them if
+    needed.
+
+    Parameters
+    ----------
+    raster_paths: Sequence[os.PathLike]
+        Paths of the monthly LST rasters.
+
+    world_cover_path: os.PathLike
+        Path of the WorldCover raster.
+
+    n_pairs: int
+        Number of categories on each side of the mean.
+
+    Returns
+    -------
+    Path
+        Path of an int8 raster with `LST_CAT_NODATA` as nodata.
+    """
+    mean_path = get_mean_suhi_path(raster_paths, world_cover_path)
+    spec = make_derived_spec("suhi_categories", [mean_path], n_pairs=n_pairs)
+    return get_or_create(
+        spec,
+        lambda path: generate_categorical_raster(mean_path, path, n_pairs=n_pairs),
+    )
+
+
+def get_cover_category_stats(
+    raster_paths: Sequence[os.PathLike],
+    world_cover_path: os.PathLike,
+    *,
+    n_pairs: int = 3,
+) -> CoverCategoryStats:
+    """Summarizes the mean SUHI raster and its categories by land cover class.
+
+    Parameters
+    ----------
+    raster_paths: Sequence[os.PathLike]
+        Paths of the monthly LST rasters.
+
+    world_cover_path: os.PathLike
+        Path of the WorldCover raster.
+
+    n_pairs: int
+        Number of categories on each side of the mean.
+
+    Returns
+    -------
+    CoverCategoryStats
+        Statistics of each WorldCover class, as columns in the order of
+        `WANTED_WORLDCOVER_LABELS`. `categories` maps each category to the fraction
+        of the valid pixels of each class that fall in it.
+    """
+    cat_path = get_categorical_path(raster_paths, world_cover_path, n_pairs=n_pairs)
+    suhi = load_mean_suhi_raster(raster_paths, world_cover_path)
+    cover = load_cached_masks(world_cover_path)["cover"]
+    with rio.open(cat_path) as ds:
+        cat = ds.read(1)
+
+    n_classes = len(WANTED_WORLDCOVER_LABELS)
+    cover_lut = np.zeros(256, dtype=np.uint8)
+    cover_lut[list(WANTED_WORLDCOVER_LABELS)] = np.arange(1, n_classes + 1)
+    labels = cover_lut[cover]
+
+    stats = get_zonal_stats(suhi.data, labels, n_classes, percentiles=())
+
+    valid = (labels > 0) & (cat != LST_CAT_NODATA)
+    n_cats = 2 * n_pairs + 1
+    counts = np.bincount(
+        (labels[valid].astype(np.int64) - 1) * n_cats + cat[valid] + n_pairs,
+        minlength=n_classes * n_cats,
+    ).reshape(n_classes, n_cats)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        fractions = counts / counts.sum(axis=1, keepdims=True)
+
+    return CoverCategoryStats(
+        cover=list(WANTED_WORLDCOVER_LABELS),
+        count=stats["count"].tolist(),
+        mean=stats["mean"].tolist(),
+        median=stats["median"].tolist(),
+        categories={
+            str(c): fractions[:, c + n_pairs].tolist()
+            for c in range(-n_pairs, n_pairs + 1)
+        },
+    )
+
+
+@functools.lru_cache(maxsize=8)
+def get_cached_overview_resolutions(
+    raster_paths: tuple[Path, ...], world_cover_path: Path
+) -> tuple[float, ...]:
+    """Pixel sizes of the mean SUHI raster and its overviews, used to pick the level
+    that map tiles are rendered from."""
+    mean_path = get_mean_suhi_path(raster_paths, world_cover_path)
+    return tuple(get_overview_resolutions(mean_path))
+
+
+@functools.lru_cache(maxsize=8)
+def get_cached_color_bounds(
+    raster_paths: tuple[Path, ...], world_cover_path: Path
+) -> tuple[float, float]:
+    """Bounds of the color scale of the mean SUHI raster, used to render map tiles."""
+    raster = load_mean_suhi_raster(raster_paths, world_cover_path)
+    return get_color_bounds(raster.data)
+
+
 def get_rural_temps(
-    raster_paths: Sequence[os.PathLike], world_cover_path: os.PathLike
+    raster_paths: Sequence[os.PathLike],
+    world_cover_path: os.PathLike,
+    *,
+    nan_thresh: float = 0.10,
 ) -> list[float]:
-    rural_mask = load_cover_and_masks(world_cover_path, rural=True)["rural"]
+    """Mean rural temperature of each month, read from their partial aggregates.
+    Months with a larger fraction of missing pixels than `nan_thresh` are NaN."""
     rural_temps = []
-    for temp in raster_generator(raster_paths, nan_thresh=0.10):
-        if temp is None:
+    for partial_path in get_suhi_partial_paths(raster_paths, world_cover_path):
+        partial = read_suhi_partial(partial_path)
+        if partial["nan_fraction"] > nan_thresh:
             rural_temps.append(np.nan)
         else:
-            data = np.array(temp.data)
-            rural_temps.append(np.nanmean(data[rural_mask]))
+            rural_temps.append(partial["rural_temp"])
     return rural_temps
 
 
-def get_radial_cdf(
-    raster_response: RasterResponseModel, center: tuple[float, float]
-) -> list[float]:
-    arr = np.array(raster_response.data)
-    center_mollweide = (
-        gpd.GeoSeries([shapely.Point(*center)], crs="EPSG:4326")
-        .to_crs("ESRI:54009")
-        .item()
+def get_radial_bins(distances: np.ndarray, ring_width: float) -> np.ndarray:
+    """Index of the ring each pixel belongs to. Ring `i` spans `(i * w, (i + 1) * w]`."""
+    return np.maximum(np.ceil(distances / ring_width).astype(np.int64) - 1, 0)
+
+
+def get_radial_profile(
+    values: np.ndarray,
+    distances: np.ndarray,
+    *,
+    ring_width: float,
+    max_distance: float,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Calculates the mean of a raster over concentric rings in a single pass.
+
+    Parameters
+    ----------
+    values: np.ndarray
+        Raster data. NaN values are ignored.
+
+    distances: np.ndarray
+        Distance from each pixel center to the center of the rings.
+
+    ring_width: float
+        Width of each ring, in the units of `distances`.
+
+    max_distance: float
+        Rings are generated until one of them reaches this distance.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        Inner radius of each ring, and the mean value of the pixels inside it. The
+        innermost disc is not included. Rings without valid pixels have a NaN mean.
+    """
+    n_bins = max(int(np.ceil(max_distance / ring_width)), 1)
+
+    valid = ~np.isnan(values)
+    bins = get_radial_bins(distances[valid], ring_width)
+    in_range = bins < n_bins
+    bins = bins[in_range]
+
+    sums = np.bincount(bins, weights=values[valid][in_range], minlength=n_bins)
+    counts = np.bincount(bins, minlength=n_bins)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / counts
+
+    radii = ring_width * np.arange(1, n_bins)
+    return radii, means[1:]
+
+
+def get_radial_profiles(
+    raster_response: RasterResponseModel,
+    centers: Sequence[tuple[float, float]],
+    *,
+    max_radii: Sequence[float | None] | None = None,
+    ring_width: float = RADIAL_RING_WIDTH,
+) -> Generator[tuple[list[float], list[float]], None, None]:
+    """Calculates the radial profile of a raster around many points.
+
+    The pixel centers of the raster are projected once and shared by every profile,
+    and only valid pixels are binned. Profiles are yielded in the order of `centers`.
+
+    Parameters
+    ----------
+    raster_response: RasterResponseModel
+        Raster to analyze.
+
+    centers: Sequence[tuple[float, float]]
+        Longitude and latitude of the center of each profile.
+
+    max_radii: Sequence[float | None] | None
+        Maximum radius of each profile, in meters. Profiles without one are
+        computed until a ring contains the whole raster.
+
+    ring_width: float
+        Width of each ring, in meters.
+
+    Yields
+    ------
+    tuple[list[float], list[float]]
+        Inner radius and mean value of each ring of a profile.
+    """
+    arr = raster_response.data
+    transform = Affine(*raster_response.transform[:6])
+    if max_radii is None:
+        max_radii = [None] * len(centers)
+
+    valid = ~np.isnan(arr)
+    values = arr[valid]
+    x, y = get_pixel_centers(
+        transform, arr.shape, crs=raster_response.crs, dst_crs="ESRI:54009"
     )
+    x, y = x[valid], y[valid]
 
-    with MemoryFile() as memfile:
-        with memfile.open(
-            driver="GTiff",
-            height=arr.shape[0],
-            width=arr.shape[1],
-            count=1,
-            dtype=float,
-            crs=raster_response.crs,
-            transform=Affine(*raster_response.transform),
-        ) as ds:
-            ds.write(arr, 1)
-            bbox = shapely.box(*ds.bounds)
-            bbox_mollweide = (
-                gpd.GeoSeries([bbox], crs="EPSG:4326").to_crs("ESRI:54009").item()
-            )
-            xmin, ymin, xmax, ymax = bbox_mollweide.bounds
+    center_x, center_y = project_points(
+        np.array([c[0] for c in centers], dtype=float),
+        np.array([c[1] for c in centers], dtype=float),
+        src_crs=raster_response.crs,
+        dst_crs="ESRI:54009",
+    )
+    corner_x, corner_y = get_raster_corners(
+        transform, arr.shape, crs=raster_response.crs, dst_crs="ESRI:54009"
+    )
 
-            max_radius = np.sqrt((xmin - xmax) ** 2 + (ymin - ymax) ** 2)
+    for cx, cy, max_radius in zip(center_x, center_y, max_radii):
+        max_distance = np.max(np.hypot(corner_x - cx, corner_y - cy))
+        if max_radius is not None:
+            max_distance = min(max_distance, max_radius)
 
-            radii, circles_mollweide = generate_circles(
-                center_mollweide, 250, max_radius
-            )
+        radii, means = get_radial_profile(
+            values,
+            np.hypot(x - cx, y - cy),
+            ring_width=ring_width,
+            max_distance=max_distance,
+        )
+        yield radii.tolist(), means.tolist()
 
-            circle_intersection_area_frac = np.array(
-                [
-                    circle.intersection(bbox_mollweide).area / bbox_mollweide.area
-                    for circle in circles_mollweide
-                ]
-            )
-            first_full_circle_idx = np.argmax(
-                np.isclose(circle_intersection_area_frac, 1.0)
-            )
-            circles_mollweide = circles_mollweide[: first_full_circle_idx + 1]
-            radii = radii[:first_full_circle_idx]
 
-            rings_mollweide = generate_rings(circles_mollweide)
-            rings_latlon = gpd.GeoSeries(rings_mollweide, crs="ESRI:54009").to_crs(
-                "EPSG:4326"
-            )
+def get_radial_max_scale(
+    accuracy: float, *, ring_width: float = RADIAL_RING_WIDTH
+) -> float:
+    """Largest pixel size, in meters, that gives radial profiles accurate to
+    `accuracy` meters. Pixels are also kept within half a ring, so that every ring
+    gets pixels."""
+    return min(accuracy, ring_width / 2)
+
+
+def get_radial_cdf(
+    raster_response: RasterResponseModel,
+    center: tuple[float, float],
+    *,
+    ring_width: float = RADIAL_RING_WIDTH,
+) -> tuple[list[float], list[float]]:
+    """Calculates the mean value of a raster over rings around a point.
 
-            res = overlay_geometries(ds, rings_latlon.values, np.nanmean)
-            print(radii, res)
-            return radii, res
+    Distances are measured in the Mollweide projection. Rings are generated until one
+    of them contains the whole raster.
+
+    Parameters
+    ----------
+    raster_response: RasterResponseModel
+        Raster to analyze.
+
+    center: tuple[float, float]
+        Longitude and latitude of the center of the rings.
+
+    ring_width: float
+        Width of each ring, in meters.
+
+    Returns
+    -------
+    tuple[list[float], list[float]]
+        Inner radius and mean value of each ring.
+    """
+    return next(get_radial_profiles(raster_response, [center], ring_width=ring_width))
+
+
+def get_radial_pdf(
+    radii: list[float], cdf: list[float], *, lam: float = RADIAL_PDF_LAM
+) -> tuple[list[float], list[float]]:
+    """Smooths a radial profile with a spline and returns its derivative.
+
+    Rings without a value are skipped when fitting the spline, and get a NaN derivative.
+
+    Parameters
+    ----------
+    radii: list[float]
+        Inner radius of each ring.
+
+    cdf: list[float]
+        Value of each ring.
+
+    lam: float
+        Smoothing strength of the spline. It depends on the units of `radii`: the
+        default is tuned for rings `RADIAL_RING_WIDTH` meters apart, and samples `d`
+        apart are smoothed the same with `lam * (d / RADIAL_RING_WIDTH) ** 3`.
+
+    Returns
+    -------
+    tuple[list[float], list[float]]
+        The radii and the derivative of the smoothed profile at each of them.
+    """
+    radii = np.asarray(radii, dtype=float)
+    cdf = np.asarray(cdf, dtype=float)
+    pdf = np.full_like(radii, np.nan)
 
+    finite = np.isfinite(cdf)
+    # make_smoothing_spline needs at least 5 points
+    if finite.sum() >= 5:
+        spline = make_smoothing_spline(radii[finite], cdf[finite], lam=lam)
+        pdf[finite] = spline.derivative()(radii[finite])
 
-def get_radial_pdf(radii: list[float], cdf: list[float]) -> list[float]:
-    spline = make_smoothing_spline(radii, cdf, lam=0.05)
-    pdf = spline.derivative()(radii)
-    return radii, pdf
+    return radii.tolist(), pdf.tolist()
@@ -0,0 +1,158 @@
+import os
+
+import numpy as np
+import rasterio as rio
+
+from affine import Affine
+from rasterio.enums import Resampling
+from rasterio.warp import reproject, transform_bounds
+from typing import Sequence
+from ursa_backend.models import RasterResponseModel
+
+
+TILE_SIZE = 256
+WEB_MERCATOR_EXTENT = 20037508.342789244
+
+
+def tile_bounds(z: int, x: int, y: int) -> tuple[float, float, float, float]:
+    """Calculates the bounds of an XYZ tile in Web Mercator (EPSG:3857).
+
+    Parameters
+    ----------
+    z: int
+        Zoom level.
+
+    x: int
+        Column of the tile, starting from the west.
+
+    y: int
+        Row of the tile, starting from the north.
+
+    Returns
+    -------
+    tuple[float, float, float, float]
+        Bounds of the tile as (xmin, ymin, xmax, ymax).
+    """
+    tile_span = 2 * WEB_MERCATOR_EXTENT / 2**z
+    xmin = -WEB_MERCATOR_EXTENT + x * tile_span
+    ymax = WEB_MERCATOR_EXTENT - y * tile_span
+    return xmin, ymax - tile_span, xmin + tile_span, ymax
+
+
+def is_valid_tile(z: int, x: int, y: int) -> bool:
+    return z >= 0 and 0 <= x < 2**z and 0 <= y < 2**z
+
+
+def get_overview_resolutions(path: os.PathLike) -> list[float]:
+    """Calculates the pixel size of a raster and of each of its overviews.
+
+    Parameters
+    ----------
+    path: os.PathLike
+        Path of the raster.
+
+    Returns
+    -------
+    list[float]
+        Approximate pixel width, in Web Mercator meters, at full resolution followed
+        by that of every overview, from finest to coarsest.
+    """
+    with rio.open(path) as ds:
+        xmin, _, xmax, _ = transform_bounds(ds.crs, "EPSG:3857", *ds.bounds)
+        resolution = (xmax - xmin) / ds.width
+        return [resolution] + [resolution * f for f in ds.overviews(1)]
+
+
+def select_overview_level(
+    resolutions: Sequence[float], z: int, *, tile_size: int = TILE_SIZE
+) -> int | None:
+    """Chooses the coarsest overview that is still finer than the pixels of a tile.
+
+    Parameters
+    ----------
+    resolutions: Sequence[float]
+        Pixel sizes as returned by `get_overview_resolutions`.
+
+    z: int
+        Zoom level of the tile.
+
+    tile_size: int
+        Width and height of the tile in pixels.
+
+    Returns
+    -------
+    int | None
+        Overview level to read, or None if the tile needs the full resolution data.
+    """
+    tile_resolution = 2 * WEB_MERCATOR_EXTENT / 2**z / tile_size
+    level = None
+    for i, resolution in enumerate(resolutions[1:]):
+        if resolution <= tile_resolution:
+            level = i
+    return level
+
+
+def render_tile(
+    raster: RasterResponseModel,
+    z: int,
+    x: int,
+    y: int,
+    *,
+    tile_size: int = TILE_SIZE,
+) -> np.ndarray | None:
+    """Resamples the portion of a raster covered by an XYZ tile.
+
+    Parameters
+    ----------
+    raster: RasterResponseModel
+        Raster to sample.
+
+    z: int
+        Zoom level.
+
+    x: int
+        Column of the tile.
+
+    y: int
+        Row of the tile.
+
+    tile_size: int
+        Width and height of the tile in pixels.
+
+    Returns
+    -------
+    np.ndarray | None
+        Float32 array of shape (tile_size, tile_size). Pixels outside the raster are
+        NaN. If the tile doesn't intersect the raster, None is returned.
+    """
+    arr = raster.data.astype(np.float32, copy=False)
+    transform = Affine(*raster.transform[:6])
+
+    rxmin, rymin, rxmax, rymax = transform_bounds(
+        raster.crs,
+        "EPSG:3857",
+        transform.c,
+        transform.f + transform.e * arr.shape[0],
+        transform.c + transform.a * arr.shape[1],
+        transform.f,
+    )
+    txmin, tymin, txmax, tymax = tile_bounds(z, x, y)
+    if txmin >= rxmax or txmax <= rxmin or tymin >= rymax or tymax <= rymin:
+        return None
+
+    pixel_size = (txmax - txmin) / tile_size
+    dst_transform = Affine(pixel_size, 0, txmin, 0, -pixel_size, tymax)
+    out = np.full((tile_size, tile_size), np.nan, dtype=np.float32)
+
+    reproject(
+        arr,
+        out,
+        src_transform=transform,
+        src_crs=raster.crs,
+        src_nodata=np.nan,
+        dst_transform=dst_transform,
+        dst_crs="EPSG:3857",
+        dst_nodata=np.nan,
+        resampling=Resampling.nearest,
+    )
+    return out
@@ -6,11 +6,25 @@ import shapely
 import geopandas as gpd
 import numpy as np
 import rasterio as rio
+import scipy.ndimage
 
 from affine import Affine
+from pathlib import Path
 from rasterio.crs import CRS  # pylint: disable=no-name-in-module
 from rasterio.windows import Window
-from typing import Generator, TypedDict
+from typing import Generator, Literal, TypedDict, assert_never
+from ursa_backend.code.arrays import get_shared_array
+from ursa_backend.code.cache import CacheSpec, get_or_create, make_derived_spec
+from ursa_backend.code.constants import (
+    RURAL_BUFFER_SIZE,
+    RURAL_DILATION,
+    WINDOW_BLOCK_SIZE,
+    WORLDCOVER_DATASET,
+)
+from ursa_backend.code.fs import atomic_write, iter_windows
+
+
+DilationEngine = Literal["edt", "vector"]
 
 
 class MaskMap(TypedDict):
@@ -20,10 +34,137 @@ class MaskMap(TypedDict):
     cover: np.ndarray | None = None
 
 
+def meters_per_degree(lat: np.ndarray | float) -> tuple[np.ndarray, np.ndarray]:
+    """Length of a degree of latitude and longitude on the WGS84 ellipsoid.
+
+    Parameters
+    ----------
+    lat: np.ndarray | float
+        Latitude, in degrees.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        Meters per degree of latitude and of longitude.
+    """
+    phi = np.radians(lat)
+    lat_m = (
+        111132.92
+        - 559.82 * np.cos(2 * phi)
+        + 1.175 * np.cos(4 * phi)
+        - 0.0023 * np.cos(6 * phi)
+    )
+    lon_m = 111412.84 * np.cos(phi) - 93.5 * np.cos(3 * phi) + 0.118 * np.cos(5 * phi)
+    return lat_m, lon_m
+
+
+def _dilate_strip(
+    arr: np.ndarray, *, pixel_size: tuple[float, float], buffer_size: float
+) -> np.ndarray:
+    if not arr.any():
+        return np.zeros_like(arr, dtype=bool)
+
+    dy, dx = pixel_size
+    iy, ix = scipy.ndimage.distance_transform_edt(
+        ~arr, sampling=(dy, dx), return_distances=False, return_indices=True
+    )
+
+    # Distance from each pixel center to the nearest edge of the closest urban pixel,
+    # which is what buffering the polygonized pixels and burning them back measures
+    rows, cols = np.indices(arr.shape, dtype=np.int32)
+    gap_y = np.maximum(np.abs(iy - rows) * dy - dy / 2, 0)
+    gap_x = np.maximum(np.abs(ix - cols) * dx - dx / 2, 0)
+    return np.hypot(gap_x, gap_y) <= buffer_size
+
+
+def dilate_binary_array_edt(
+    arr: np.ndarray,
+    *,
+    transform: Affine,
+    crs: CRS,
+    buffer_size: float,
+    strip_height: int = 512,
+) -> np.ndarray:
+    """Dilates a georeferenced binary array with a Euclidean distance transform.
+
+    Geographic rasters are processed in horizontal strips, each with the metric pixel
+    size at its central latitude, plus enough overlapping rows to cover the buffer.
+
+    Parameters
+    ----------
+    arr: np.ndarray
+        Array to dilate.
+
+    transform: affine.Affine
+        Geographic transform of the original raster. Must be north-up.
+
+    crs: rasterio.crs.CRS
+        Crs of the original raster.
+
+    buffer_size: float
+        Buffer size (in meters) to dilate the array.
+
+    strip_height: int
+        Number of rows per strip, excluding the overlap.
+
+    Returns
+    -------
+    np.ndarray
+        Dilated array.
+    """
+    arr = arr.astype(bool)
+    height = arr.shape[0]
+
+    if not CRS.from_user_input(crs).is_geographic:
+        return _dilate_strip(
+            arr,
+            pixel_size=(abs(transform.e), abs(transform.a)),
+            buffer_size=buffer_size,
+        )
+
+    out = np.zeros_like(arr, dtype=bool)
+    for start in range(0, height, strip_height):
+        stop = min(start + strip_height, height)
+
+        lat = transform.f + transform.e * (start + stop) / 2
+        lat_m, lon_m = meters_per_degree(lat)
+        dy = abs(transform.e) * lat_m
+        dx = abs(transform.a) * lon_m
+
+        halo = int(np.ceil(buffer_size / dy)) + 1
+        halo_start = max(start - halo, 0)
+        halo_stop = min(stop + halo, height)
+
+        dilated = _dilate_strip(
+            arr[halo_start:halo_stop], pixel_size=(dy, dx), buffer_size=buffer_size
+        )
+        out[start:stop] = dilated[start - halo_start : stop - halo_start]
+
+    return out
+
+
+def get_local_projection(transform: Affine, shape: tuple[int, int]) -> CRS:
+    """Azimuthal equidistant projection centered on a geographic raster. Distances
+    from its center are true, and others are close to true within a city."""
+    lon, lat = transform * (shape[1] / 2, shape[0] / 2)
+    return CRS.from_proj4(f"+proj=aeqd +lat_0={lat} +lon_0={lon} +datum=WGS84 +units=m")
+
+
 def dilate_binary_array(
-    arr: np.ndarray, *, transform: Affine, crs: CRS, buffer_size: float
+    arr: np.ndarray,
+    *,
+    transform: Affine,
+    crs: CRS,
+    buffer_size: float,
+    projection: CRS | str = "ESRI:54009",
 ) -> np.ndarray:
-    """Dilates a georeferenced binary array.
+    """Dilates a georeferenced binary array by buffering its polygonized shapes.
+
+    This is much slower than `dilate_binary_array_edt` for large rasters, and is kept
+    as a reference implementation. The default Mollweide projection stretches
+    distances away from its central meridian. Buffering in an azimuthal equidistant
+    projection centered on the raster measures true distances, like
+    `dilate_binary_array_edt`.
 
     Parameters
     ----------
@@ -39,6 +180,8 @@ def dilate_binary_array(
     buffer_size: float
         Buffer size (in meters) to dilate the array.
 
+    projection: rasterio.crs.CRS | str
+        Metric projection the shapes are buffered in.
 
     Returns
     -------
@@ -52,7 +195,7 @@ def dilate_binary_array(
     ]
     df = (
         gpd.GeoDataFrame(geometry=shapes, crs=crs)
-        .to_crs("ESRI:54009")
+        .to_crs(projection)
         .assign(geometry=lambda df: df.geometry.buffer(buffer_size, resolution=32))
         .to_crs(crs)
     )
@@ -71,6 +214,8 @@ def get_masks(
     urban: bool = True,
     rural: bool = True,
     valid: bool = True,
+    buffer_size: float = RURAL_BUFFER_SIZE,
+    dilation: DilationEngine = RURAL_DILATION,
 ) -> MaskMap:
     """Calculates urban, rural and valid masks from a WorldCover image.
 
@@ -88,6 +233,14 @@ def get_masks(
     valid: bool
         Whether to return the valid mask. If `rural=True`, this mask is calculated regardless.
 
+    buffer_size: float
+        Distance, in meters, from urban pixels within which pixels are not rural.
+
+    dilation: DilationEngine
+        Algorithm used to dilate the urban mask. `edt` uses a distance transform on the
+        raster, while `vector` buffers the polygonized mask in the Mollweide
+        projection, as the rural mask was built before. See `RURAL_DILATION`.
+
     Returns
     -------
     dict[str, np.ndarray]:
@@ -105,10 +258,15 @@ def get_masks(
         valid_mask = np.bitwise_and(snow_mask, water_mask)
 
     if rural:
+        if dilation == "edt":
+            dilate = dilate_binary_array_edt
+        elif dilation == "vector":
+            dilate = dilate_binary_array
+        else:
+            assert_never(dilation)
+
         rural_mask = np.bitwise_not(
-            dilate_binary_array(
-                urban_mask, transform=transform, crs=crs, buffer_size=500
-            )
+            dilate(urban_mask, transform=transform, crs=crs, buffer_size=buffer_size)
         )
 
         if not urban:
@@ -127,7 +285,7 @@ def get_masks(
 
 
 def get_world_cover(bbox: ee.Geometry) -> ee.Image:
-    lc_cover = ee.ImageCollection("ESA/WorldCover/v200").mode().clip(bbox)
+    lc_cover = ee.ImageCollection(WORLDCOVER_DATASET).mode().clip(bbox)
     return lc_cover
 
 
@@ -137,6 +295,8 @@ def load_cover_and_masks(
     urban: bool = False,
     rural: bool = False,
     valid: bool = False,
+    buffer_size: float = RURAL_BUFFER_SIZE,
+    dilation: DilationEngine = RURAL_DILATION,
 ) -> MaskMap:
     with rio.open(wc_path) as ds:
         data = ds.read(1)
@@ -144,32 +304,267 @@ def load_cover_and_masks(
         transform = ds.transform
 
     masks = get_masks(
-        data, transform=transform, crs=crs, urban=urban, rural=rural, valid=valid
+        data,
+        transform=transform,
+        crs=crs,
+        urban=urban,
+        rural=rural,
+        valid=valid,
+        buffer_size=buffer_size,
+        dilation=dilation,
     )
     masks["cover"] = data
     return masks
 
 
+def get_halo(
+    transform: Affine, crs: CRS, window: Window, buffer_size: float
+) -> tuple[int, int]:
+    """Number of rows and columns a block must be padded with to dilate it exactly.
+
+    Parameters
+    ----------
+    transform: affine.Affine
+        Geographic transform of the raster. Must be north-up.
+
+    crs: rasterio.crs.CRS
+        CRS of the raster.
+
+    window: rasterio.windows.Window
+        Block to pad.
+
+    buffer_size: float
+        Buffer size, in meters.
+
+    Returns
+    -------
+    tuple[int, int]
+        Rows and columns of padding on each side.
+    """
+    dy, dx = abs(transform.e), abs(transform.a)
+    if CRS.from_user_input(crs).is_geographic:
+        # Degrees of longitude are shortest on the row farthest from the equator
+        rows = np.array([window.row_off, window.row_off + window.height])
+        lat = np.max(np.abs(transform.f + transform.e * rows))
+        lat_m, lon_m = meters_per_degree(lat)
+        dy, dx = dy * lat_m, dx * lon_m
+
+    return int(np.ceil(buffer_size / dy)) + 1, int(np.ceil(buffer_size / dx)) + 1
+
+
 def load_cover_and_masks_generator(
     wc_path: os.PathLike,
     *,
     urban: bool = False,
     rural: bool = False,
     valid: bool = False,
+    buffer_size: float = RURAL_BUFFER_SIZE,
+    dilation: DilationEngine = RURAL_DILATION,
+    block_size: int = WINDOW_BLOCK_SIZE,
 ) -> Generator[tuple[Window, MaskMap], None, None]:
-    with rio.open(wc_path) as ds:
-        for _, window in ds.block_windows(1):
-            data = ds.read(1, window=window)
-            crs = ds.crs
-            transform = ds.transform
+    """Calculates the masks of a WorldCover raster one block at a time.
+
+    When the rural mask is requested, each block is read with enough surrounding
+    pixels to cover the buffer, so the dilation matches the one of the whole raster.
+
+    Parameters
+    ----------
+    wc_path: os.PathLike
+        Path of the WorldCover raster.
+
+    urban, rural, valid: bool
+        Masks to calculate. See `get_masks`.
+
+    buffer_size: float
+        Distance, in meters, from urban pixels within which pixels are not rural.
 
+    dilation: DilationEngine
+        Algorithm used to dilate the urban mask. See `get_masks`.
+
+    block_size: int
+        Height and width of each block.
+
+    Yields
+    ------
+    tuple[rasterio.windows.Window, MaskMap]
+        Window of each block and its masks and cover data.
+    """
+    with rio.open(wc_path) as ds:
+        bounds = Window(0, 0, ds.width, ds.height)
+        for window in iter_windows(ds.height, ds.width, block_size):
+            halo_rows, halo_cols = (
+                get_halo(ds.transform, ds.crs, window, buffer_size) if rural else (0, 0)
+            )
+            outer = Window(
+                window.col_off - halo_cols,
+                window.row_off - halo_rows,
+                window.width + 2 * halo_cols,
+                window.height + 2 * halo_rows,
+            ).intersection(bounds)
+
+            data = ds.read(1, window=outer)
             masks = get_masks(
                 data,
-                transform=transform,
-                crs=crs,
+                transform=ds.window_transform(outer),
+                crs=ds.crs,
                 urban=urban,
                 rural=rural,
                 valid=valid,
+                buffer_size=buffer_size,
+                dilation=dilation,
             )
             masks["cover"] = data
-            yield (window, masks)
+
+            row = int(window.row_off - outer.row_off)
+            col = int(window.col_off - outer.col_off)
+            inner = (
+                slice(row, row + int(window.height)),
+                slice(col, col + int(window.width)),
+            )
+            yield window, MaskMap(
+                **{k: None if v is None else v[inner] for k, v in masks.items()}
+            )
+
+
+def get_masks_spec(
+    wc_path: os.PathLike,
+    *,
+    buffer_size: float = RURAL_BUFFER_SIZE,
+    dilation: DilationEngine = RURAL_DILATION,
+) -> CacheSpec:
+    """Specification of the cached masks of a cover raster. Artifacts computed from the
+    masks list its cache path among their inputs, so they change with the buffer size
+    and the dilation engine."""
+    return make_derived_spec(
+        "masks", [wc_path], buffer_size=buffer_size, dilation=dilation
+    )
+
+
+def get_cached_masks_path(
+    wc_path: os.PathLike,
+    *,
+    buffer_size: float = RURAL_BUFFER_SIZE,
+    dilation: DilationEngine = RURAL_DILATION,
+    block_size: int | None = None,
+) -> Path:
+    """Location of the cached urban, rural and valid masks of a cover raster.
+
+    The masks are stored as the three bands of a uint8 GeoTIFF.
+
+    Parameters
+    ----------
+    wc_path: os.PathLike
+        Path of the WorldCover raster.
+
+    buffer_size: float
+        Distance, in meters, from urban pixels within which pixels are not rural.
+
+    dilation: DilationEngine
+        Algorithm used to dilate the urban mask. See `get_masks`.
+
+    block_size: int | None
+        If given and the masks aren't cached, they are computed in blocks of this
+        size with `load_cover_and_masks_generator`, so the cover raster is never
+        fully read into memory.
+
+    Returns
+    -------
+    Path
+        Path of the masks.
+    """
+    spec = get_masks_spec(wc_path, buffer_size=buffer_size, dilation=dilation)
+
+    def compute(path: Path) -> None:
+        with rio.open(wc_path) as ds:
+            profile = ds.profile
+
+        profile.update(
+            count=3,
+            dtype="uint8",
+            nodata=None,
+            compress="deflate",
+            tiled=True,
+            blockxsize=256,
+            blockysize=256,
+        )
+        names = ("urban", "rural", "valid")
+        with atomic_write(path) as temp_path, rio.open(temp_path, "w", **profile) as ds:
+            if block_size is None:
+                masks = load_cover_and_masks(
+                    wc_path,
+                    urban=True,
+                    rural=True,
+                    valid=True,
+                    buffer_size=buffer_size,
+                    dilation=dilation,
+                )
+                blocks = [(None, masks)]
+            else:
+                blocks = load_cover_and_masks_generator(
+                    wc_path,
+                    urban=True,
+                    rural=True,
+                    valid=True,
+                    buffer_size=buffer_size,
+                    dilation=dilation,
+                    block_size=block_size,
+                )
+
+            for window, masks in blocks:
+                for i, name in enumerate(names, start=1):
+                    ds.write(masks[name].astype(np.uint8), i, window=window)
+
+    return get_or_create(spec, compute)
+
+
+def load_cached_masks(
+    wc_path: os.PathLike,
+    *,
+    buffer_size: float = RURAL_BUFFER_SIZE,
+    dilation: DilationEngine = RURAL_DILATION,
+    cover: bool = True,
+) -> MaskMap:
+    """Loads the cover raster with its urban, rural and valid masks.
+
+    The masks are computed once per cover raster and buffer size, and stored in the
+    cache as a three band uint8 GeoTIFF. The decoded arrays are shared between worker
+    processes with `get_shared_array`, and are read-only.
+
+    Parameters
+    ----------
+    wc_path: os.PathLike
+        Path of the WorldCover raster.
+
+    buffer_size: float
+        Distance, in meters, from urban pixels within which pixels are not rural.
+
+    dilation: DilationEngine
+        Algorithm used to dilate the urban mask. See `get_masks`.
+
+    cover: bool
+        Whether to load the cover data too.
+
+    Returns
+    -------
+    MaskMap
+        All the masks and, if requested, the cover data.
+    """
+    masks_path = get_cached_masks_path(
+        wc_path, buffer_size=buffer_size, dilation=dilation
+    )
+
+    def read_cover() -> np.ndarray:
+        with rio.open(wc_path) as ds:
+            return ds.read(1)
+
+    def read_masks() -> np.ndarray:
+        with rio.open(masks_path) as ds:
+            return ds.read()
+
+    # Every worker process attaches to the same decoded arrays
+    cover_data = get_shared_array(Path(wc_path).stem, read_cover) if cover else None
+
+    # The bands only hold 0 and 1, so they can be viewed as booleans without a copy
+    urban, rural, valid = get_shared_array(masks_path.stem, read_masks).view(bool)
+
+    return MaskMap(urban=urban, rural=rural, valid=valid, cover=cover_data)
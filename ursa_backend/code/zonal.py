@@ -0,0 +1,253 @@
+import io
+import rasterio.features  # pylint: disable=unused-import
+
+import geopandas as gpd
+import numpy as np
+import rasterio as rio
+
+from affine import Affine
+from typing import Sequence, TypedDict
+from ursa_backend.models import RasterResponseModel
+
+
+GEOJSON_MEDIA_TYPES = ("application/geo+json", "application/json")
+GEOPARQUET_MEDIA_TYPES = (
+    "application/vnd.apache.parquet",
+    "application/x-parquet",
+    "application/octet-stream",
+)
+
+DEFAULT_PERCENTILES = (10, 25, 75, 90)
+
+
+class ZonalStats(TypedDict):
+    id: list
+    count: list[int]
+    valid_fraction: list[float]
+    mean: list[float]
+    median: list[float]
+    percentiles: dict[str, list[float]]
+
+
+def read_zones(content: bytes, media_type: str) -> gpd.GeoDataFrame:
+    """Reads a GeoJSON FeatureCollection or a GeoParquet file from a request body.
+
+    Parameters
+    ----------
+    content: bytes
+        Body of the request.
+
+    media_type: str
+        Content type of the body. GeoJSON is assumed to be in EPSG:4326, as per
+        RFC 7946, unless it declares its own CRS.
+
+    Returns
+    -------
+    gpd.GeoDataFrame
+        Zones, in the order of the features.
+
+    Raises
+    ------
+    ValueError
+        If the media type is not supported.
+
+    ImportError
+        If the body is GeoParquet and pyarrow is not installed.
+    """
+    media_type = media_type.split(";")[0].strip().lower()
+    if media_type in GEOJSON_MEDIA_TYPES:
+        df = gpd.read_file(io.BytesIO(content))
+        if df.crs is None:
+            df = df.set_crs("EPSG:4326")
+        return df
+    if media_type in GEOPARQUET_MEDIA_TYPES:
+        return gpd.read_parquet(io.BytesIO(content))
+    raise ValueError(f"Unsupported zone format: {media_type}")
+
+
+def get_zones_max_scale(zones: gpd.GeoDataFrame, min_pixels: int) -> float:
+    """Calculates the largest pixel size that still samples every zone well enough.
+
+    Areas are measured in the Mollweide projection.
+
+    Parameters
+    ----------
+    zones: gpd.GeoDataFrame
+        Zones to summarize.
+
+    min_pixels: int
+        Number of pixels the smallest zone must contain.
+
+    Returns
+    -------
+    float
+        Pixel size, in meters. Infinite if no zone has an area.
+    """
+    areas = zones.geometry.to_crs("ESRI:54009").area
+    areas = areas[areas > 0]
+    if areas.empty:
+        return np.inf
+    return float(np.sqrt(areas.min() / min_pixels))
+
+
+def rasterize_zones(
+    zones: gpd.GeoDataFrame, transform: Affine, shape: tuple[int, int], crs: str
+) -> np.ndarray:
+    """Burns every zone into a single label raster.
+
+    Pixels are labelled with the position of their zone plus one, and pixels outside
+    every zone are labelled 0. Where zones overlap, the later zone wins.
+
+    Parameters
+    ----------
+    zones: gpd.GeoDataFrame
+        Zones to rasterize.
+
+    transform: affine.Affine
+        Geographic transform of the output raster.
+
+    shape: tuple[int, int]
+        Height and width of the output raster.
+
+    crs: str
+        CRS of the output raster.
+
+    Returns
+    -------
+    np.ndarray
+        Label raster.
+    """
+    geometries = zones.geometry.to_crs(crs)
+    dtype = np.uint16 if len(zones) < np.iinfo(np.uint16).max else np.uint32
+    shapes = (
+        (geom, i + 1)
+        for i, geom in enumerate(geometries)
+        if geom is not None and not geom.is_empty
+    )
+    return rio.features.rasterize(
+        shapes, out_shape=shape, transform=transform, fill=0, dtype=dtype
+    )
+
+
+def _sorted_quantiles(
+    sorted_values: np.ndarray,
+    starts: np.ndarray,
+    counts: np.ndarray,
+    q: float,
+) -> np.ndarray:
+    # Linear interpolation between the closest ranks, like np.percentile
+    pos = starts + q * np.maximum(counts - 1, 0)
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.ceil(pos).astype(np.int64)
+    frac = pos - lo
+
+    padded = np.append(sorted_values, np.nan)
+    lo = np.where(counts > 0, lo, len(sorted_values))
+    hi = np.where(counts > 0, hi, len(sorted_values))
+    return padded[lo] * (1 - frac) + padded[hi] * frac
+
+
+def get_zonal_stats(
+    values: np.ndarray,
+    labels: np.ndarray,
+    n_zones: int,
+    *,
+    percentiles: Sequence[float] = DEFAULT_PERCENTILES,
+) -> dict[str, np.ndarray]:
+    """Calculates statistics of a raster for every zone of a label raster at once.
+
+    Pixels are grouped by sorting them by label and value, so every statistic is
+    computed in a single vectorized pass regardless of the number of zones.
+
+    Parameters
+    ----------
+    values: np.ndarray
+        Raster data. NaN values are ignored.
+
+    labels: np.ndarray
+        Label raster with the same shape as `values`, as returned by
+        `rasterize_zones`.
+
+    n_zones: int
+        Number of zones.
+
+    percentiles: Sequence[float]
+        Percentiles to calculate, between 0 and 100.
+
+    Returns
+    -------
+    dict[str, np.ndarray]
+        Number of pixels, fraction of valid pixels, mean, median and percentiles of
+        each zone. Zones without valid pixels get NaN statistics.
+    """
+    values = values.ravel()
+    labels = labels.ravel()
+
+    total = np.bincount(labels, minlength=n_zones + 1)[1:]
+
+    valid = (labels > 0) & ~np.isnan(values)
+    valid_labels = labels[valid]
+    valid_values = values[valid]
+
+    counts = np.bincount(valid_labels, minlength=n_zones + 1)[1:]
+    sums = np.bincount(valid_labels, weights=valid_values, minlength=n_zones + 1)[1:]
+
+    order = np.lexsort((valid_values, valid_labels))
+    sorted_values = valid_values[order]
+    starts = np.cumsum(counts) - counts
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        stats = dict(
+            count=total,
+            valid_fraction=counts / total,
+            mean=sums / counts,
+            median=_sorted_quantiles(sorted_values, starts, counts, 0.5),
+        )
+    for p in percentiles:
+        stats[f"p{p:g}"] = _sorted_quantiles(sorted_values, starts, counts, p / 100)
+    return stats
+
+
+def get_raster_zonal_stats(
+    raster_response: RasterResponseModel,
+    zones: gpd.GeoDataFrame,
+    *,
+    id_field: str | None = None,
+    percentiles: Sequence[float] = DEFAULT_PERCENTILES,
+) -> ZonalStats:
+    """Calculates statistics of a raster over a layer of polygons.
+
+    Parameters
+    ----------
+    raster_response: RasterResponseModel
+        Raster to summarize.
+
+    zones: gpd.GeoDataFrame
+        Polygons to summarize the raster over.
+
+    id_field: str | None
+        Column used to identify each zone. If None, the index is used.
+
+    percentiles: Sequence[float]
+        Percentiles to calculate, between 0 and 100.
+
+    Returns
+    -------
+    ZonalStats
+        Statistics of each zone, as columns in the order of `zones`.
+    """
+    arr = raster_response.data
+    transform = Affine(*raster_response.transform[:6])
+
+    labels = rasterize_zones(zones, transform, arr.shape, raster_response.crs)
+    stats = get_zonal_stats(arr, labels, len(zones), percentiles=percentiles)
+
+    ids = zones.index if id_field is None else zones[id_field]
+    return ZonalStats(
+        id=ids.tolist(),
+        count=stats["count"].tolist(),
+        valid_fraction=stats["valid_fraction"].tolist(),
+        mean=stats["mean"].tolist(),
+        median=stats["median"].tolist(),
+        percentiles={f"{p:g}": stats[f"p{p:g}"].tolist() for p in percentiles},
+    )
@@ -1,39 +1,146 @@
-from fastapi import Query
+import geopandas as gpd
+
+from fastapi import HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
 from pathlib import Path
-from typing import Annotated
-from ursa_backend.code.common import load_or_download_image
-from ursa_backend.code.dates import get_date_range, season_to_months
-from ursa_backend.code.constants import LST_NODATA
-from ursa_backend.code.suhi import get_lst
-from ursa_backend.code.world_cover import get_world_cover
-from ursa_backend.models import GeographicRequestModel, GeoTemporalRequestModel
-
-
-def lst_dependency(
-    request: Annotated[GeoTemporalRequestModel, Query()]
-) -> dict[str, Path]:
-    box_ee = request.bounds_to_ee()
-
-    out = []
-    for month in season_to_months(request.season):
-        cont_raster_path = Path(
-            f"./data/{request.get_hash()}/suhi/{request.year}_{str(month).rjust(2, '0')}.tif"
+from typing import Annotated, TypedDict
+from ursa_backend.code.catalog import (
+    MonthCoverage,
+    get_month_coverage,
+    get_scene_catalog,
+)
+from ursa_backend.code.constants import PREVIEW_SCALE
+from ursa_backend.code.dates import season_to_months
+from ursa_backend.code.exposure import is_population_raster
+from ursa_backend.code.fetch import (
+    fetch_lst_rasters,
+    fetch_world_cover,
+    get_lst_months,
+)
+from ursa_backend.code.jobs import is_result_cached, submit_job
+from ursa_backend.code.scheduler import Priority
+from ursa_backend.code.zonal import read_zones
+from ursa_backend.models import (
+    GeographicRequestModel,
+    GeoTemporalRequestModel,
+    MapRequestModel,
+    RadialRequestModel,
+    ZonalRequestModel,
+)
+
+
+def get_season_coverage(request: GeoTemporalRequestModel) -> list[MonthCoverage]:
+    catalog = get_scene_catalog(
+        request.get_bounds(), request.year, priority=Priority.INTERACTIVE
+    )
+    return get_month_coverage(catalog, season_to_months(request.season))
+
+
+def coverage_dependency(
+    request: Annotated[GeoTemporalRequestModel, Query()],
+) -> list[MonthCoverage]:
+    return get_season_coverage(request)
+
+
+def get_available_months(request: GeoTemporalRequestModel) -> list[int]:
+    """Months of the season of a request with scenes in the scene catalog, as given by
+    `get_lst_months`. Raises a 404 if there are none."""
+    months = get_lst_months(request, Priority.INTERACTIVE)
+    if not months:
+        raise HTTPException(
+            status_code=404, detail="No measurements for given date and location found."
         )
+    return months
+
+
+def get_lst_rasters(request: GeoTemporalRequestModel) -> list[Path]:
+    """Monthly LST rasters of a request. Months without scenes in the scene catalog
+    are skipped without asking Earth Engine. Every endpoint that reads LST fetches
+    it through here, so they share the same months and mean SUHI raster."""
+    months = get_available_months(request)
+    return fetch_lst_rasters(request, Priority.INTERACTIVE, months=months)
 
-        if not cont_raster_path.exists():
-            start_date, end_date = get_date_range(month, request.year)
-            lst = get_lst(box_ee, start_date, end_date)
-            load_or_download_image(lst, cont_raster_path, box_ee, nodata=LST_NODATA)
 
-        out.append(cont_raster_path)
+def lst_dependency(request: Annotated[GeoTemporalRequestModel, Query()]) -> list[Path]:
+    return get_lst_rasters(request)
 
-    return out
+
+def season_lst_dependency(
+    request: Annotated[GeoTemporalRequestModel, Query()],
+) -> dict[int, Path | None]:
+    """Monthly LST raster of every month of the season of a request, in chronological
+    order. Months without scenes in the scene catalog are None."""
+    months = get_available_months(request)
+    paths = dict(
+        zip(months, fetch_lst_rasters(request, Priority.INTERACTIVE, months=months))
+    )
+    return {month: paths.get(month) for month in season_to_months(request.season)}
 
 
 def world_cover_dependency(request: Annotated[GeographicRequestModel, Query()]) -> Path:
-    box_ee = request.bounds_to_ee()
-    img = get_world_cover(box_ee)
-    path = Path(f"./data/{request.get_hash()}/cover.tif")
-    load_or_download_image(img, path, box_ee, nodata=0)
+    return fetch_world_cover(request, Priority.INTERACTIVE)
+
+
+class MapInputs(TypedDict):
+    monthly_temp_paths: list[Path]
+    world_cover_path: Path
+    scale: int
+    job_id: str | None
+
+
+def map_inputs_dependency(
+    request: Annotated[MapRequestModel, Query()],
+) -> MapInputs:
+    """Inputs of the map endpoints.
+
+    In progressive mode, a request whose mean SUHI raster isn't cached yet is served
+    at `PREVIEW_SCALE`, and a background job computes it at the requested scale. The
+    ID of the job is returned so that clients can poll it and ask again.
+    """
+    job_id = None
+    progressive = request.progressive
+    request = GeoTemporalRequestModel(**request.model_dump(exclude={"progressive"}))
+
+    # Requests without scenes fail before a job is queued for them
+    months = get_available_months(request)
+    if progressive and request.scale < PREVIEW_SCALE and not is_result_cached(request):
+        job_id = submit_job(request)["id"]
+        request = request.with_scale(PREVIEW_SCALE)
+
+    return MapInputs(
+        world_cover_path=fetch_world_cover(request, Priority.INTERACTIVE),
+        monthly_temp_paths=fetch_lst_rasters(
+            request, Priority.INTERACTIVE, months=months
+        ),
+        scale=request.scale,
+        job_id=job_id,
+    )
+
+
+def radial_request_dependency(
+    request: Annotated[RadialRequestModel, Query()],
+) -> RadialRequestModel:
+    return request
+
+
+def zonal_request_dependency(
+    request: Annotated[ZonalRequestModel, Query()],
+) -> ZonalRequestModel:
+    return request
+
+
+async def zones_dependency(request: Request) -> gpd.GeoDataFrame:
+    content = await request.body()
+    media_type = request.headers.get("content-type", "application/geo+json")
+    try:
+        return await run_in_threadpool(read_zones, content, media_type)
+    except (ValueError, ImportError) as exc:
+        raise HTTPException(status_code=415, detail=str(exc)) from exc
+
 
-    return path
+async def population_dependency(request: Request) -> gpd.GeoDataFrame | bytes:
+    """Population rasters are passed through as bytes, polygon layers are parsed."""
+    media_type = request.headers.get("content-type", "application/geo+json")
+    if is_population_raster(media_type):
+        return await request.body()
+    return await zones_dependency(request)
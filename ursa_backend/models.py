@@ -1,7 +1,19 @@
 import ee
 
-from pydantic import BaseModel
-from ursa_backend.code.common import bounds_to_ee, get_hash
+import numpy as np
+
+from pydantic import (
+    BaseModel,
+    BeforeValidator,
+    ConfigDict,
+    Field,
+    field_validator,
+    model_validator,
+)
+from typing import Annotated, Self
+from ursa_backend.code.cache import canonicalize_bounds
+from ursa_backend.code.common import bounds_to_ee
+from ursa_backend.code.constants import DEFAULT_SCALE, SCALE_TIERS, SEASONS
 
 
 class GeographicRequestModel(BaseModel):
@@ -9,12 +21,23 @@ class GeographicRequestModel(BaseModel):
     ymin: float
     xmax: float
     ymax: float
+    scale: int = DEFAULT_SCALE
+
+    @field_validator("scale")
+    @classmethod
+    def check_scale(cls, scale: int) -> int:
+        if scale not in SCALE_TIERS:
+            raise ValueError(f"scale must be one of {SCALE_TIERS}.")
+        return scale
+
+    def with_scale(self, scale: int) -> Self:
+        return self.model_copy(update=dict(scale=scale))
 
     def bounds_to_ee(self) -> ee.Geometry:
         return bounds_to_ee(self.xmin, self.ymin, self.xmax, self.ymax)
 
-    def get_hash(self) -> str:
-        return get_hash(self.xmin, self.ymin, self.xmax, self.ymax)
+    def get_bounds(self) -> tuple[float, float, float, float]:
+        return canonicalize_bounds(self.xmin, self.ymin, self.xmax, self.ymax)
 
 
 class GeoTemporalRequestModel(GeographicRequestModel):
@@ -27,7 +50,55 @@ class CenterRequestModel(BaseModel):
     y: float
 
 
+class RadialCenterModel(CenterRequestModel):
+    id: str | None = None
+    max_radius: float | None = None
+
+
+class MapRequestModel(GeoTemporalRequestModel):
+    progressive: bool = False
+
+
+class RadialRequestModel(GeoTemporalRequestModel):
+    accuracy: float | None = Field(default=None, gt=0)
+
+
+class RadialBatchRequestModel(RadialRequestModel):
+    centers: list[RadialCenterModel]
+
+
+class ZonalRequestModel(GeoTemporalRequestModel):
+    min_zone_pixels: int | None = Field(default=None, gt=0)
+
+
+class TimeSeriesRequestModel(GeographicRequestModel):
+    start_year: int
+    end_year: int
+    seasons: list[str] = ["Qall"]
+
+    @field_validator("seasons")
+    @classmethod
+    def check_seasons(cls, seasons: list[str]) -> list[str]:
+        if not seasons or not set(seasons).issubset(SEASONS):
+            raise ValueError(f"seasons must be one or more of {SEASONS}.")
+        return list(dict.fromkeys(seasons))
+
+    @model_validator(mode="after")
+    def check_years(self) -> Self:
+        if self.end_year < self.start_year:
+            raise ValueError("end_year can't be earlier than start_year.")
+        return self
+
+
 class RasterResponseModel(BaseModel):
-    data: list
+    """A single band raster held in memory.
+
+    `data` is stored as given, without copying or validating its elements, so it
+    keeps its dtype. Lists are converted to arrays.
+    """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    data: Annotated[np.ndarray, BeforeValidator(np.asarray)]
     transform: list
     crs: str
@@ -0,0 +1,68 @@
+from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import ORJSONResponse
+from typing import Annotated
+from ursa_backend.code.cache import (
+    evict,
+    get_entry,
+    get_stats,
+    list_entries,
+    purge,
+    remove_entry,
+    verify_entries,
+)
+from ursa_backend.code.scheduler import get_scheduler
+
+
+router = APIRouter(prefix="/admin")
+
+
+@router.get("/cache")
+def cache_stats_endpoint():
+    return ORJSONResponse(get_stats())
+
+
+@router.get("/cache/entries")
+def cache_entries_endpoint(dataset: Annotated[str | None, Query()] = None):
+    return ORJSONResponse(list_entries(dataset))
+
+
+@router.get("/cache/entries/{key}")
+def cache_entry_endpoint(key: str):
+    entry = get_entry(key)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Cache entry not found.")
+    return ORJSONResponse(entry)
+
+
+@router.delete("/cache/entries/{key}")
+def delete_cache_entry_endpoint(key: str):
+    entry = remove_entry(key)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Cache entry not found.")
+    return ORJSONResponse(entry)
+
+
+@router.post("/cache/purge")
+def purge_cache_endpoint(dataset: Annotated[str | None, Query()] = None):
+    entries = purge(dataset)
+    return ORJSONResponse(
+        dict(deleted=len(entries), size=sum(e["size"] for e in entries))
+    )
+
+
+@router.post("/cache/evict")
+def evict_cache_endpoint(max_size: Annotated[int | None, Query(ge=0)] = None):
+    entries = evict() if max_size is None else evict(max_size)
+    return ORJSONResponse(
+        dict(evicted=len(entries), size=sum(e["size"] for e in entries))
+    )
+
+
+@router.get("/cache/verify")
+def verify_cache_endpoint(checksum: Annotated[bool, Query()] = False):
+    return ORJSONResponse(verify_entries(checksum=checksum))
+
+
+@router.get("/scheduler")
+def scheduler_stats_endpoint():
+    return ORJSONResponse(get_scheduler().stats())
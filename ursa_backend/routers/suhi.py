@@ -1,93 +1,416 @@
-import numpy as np
+import json
 
-from fastapi import APIRouter, Depends, Query
-from fastapi.responses import JSONResponse, ORJSONResponse
+import geopandas as gpd
+import orjson
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse
 from pathlib import Path
-from typing import Annotated
-from ursa_backend.code.common import raster_to_rgb
+from typing import Annotated, Generator, Literal
+from ursa_backend.code.catalog import MonthCoverage
+from ursa_backend.code.common import raster_to_rgb, raster_to_rgba
+from ursa_backend.code.constants import LST_CAT_NODATA
+from ursa_backend.code.encoding import (
+    IMAGE_MEDIA_TYPES,
+    RASTER_MEDIA_TYPES,
+    ImageFormat,
+    RasterFormat,
+    encode_image,
+    encode_raster,
+    negotiate_format,
+    raster_headers,
+    raster_to_float32,
+)
+from ursa_backend.code.exposure import get_raster_exposure, get_zone_exposure
+from ursa_backend.code.fetch import fetch_world_cover, select_scale
+from ursa_backend.code.fs import read_raster
+from ursa_backend.code.jobs import get_job_result_path, read_job, submit_job
+from ursa_backend.code.scheduler import Priority
+from ursa_backend.code.series import get_rural_time_series
 from ursa_backend.code.suhi import (
-    generate_mean_suhi_raster,
+    get_cached_color_bounds,
+    get_cached_overview_resolutions,
+    get_categorical_path,
+    get_cover_category_stats,
     get_rural_temps,
     get_radial_cdf,
+    get_radial_max_scale,
     get_radial_pdf,
+    get_radial_profiles,
+    load_mean_suhi_raster,
+)
+from ursa_backend.code.tiles import is_valid_tile, render_tile, select_overview_level
+from ursa_backend.code.zonal import (
+    DEFAULT_PERCENTILES,
+    get_raster_zonal_stats,
+    get_zones_max_scale,
+)
+from ursa_backend.dependencies import (
+    MapInputs,
+    coverage_dependency,
+    get_lst_rasters,
+    lst_dependency,
+    map_inputs_dependency,
+    population_dependency,
+    radial_request_dependency,
+    season_lst_dependency,
+    world_cover_dependency,
+    zonal_request_dependency,
+    zones_dependency,
+)
+from ursa_backend.models import (
+    CenterRequestModel,
+    GeoTemporalRequestModel,
+    RadialBatchRequestModel,
+    RadialRequestModel,
+    RasterResponseModel,
+    TimeSeriesRequestModel,
+    ZonalRequestModel,
 )
-from ursa_backend.dependencies import lst_dependency, world_cover_dependency
-from ursa_backend.models import CenterRequestModel
 
 
 router = APIRouter(prefix="/suhi")
 
 
+def encode_raster_response(
+    fmt: RasterFormat, raster_response: RasterResponseModel
+) -> Response:
+    if fmt != "json":
+        arr = raster_to_float32(raster_response)
+        return Response(
+            content=encode_raster(fmt, arr, raster_response),
+            media_type=RASTER_MEDIA_TYPES[fmt],
+            headers=raster_headers(raster_response, arr),
+        )
+
+    arr = raster_response.data
+    return JSONResponse(
+        dict(
+            data=arr.flatten().tolist(),
+            width=arr.shape[1],
+            height=arr.shape[0],
+            crs=raster_response.crs,
+            transform=raster_response.transform,
+        )
+    )
+
+
+def map_headers(inputs: MapInputs) -> dict[str, str]:
+    headers = {"X-Raster-Scale": str(inputs["scale"])}
+    if inputs["job_id"] is not None:
+        headers["X-Full-Resolution-Job"] = inputs["job_id"]
+    return headers
+
+
 @router.get("/maps/continuous")
 def lst_endpoint(
-    monthly_temp_paths: Annotated[list[Path], Depends(lst_dependency)],
-    world_cover_path: Annotated[Path, Depends(world_cover_dependency)],
+    inputs: Annotated[MapInputs, Depends(map_inputs_dependency)],
+    format: Annotated[ImageFormat | None, Query()] = None,
+    accept: Annotated[str | None, Header()] = None,
 ):
-    mean_suhi_raster = generate_mean_suhi_raster(monthly_temp_paths, world_cover_path)
-    arr = np.array(mean_suhi_raster.data)
+    fmt = negotiate_format(format, accept, IMAGE_MEDIA_TYPES, default="json")
+    if fmt is None:
+        raise HTTPException(status_code=406, detail="Unsupported image format.")
+
+    mean_suhi_raster = load_mean_suhi_raster(
+        inputs["monthly_temp_paths"], inputs["world_cover_path"]
+    )
+    arr = mean_suhi_raster.data
+
+    if fmt != "json":
+        rgba, bounds = raster_to_rgba(arr, kind="continuous_centered")
+        headers = raster_headers(mean_suhi_raster, arr)
+        headers["X-Color-Bounds"] = json.dumps(bounds)
+        headers.update(map_headers(inputs))
+        return Response(
+            content=encode_image(fmt, rgba),
+            media_type=IMAGE_MEDIA_TYPES[fmt],
+            headers=headers,
+        )
+
     data, bounds = raster_to_rgb(arr, kind="continuous_centered")
 
     return JSONResponse(
-        dict(data=data, width=arr.shape[1], height=arr.shape[0], bounds=bounds)
+        dict(
+            data=data,
+            width=arr.shape[1],
+            height=arr.shape[0],
+            bounds=bounds,
+            scale=inputs["scale"],
+            job_id=inputs["job_id"],
+        )
     )
 
 
-@router.get("/raster/suhi")
-def raster_suhi_endpoint(
-    monthly_temp_paths: Annotated[list[Path], Depends(lst_dependency)],
-    world_cover_path: Annotated[Path, Depends(world_cover_dependency)],
+@router.get("/maps/categorical")
+def lst_cat_endpoint(
+    inputs: Annotated[MapInputs, Depends(map_inputs_dependency)],
+    format: Annotated[ImageFormat | None, Query()] = None,
+    accept: Annotated[str | None, Header()] = None,
 ):
-    raster_response = generate_mean_suhi_raster(monthly_temp_paths, world_cover_path)
-    arr = np.array(raster_response.data)
+    fmt = negotiate_format(format, accept, IMAGE_MEDIA_TYPES, default="json")
+    if fmt is None:
+        raise HTTPException(status_code=406, detail="Unsupported image format.")
+
+    cat_raster = read_raster(
+        get_categorical_path(inputs["monthly_temp_paths"], inputs["world_cover_path"])
+    )
+    arr = cat_raster.data
+
+    if fmt != "json":
+        rgba, bounds = raster_to_rgba(arr, nodata=LST_CAT_NODATA, kind="discrete")
+        headers = raster_headers(cat_raster, arr)
+        headers["X-Color-Bounds"] = json.dumps(bounds)
+        headers.update(map_headers(inputs))
+        return Response(
+            content=encode_image(fmt, rgba),
+            media_type=IMAGE_MEDIA_TYPES[fmt],
+            headers=headers,
+        )
+
+    data, bounds = raster_to_rgb(arr, nodata=LST_CAT_NODATA, kind="discrete")
+
     return JSONResponse(
         dict(
-            data=arr.flatten().tolist(),
+            data=data,
             width=arr.shape[1],
             height=arr.shape[0],
-            crs=raster_response.crs,
-            transform=raster_response.transform,
+            bounds=bounds,
+            scale=inputs["scale"],
+            job_id=inputs["job_id"],
         )
     )
 
 
+@router.get("/tiles/{z}/{x}/{y}")
+def tile_endpoint(
+    z: int,
+    x: int,
+    y: int,
+    inputs: Annotated[MapInputs, Depends(map_inputs_dependency)],
+    format: Annotated[Literal["png", "webp"], Query()] = "png",
+):
+    if not is_valid_tile(z, x, y):
+        raise HTTPException(status_code=404, detail="Tile out of range.")
+
+    raster_paths = tuple(inputs["monthly_temp_paths"])
+    world_cover_path = inputs["world_cover_path"]
+    overview_level = select_overview_level(
+        get_cached_overview_resolutions(raster_paths, world_cover_path), z
+    )
+    mean_suhi_raster = load_mean_suhi_raster(
+        raster_paths, world_cover_path, overview_level=overview_level
+    )
+    tile = render_tile(mean_suhi_raster, z, x, y)
+    if tile is None:
+        return Response(status_code=204, headers=map_headers(inputs))
+
+    color_bounds = get_cached_color_bounds(raster_paths, world_cover_path)
+    rgba, _ = raster_to_rgba(
+        tile, kind="continuous_centered", color_bounds=color_bounds
+    )
+    return Response(
+        content=encode_image(format, rgba),
+        media_type=IMAGE_MEDIA_TYPES[format],
+        headers={
+            "X-Color-Bounds": json.dumps(list(color_bounds)),
+            **map_headers(inputs),
+        },
+    )
+
+
+@router.get("/raster/suhi")
+def raster_suhi_endpoint(
+    monthly_temp_paths: Annotated[list[Path], Depends(lst_dependency)],
+    world_cover_path: Annotated[Path, Depends(world_cover_dependency)],
+    format: Annotated[RasterFormat | None, Query()] = None,
+    accept: Annotated[str | None, Header()] = None,
+):
+    fmt = negotiate_format(format, accept, RASTER_MEDIA_TYPES, default="json")
+    if fmt is None:
+        raise HTTPException(status_code=406, detail="Unsupported raster format.")
+
+    raster_response = load_mean_suhi_raster(monthly_temp_paths, world_cover_path)
+    return encode_raster_response(fmt, raster_response)
+
+
 @router.get("/data/rural")
 def rural_temp_endpoint(
+    season_temp_paths: Annotated[
+        dict[int, Path | None], Depends(season_lst_dependency)
+    ],
+    world_cover_path: Annotated[Path, Depends(world_cover_dependency)],
+):
+    # Months without scenes keep their place in the season as NaN
+    monthly_temp_paths = {
+        month: path for month, path in season_temp_paths.items() if path is not None
+    }
+    temps = dict(
+        zip(
+            monthly_temp_paths,
+            get_rural_temps(list(monthly_temp_paths.values()), world_cover_path),
+        )
+    )
+    rural_temps = [temps.get(month, float("nan")) for month in season_temp_paths]
+    return ORJSONResponse(dict(value=rural_temps, months=list(season_temp_paths)))
+
+
+@router.get("/data/rural/series")
+def rural_series_endpoint(request: Annotated[TimeSeriesRequestModel, Query()]):
+    return ORJSONResponse(get_rural_time_series(request))
+
+
+@router.get("/data/coverage")
+def coverage_endpoint(
+    coverage: Annotated[list[MonthCoverage], Depends(coverage_dependency)],
+):
+    return ORJSONResponse(dict(months=coverage))
+
+
+@router.get("/data/category")
+def category_temp_endpoint(
     monthly_temp_paths: Annotated[list[Path], Depends(lst_dependency)],
     world_cover_path: Annotated[Path, Depends(world_cover_dependency)],
 ):
-    rural_temps = get_rural_temps(monthly_temp_paths, world_cover_path)
-    return ORJSONResponse(dict(value=rural_temps))
+    return ORJSONResponse(
+        get_cover_category_stats(monthly_temp_paths, world_cover_path)
+    )
 
 
 @router.get("/data/radial")
 def radial_temp_endpoint(
-    monthly_temp_paths: Annotated[list[Path], Depends(lst_dependency)],
-    world_cover_path: Annotated[Path, Depends(world_cover_dependency)],
+    request: Annotated[RadialRequestModel, Depends(radial_request_dependency)],
     center: Annotated[CenterRequestModel, Query()],
 ):
-    raster_response = generate_mean_suhi_raster(monthly_temp_paths, world_cover_path)
+    if request.accuracy is not None:
+        request = request.with_scale(
+            select_scale(get_radial_max_scale(request.accuracy), request.scale)
+        )
+
+    world_cover_path = fetch_world_cover(request, Priority.INTERACTIVE)
+    monthly_temp_paths = get_lst_rasters(request)
+    raster_response = load_mean_suhi_raster(monthly_temp_paths, world_cover_path)
     radii, cdf = get_radial_cdf(raster_response, (center.x, center.y))
-    # _, pdf = get_radial_pdf(radii, cdf)
-    return ORJSONResponse(dict(radii=radii, cdf=cdf, pdf=[]))
+    _, pdf = get_radial_pdf(radii, cdf)
+    return ORJSONResponse(dict(radii=radii, cdf=cdf, pdf=pdf, scale=request.scale))
+
+
+@router.post("/data/radial/batch")
+def radial_batch_endpoint(request: RadialBatchRequestModel):
+    if request.accuracy is not None:
+        request = request.with_scale(
+            select_scale(get_radial_max_scale(request.accuracy), request.scale)
+        )
 
+    world_cover_path = fetch_world_cover(request, Priority.INTERACTIVE)
+    monthly_temp_paths = get_lst_rasters(request)
+    raster_response = load_mean_suhi_raster(monthly_temp_paths, world_cover_path)
 
-# @router.post("/maps/categorical")
-# def lst_cat_endpoint(
-#     month_temp_paths: Annotated[list[Path], Depends(lst_dependency)]
-# ):
-#     for path in temp_path_list:
+    profiles = get_radial_profiles(
+        raster_response,
+        [(center.x, center.y) for center in request.centers],
+        max_radii=[center.max_radius for center in request.centers],
+    )
+
+    def generate() -> Generator[bytes, None, None]:
+        for i, (center, (radii, cdf)) in enumerate(zip(request.centers, profiles)):
+            _, pdf = get_radial_pdf(radii, cdf)
+            line = dict(index=i, id=center.id, radii=radii, cdf=cdf, pdf=pdf)
+            yield orjson.dumps(line) + b"\n"
+
+    return StreamingResponse(
+        generate(),
+        media_type="application/x-ndjson",
+        headers={"X-Raster-Scale": str(request.scale)},
+    )
+
+
+@router.post("/data/zonal")
+def zonal_stats_endpoint(
+    request: Annotated[ZonalRequestModel, Depends(zonal_request_dependency)],
+    zones: Annotated[gpd.GeoDataFrame, Depends(zones_dependency)],
+    id_field: Annotated[str | None, Query()] = None,
+    percentiles: Annotated[list[float], Query()] = list(DEFAULT_PERCENTILES),
+):
+    if id_field is not None and id_field not in zones.columns:
+        raise HTTPException(status_code=422, detail=f"Unknown field: {id_field}")
+    if any(p < 0 or p > 100 for p in percentiles):
+        raise HTTPException(
+            status_code=422, detail="Percentiles must be between 0 and 100."
+        )
+
+    if request.min_zone_pixels is not None:
+        max_scale = get_zones_max_scale(zones, request.min_zone_pixels)
+        request = request.with_scale(select_scale(max_scale, request.scale))
+
+    world_cover_path = fetch_world_cover(request, Priority.INTERACTIVE)
+    monthly_temp_paths = get_lst_rasters(request)
+    raster_response = load_mean_suhi_raster(monthly_temp_paths, world_cover_path)
+    stats = get_raster_zonal_stats(
+        raster_response, zones, id_field=id_field, percentiles=percentiles
+    )
+    return ORJSONResponse(stats, headers={"X-Raster-Scale": str(request.scale)})
+
+
+@router.post("/data/exposure")
+def exposure_endpoint(
+    monthly_temp_paths: Annotated[list[Path], Depends(lst_dependency)],
+    world_cover_path: Annotated[Path, Depends(world_cover_dependency)],
+    population: Annotated[gpd.GeoDataFrame | bytes, Depends(population_dependency)],
+    weight_field: Annotated[str | None, Query()] = None,
+    bin_width: Annotated[float, Query(gt=0)] = 0.1,
+):
+    if isinstance(population, gpd.GeoDataFrame) and (
+        weight_field is None or weight_field not in population.columns
+    ):
+        raise HTTPException(
+            status_code=422,
+            detail="Polygon layers need a weight_field with the population counts.",
+        )
+
+    raster_response = load_mean_suhi_raster(monthly_temp_paths, world_cover_path)
+    if isinstance(population, bytes):
+        curve = get_raster_exposure(raster_response, population, bin_width=bin_width)
+    else:
+        curve = get_zone_exposure(
+            raster_response, population, weight_field, bin_width=bin_width
+        )
+    return ORJSONResponse(curve)
+
+
+@router.post("/jobs", status_code=202)
+def submit_job_endpoint(request: GeoTemporalRequestModel):
+    return ORJSONResponse(submit_job(request), status_code=202)
+
+
+@router.get("/jobs/{job_id}")
+def job_status_endpoint(job_id: str):
+    job = read_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return ORJSONResponse(job)
+
+
+@router.get("/jobs/{job_id}/result")
+def job_result_endpoint(
+    job_id: str,
+    format: Annotated[RasterFormat | None, Query()] = None,
+    accept: Annotated[str | None, Header()] = None,
+):
+    job = read_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
 
+    result_path = get_job_result_path(job_id)
+    if result_path is None:
+        raise HTTPException(status_code=409, detail=f"Job is {job['status']}.")
 
-#     data, width, height, bounds = raster_to_rgb(temp_path_map["cat"], discrete=True)
-#     return JSONResponse(dict(data=data, width=width, height=height, bounds=bounds))
+    fmt = negotiate_format(format, accept, RASTER_MEDIA_TYPES, default="json")
+    if fmt is None:
+        raise HTTPException(status_code=406, detail="Unsupported raster format.")
 
+    return encode_raster_response(fmt, read_raster(result_path))
 
-# @router.post("/data/category")
-# def category_temp_endpoint(
-#     temp_path_map: Annotated[dict[str, Path], Depends(lst_dependency)],
-#     world_cover_path: Annotated[Path, Depends(world_cover_dependency)],
-# ):
-#     return ORJSONResponse(calculate_cover_temperature(temp_path_map["cont"], world_cover_path))
 
 # # @router.post("/charts/temp_cat")
 # # async def temp_cat_chart_endpoint(raster_path: Annotated[Path, Depends(lst_dependency)]):